@@ -0,0 +1,58 @@
+//! no-server-workers
+/* Test the cache-control aware resources, lib/www/cache.py. */
+
+var webpage = require('webpage');
+
+function header(response, name) {
+    for (var i = 0; i < response.headers.length; i++) {
+        if (response.headers[i].name.toLowerCase() === name.toLowerCase()) {
+            return response.headers[i].value;
+        }
+    }
+    return null;
+}
+
+async_test(function () {
+    var run = 'counts-' + Date.now();
+    var page = webpage.create();
+    page.open(TEST_HTTP_BASE + 'cache?kind=page&mode=no-store&n=3&run=' + run,
+              this.step_func(function (status) {
+        assert_equals(status, 'success');
+        assert_equals(page.evaluate(function () {
+            return window.__cache_loaded;
+        }), 3);
+        page.open(TEST_HTTP_BASE + 'cache?kind=stats&run=' + run,
+                  this.step_func_done(function (status) {
+            assert_equals(status, 'success');
+            var stats = JSON.parse(page.plainText);
+            assert_deep_equals(stats, {
+                'no-store/0': { full: 1, revalidated: 0 },
+                'no-store/1': { full: 1, revalidated: 0 },
+                'no-store/2': { full: 1, revalidated: 0 }
+            });
+        }));
+    }));
+}, "requests are counted per resource");
+
+[
+    ['max-age',       'Cache-Control', /max-age=86400/],
+    ['expires',       'Expires',       /GMT$/],
+    ['etag',          'ETag',          /^"etag-0-100"$/],
+    ['last-modified', 'Last-Modified', /2015/],
+    ['no-store',      'Cache-Control', /^no-store$/]
+].forEach(function (arr) {
+    var mode = arr[0], name = arr[1], pattern = arr[2];
+    async_test(function () {
+        var page = webpage.create();
+        var url = TEST_HTTP_BASE + 'cache?mode=' + mode +
+                  '&size=100&run=headers-' + Date.now();
+        page.onResourceReceived = this.step_func(function (response) {
+            if (response.stage === 'end') {
+                assert_regexp_match(header(response, name) || '', pattern);
+            }
+        });
+        page.open(url, this.step_func_done(function (status) {
+            assert_equals(status, 'success');
+        }));
+    }, mode + " resources carry a " + name + " header");
+});
@@ -0,0 +1,57 @@
+/* Test the synthetic page generator, lib/www/gen.py. */
+
+var webpage = require('webpage');
+
+function gen_url(query) {
+    return TEST_HTTP_BASE + 'gen?' + query;
+}
+
+async_test(function () {
+    var page = webpage.create();
+    page.onResourceError = this.unreached_func();
+    page.open(gen_url('nodes=2000&imgs=5&scripts=3&work=100&seed=1'),
+              this.step_func_done(function (status) {
+        assert_equals(status, 'success');
+        var counts = page.evaluate(function () {
+            var imgs = document.images, loaded = 0;
+            for (var i = 0; i < imgs.length; i++) {
+                if (imgs[i].complete && imgs[i].naturalWidth === 16) {
+                    loaded++;
+                }
+            }
+            return {
+                nodes:   document.querySelectorAll('#gen *').length,
+                imgs:    imgs.length,
+                loaded:  loaded,
+                scripts: window.__gen_scripts
+            };
+        });
+        assert_deep_equals(counts, {
+            nodes: 2000, imgs: 5, loaded: 5, scripts: 3
+        });
+    }));
+}, "requested DOM size and subresources are generated");
+
+async_test(function () {
+    var page = webpage.create();
+    var first;
+    var url = gen_url('nodes=500&seed=42');
+    page.open(url, this.step_func(function (status) {
+        assert_equals(status, 'success');
+        first = page.content;
+        page.open(url + '&page=2', this.step_func_done(function (status) {
+            assert_equals(status, 'success');
+            assert_equals(page.content, first);
+        }));
+    }));
+}, "output is deterministic for a given seed");
+
+async_test(function () {
+    var page = webpage.create();
+    page.onResourceReceived = this.step_func(function (response) {
+        if (response.stage === 'end') {
+            assert_equals(response.status, 400);
+        }
+    });
+    page.open(gen_url('kind=bogus'), this.step_func_done());
+}, "invalid parameters are rejected");
@@ -0,0 +1,46 @@
+//! no-server-workers
+/* Test the forward proxies in front of the test servers
+   (TEST_PROXY_BASE and TEST_SOCKS_PROXY_BASE). */
+
+var webpage = require('webpage');
+
+// Each page gets its own proxy: phantom.setProxy would set one for
+// the whole process, and these tests run concurrently.
+function proxied_page(base) {
+    var page = webpage.create();
+    page.setProxy(base);
+    return page;
+}
+
+async_test(function () {
+    var page = proxied_page(TEST_PROXY_BASE);
+    page.open(TEST_HTTP_BASE + 'echo', this.step_func(function (status) {
+        assert_equals(status, 'success');
+        var echo = JSON.parse(page.plainText);
+        assert_equals(echo.headers.via, '1.1 run-tests');
+        page.open(TEST_HTTP_BASE + '__stats',
+                  this.step_func_done(function (status) {
+            assert_equals(status, 'success');
+            var stats = JSON.parse(page.plainText);
+            assert_greater_than_equal(stats.proxy.http.requests, 2);
+        }));
+    }));
+}, "HTTP requests through the HTTP proxy");
+
+async_test(function () {
+    var page = proxied_page(TEST_PROXY_BASE);
+    page.onResourceError = this.unreached_func();
+    page.open(TEST_HTTPS_BASE + 'hello.html',
+              this.step_func_done(function (status) {
+        assert_equals(status, 'success');
+    }));
+}, "HTTPS requests through the HTTP proxy (CONNECT)");
+
+async_test(function () {
+    var page = proxied_page(TEST_SOCKS_PROXY_BASE);
+    page.onResourceError = this.unreached_func();
+    page.open(TEST_HTTP_BASE + 'hello.html',
+              this.step_func_done(function (status) {
+        assert_equals(status, 'success');
+    }));
+}, "HTTP requests through the SOCKS5 proxy");
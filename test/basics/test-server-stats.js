@@ -0,0 +1,34 @@
+//! no-server-workers
+/* Test the test server's request accounting (the /__stats URL). */
+
+var webpage = require('webpage');
+
+async_test(function () {
+    var tag = 'stats-probe-' + Date.now();
+    var page = webpage.create();
+    page.open(TEST_HTTP_BASE + 'logo.html?__test=' + tag,
+              this.step_func(function (status) {
+        assert_equals(status, 'success');
+        page.open(TEST_HTTP_BASE + '__stats?test=' + tag,
+                  this.step_func_done(function (status) {
+            assert_equals(status, 'success');
+            var stats = JSON.parse(page.plainText);
+            assert_deep_equals(stats.requests, { '/logo.html': 1 });
+            assert_greater_than(stats.bytes, 0);
+        }));
+    }));
+}, "requests tagged with __test are counted separately");
+
+async_test(function () {
+    var page = webpage.create();
+    page.customHeaders = { 'X-Test-Id': 'stats-header-probe' };
+    page.open(TEST_HTTP_BASE + 'hello.html', this.step_func(function () {
+        page.customHeaders = {};
+        page.open(TEST_HTTP_BASE + '__stats?test=stats-header-probe',
+                  this.step_func_done(function (status) {
+            assert_equals(status, 'success');
+            var stats = JSON.parse(page.plainText);
+            assert_greater_than_equal(stats.requests['/hello.html'], 1);
+        }));
+    }));
+}, "requests tagged with X-Test-Id are counted separately");
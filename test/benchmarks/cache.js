@@ -0,0 +1,23 @@
+// Controller for the "disk-cache" benchmark in run-tests.py.
+// Usage: cache.js <url>
+//
+// Loads <url> (relative to the test HTTP server) once and prints a
+// RESULT line with the load time and the number of cache.py resources
+// that ran.  The runner starts a fresh process for every load so that
+// only the disk cache, not WebKit's memory cache, can satisfy repeats.
+
+var system  = require('system');
+var webpage = require('webpage');
+
+var page = webpage.create();
+var t0 = Date.now();
+page.open(system.env.TEST_HTTP_BASE + system.args[1], function (status) {
+    var ms = Date.now() - t0;
+    var loaded = page.evaluate(function () {
+        return window.__cache_loaded || 0;
+    });
+    console.log('RESULT ' + JSON.stringify({
+        status: status, ms: ms, loaded: loaded
+    }));
+    phantom.exit(0);
+});
@@ -0,0 +1,160 @@
+// Controller for the "child-process" benchmark in run-tests.py.
+// Usage: child_process.js <config>
+//
+// <config> is a JSON object:
+//
+//   { "cmd":         [program, arg, ...],  trivial command to spawn
+//     "python":      path to Python,
+//     "stream":      path to lib/fixtures/stream.py,
+//     "spawns":      spawns per latency and concurrency case,
+//     "concurrency": [children in flight, ...],
+//     "bytes":       bytes per streaming case,
+//     "chunks":      [chunk size, ...] }
+//
+// Runs, in order: sequential spawns of 'cmd' (latency), spawns of
+// 'cmd' with several children in flight, and for each chunk size,
+// streaming from a child's stdout, into a child's stdin, and through
+// a child both ways.  Prints one RESULT line per case.
+
+var cp     = require('child_process');
+var system = require('system');
+
+var config = JSON.parse(system.args[1]);
+var steps  = [];
+
+function report(r) {
+    console.log('RESULT ' + JSON.stringify(r));
+}
+
+function next() {
+    var step = steps.shift();
+    if (step) {
+        setTimeout(step, 0);
+    } else {
+        phantom.exit(0);
+    }
+}
+
+function spawnCmd(cb) {
+    var t0 = Date.now();
+    var p = cp.spawn(config.cmd[0], config.cmd.slice(1));
+    p.on('exit', function (code) {
+        cb(code, Date.now() - t0);
+    });
+}
+
+function stream(args) {
+    return cp.spawn(config.python, [config.stream].concat(args));
+}
+
+function makeChunk(n) {
+    var line = '0123456789abcdefghijklmnopqrstuvwxyz', parts = [], len = 0;
+    while (len < n) {
+        parts.push(line);
+        len += line.length;
+    }
+    return parts.join('').slice(0, n);
+}
+
+// Write config.bytes to P's stdin, CHUNK characters at a time.
+function feed(p, chunk) {
+    var data = makeChunk(chunk);
+    for (var n = 0; n < config.bytes; n += chunk) {
+        p.stdin.write(n + chunk <= config.bytes ?
+                      data : data.slice(0, config.bytes - n));
+    }
+    p.stdin.close();
+}
+
+steps.push(function () {
+    var times = [], failed = 0;
+    (function one() {
+        if (times.length === config.spawns) {
+            report({ op: 'spawn', times: times, failed: failed });
+            return next();
+        }
+        spawnCmd(function (code, ms) {
+            if (code !== 0) {
+                failed++;
+            }
+            times.push(ms);
+            one();
+        });
+    })();
+});
+
+config.concurrency.forEach(function (c) {
+    steps.push(function () {
+        var started = 0, done = 0, failed = 0, t0 = Date.now();
+        function launch() {
+            started++;
+            spawnCmd(function (code) {
+                done++;
+                if (code !== 0) {
+                    failed++;
+                }
+                if (started < config.spawns) {
+                    launch();
+                } else if (done === config.spawns) {
+                    report({ op: 'concurrent', concurrency: c,
+                             spawns: done, failed: failed,
+                             ms: Date.now() - t0 });
+                    next();
+                }
+            });
+        }
+        for (var i = 0; i < c && i < config.spawns; i++) {
+            launch();
+        }
+    });
+});
+
+config.chunks.forEach(function (chunk) {
+    steps.push(function () {
+        var bytes = 0, events = 0, t0 = Date.now();
+        var p = stream(['gen', config.bytes, chunk]);
+        p.stdout.on('data', function (data) {
+            bytes += data.length;
+            events++;
+        });
+        p.on('exit', function (code) {
+            report({ op: 'stdout', chunk: chunk, bytes: bytes,
+                     expected: config.bytes, events: events,
+                     ms: Date.now() - t0, code: code });
+            next();
+        });
+    });
+
+    steps.push(function () {
+        var out = '', t0 = Date.now();
+        var p = stream(['sink']);
+        p.stdout.on('data', function (data) {
+            out += data;
+        });
+        p.on('exit', function (code) {
+            report({ op: 'stdin', chunk: chunk, bytes: +out,
+                     expected: config.bytes, ms: Date.now() - t0,
+                     code: code });
+            next();
+        });
+        feed(p, chunk);
+    });
+
+    steps.push(function () {
+        var bytes = 0, events = 0, t0 = Date.now();
+        var p = stream(['cat']);
+        p.stdout.on('data', function (data) {
+            bytes += data.length;
+            events++;
+        });
+        p.on('exit', function (code) {
+            report({ op: 'pipe', chunk: chunk, bytes: bytes,
+                     expected: config.bytes, events: events,
+                     ms: Date.now() - t0, code: code });
+            next();
+        });
+        feed(p, chunk);
+    });
+});
+
+next();
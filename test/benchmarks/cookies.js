@@ -0,0 +1,99 @@
+// Controller for the "cookies" benchmark in run-tests.py.
+// Usage: cookies.js grow <per_response> <probes> <checkpoint> ...
+//        cookies.js count
+//
+// 'grow' repeatedly loads lib/www/cookies.py, each load setting
+// <per_response> new persistent cookies, until the jar holds each
+// <checkpoint> number of cookies in turn.  At each checkpoint it
+// loads the page <probes> more times without setting cookies, and
+// prints a RESULT line with the mean time per cookie-setting load
+// since the previous checkpoint, the mean time per probe load, the
+// number of cookies in the jar and, where /proc/self/status exists,
+// the resident set size.
+//
+// 'count' prints a RESULT line with the number of cookies in the jar
+// (as loaded from --cookies-file) and exits.
+
+var fs      = require('fs');
+var system  = require('system');
+var webpage = require('webpage');
+
+var base = system.env.TEST_HTTP_BASE + 'cookies';
+var args = system.args.slice(1);
+
+function rss() {
+    try {
+        var m = /VmRSS:\s*(\d+)/.exec(fs.read('/proc/self/status'));
+        return m ? +m[1] * 1024 : null;
+    } catch (e) {
+        return null;
+    }
+}
+
+if (args[0] === 'count') {
+    console.log('RESULT ' + JSON.stringify({ cookies: phantom.cookies.length }));
+    phantom.exit(0);
+}
+
+var perResponse = +args[1];
+var probes      = +args[2];
+var checkpoints = args.slice(3).map(Number);
+
+var page  = webpage.create();
+var batch = 0;
+var jar   = 0;
+
+function load(url, cb) {
+    var t0 = Date.now();
+    page.open(url, function (status) {
+        if (status !== 'success') {
+            console.log('load of ' + url + ' failed: ' + status);
+            phantom.exit(1);
+        }
+        cb(Date.now() - t0);
+    });
+}
+
+function checkpoint(i) {
+    if (i === checkpoints.length) {
+        phantom.exit(0);
+        return;
+    }
+
+    var setMs = 0, sets = 0, getMs = 0, gets = 0;
+
+    function grow() {
+        if (jar >= checkpoints[i]) {
+            return probe();
+        }
+        load(base + '?n=' + perResponse + '&batch=' + batch, function (ms) {
+            batch++;
+            jar += perResponse;
+            setMs += ms;
+            sets++;
+            grow();
+        });
+    }
+
+    function probe() {
+        if (gets === probes) {
+            console.log('RESULT ' + JSON.stringify({
+                target:  checkpoints[i],
+                cookies: phantom.cookies.length,
+                set_ms:  sets ? setMs / sets : null,
+                get_ms:  gets ? getMs / gets : null,
+                rss:     rss()
+            }));
+            return checkpoint(i + 1);
+        }
+        load(base, function (ms) {
+            getMs += ms;
+            gets++;
+            probe();
+        });
+    }
+
+    grow();
+}
+
+checkpoint(0);
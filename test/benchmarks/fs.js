@@ -0,0 +1,167 @@
+// Controller for the "fs" benchmark in run-tests.py.
+// Usage: fs.js <dir> <config>
+//
+// <dir> is a scratch directory prepared by the runner, containing
+// text.txt (UTF-8 text), binary.bin (random bytes) and tree/ (a
+// directory tree of small files).  <config> is a JSON object:
+//
+//   { "chunks":   [bytes, ...],        chunk sizes for read and write
+//     "modes":    ["text", "binary"],
+//     "charsets": ["UTF-8", ...],      charsets for text mode
+//     "size":     bytes }              bytes to write per write case
+//
+// Prints one RESULT line per operation, with its elapsed time, the
+// bytes (or directory entries) it processed, and, where
+// /proc/self/io exists, the read and write system calls it made.
+
+var fs     = require('fs');
+var system = require('system');
+
+var dir    = system.args[1];
+var config = JSON.parse(system.args[2]);
+var SEP    = fs.separator;
+
+function path(name) {
+    return dir + SEP + name;
+}
+
+function io() {
+    var counts = {};
+    try {
+        fs.read('/proc/self/io').split('\n').forEach(function (line) {
+            var m = /^(\w+):\s*(\d+)$/.exec(line);
+            if (m) {
+                counts[m[1]] = +m[2];
+            }
+        });
+    } catch (e) {
+        return null;
+    }
+    return counts.syscr === undefined ? null : counts;
+}
+
+function measure(result, fn) {
+    var io0 = io(), t0 = Date.now();
+    fn(result);
+    result.ms = Date.now() - t0;
+    var io1 = io();
+    if (io0 && io1) {
+        result.syscr = io1.syscr - io0.syscr;
+        result.syscw = io1.syscw - io0.syscw;
+    }
+    console.log('RESULT ' + JSON.stringify(result));
+}
+
+function openOpts(mode, charset, rw) {
+    if (mode === 'binary') {
+        return { mode: rw + 'b' };
+    }
+    return { mode: rw, charset: charset };
+}
+
+// A chunk of 'n' characters: cycling through all byte values for
+// binary mode, or text with some non-ASCII letters otherwise.
+function makeChunk(mode, n) {
+    var parts = [], len = 0, unit, i;
+    if (mode === 'binary') {
+        unit = [];
+        for (i = 0; i < 256; i++) {
+            unit.push(String.fromCharCode(i));
+        }
+        unit = unit.join('');
+    } else {
+        unit = 'The naïve café served crème brûlée.\n';
+    }
+    while (len < n) {
+        parts.push(unit);
+        len += unit.length;
+    }
+    return parts.join('').slice(0, n);
+}
+
+function cases(fn) {
+    config.modes.forEach(function (mode) {
+        var charsets = mode === 'binary' ? [null] : config.charsets;
+        charsets.forEach(function (charset) {
+            config.chunks.forEach(function (chunk) {
+                fn(mode, charset, chunk);
+            });
+        });
+    });
+}
+
+// Streaming reads, chunk by chunk.
+cases(function (mode, charset, chunk) {
+    var name = mode === 'binary' ? 'binary.bin' : 'text.txt';
+    measure({ op: 'read', mode: mode, charset: charset, chunk: chunk },
+            function (r) {
+        var f = fs.open(path(name), openOpts(mode, charset, 'r'));
+        while (f.read(chunk).length > 0) {}
+        f.close();
+        r.bytes = fs.size(path(name));
+    });
+});
+
+// Line-by-line reads of the text file.
+config.charsets.forEach(function (charset) {
+    if (config.modes.indexOf('text') === -1) {
+        return;
+    }
+    measure({ op: 'readLine', mode: 'text', charset: charset },
+            function (r) {
+        var f = fs.open(path('text.txt'), { mode: 'r', charset: charset });
+        while (!f.atEnd()) {
+            f.readLine();
+        }
+        f.close();
+        r.bytes = fs.size(path('text.txt'));
+    });
+});
+
+// Streaming writes, chunk by chunk.
+cases(function (mode, charset, chunk) {
+    var data = makeChunk(mode, chunk);
+    var out = path('out.tmp');
+    measure({ op: 'write', mode: mode, charset: charset, chunk: chunk },
+            function (r) {
+        var f = fs.open(out, openOpts(mode, charset, 'w'));
+        for (var n = 0; n < config.size; n += chunk) {
+            f.write(data);
+        }
+        f.close();
+        r.bytes = fs.size(out);
+    });
+    fs.remove(out);
+});
+
+measure({ op: 'copy' }, function (r) {
+    fs.copy(path('binary.bin'), path('copy.tmp'));
+    r.bytes = fs.size(path('copy.tmp'));
+});
+fs.remove(path('copy.tmp'));
+
+measure({ op: 'copyTree' }, function (r) {
+    fs.copyTree(path('tree'), path('tree.tmp'));
+});
+
+measure({ op: 'list' }, function (r) {
+    var entries = 0;
+    (function walk(d) {
+        fs.list(d).forEach(function (name) {
+            if (name === '.' || name === '..') {
+                return;
+            }
+            entries++;
+            if (fs.isDirectory(d + SEP + name)) {
+                walk(d + SEP + name);
+            }
+        });
+    })(path('tree.tmp'));
+    r.entries = entries;
+});
+
+measure({ op: 'removeTree' }, function (r) {
+    fs.removeTree(path('tree.tmp'));
+});
+
+phantom.exit(0);
@@ -0,0 +1,52 @@
+// Controller for the "multipage" benchmark in run-tests.py.
+// Usage: multipage.js <concurrency> <total pages> <url>
+//
+// Loads <total pages> distinct copies of <url> (relative to the test
+// HTTP server), keeping <concurrency> webpage objects in flight at
+// once.  Prints one RESULT line with the time from open() to
+// onLoadFinished for each page, then stays alive until killed so that
+// the runner can read the process's peak memory use.
+
+var system  = require('system');
+var webpage = require('webpage');
+
+var concurrency = parseInt(system.args[1], 10);
+var total       = parseInt(system.args[2], 10);
+var url         = system.env.TEST_HTTP_BASE + system.args[3];
+var sep         = url.indexOf('?') === -1 ? '?' : '&';
+
+var started  = 0;
+var finished = 0;
+var failed   = 0;
+var times    = [];
+var t_start  = Date.now();
+
+function open_next() {
+    if (started >= total) {
+        return;
+    }
+    var n = started++;
+    var page = webpage.create();
+    var t0 = Date.now();
+    page.open(url + sep + 'page=' + n, function (status) {
+        times.push(Date.now() - t0);
+        if (status !== 'success') {
+            failed++;
+        }
+        finished++;
+        page.close();
+        if (finished === total) {
+            console.log('RESULT ' + JSON.stringify({
+                times: times,
+                failed: failed,
+                elapsed: Date.now() - t_start
+            }));
+        } else {
+            setTimeout(open_next, 0);
+        }
+    });
+}
+
+for (var i = 0; i < concurrency; i++) {
+    open_next();
+}
@@ -0,0 +1,61 @@
+// Controller for the "render" benchmark in run-tests.py.
+// Usage: render.js <cases.json> <scratch directory>
+//
+// cases.json holds an array of render cases built by run-tests.py.
+// For each case, the page is loaded once and then rendered repeatedly;
+// one RESULT line of JSON is printed per case.  If the case has 'keep'
+// set, every render is left in the scratch directory, named in the
+// result's 'files', for the runner to check.
+
+var fs      = require('fs');
+var system  = require('system');
+var webpage = require('webpage');
+
+var cases   = JSON.parse(fs.read(system.args[1]));
+var scratch = system.args[2];
+var base    = system.env.TEST_HTTP_BASE;
+
+function run_case(i) {
+    if (i >= cases.length) {
+        phantom.exit(0);
+        return;
+    }
+    var c = cases[i];
+    var page = webpage.create();
+    page.viewportSize = c.viewport;
+    page.zoomFactor = c.zoom;
+    if (c.paperSize) {
+        page.paperSize = c.paperSize;
+    }
+
+    page.open(base + c.url, function (status) {
+        var result = { index: i, status: status };
+        if (status === 'success') {
+            var out = fs.join(scratch, i + '.' + c.format);
+            var opts = { format: c.format };
+            if (c.quality) {
+                opts.quality = c.quality;
+            }
+            result.times = [];
+            result.files = [];
+            for (var n = 0; n < c.iterations; n++) {
+                if (c.keep) {
+                    out = fs.join(scratch, i + '.' + n + '.' + c.format);
+                    result.files.push(out);
+                }
+                var t0 = Date.now();
+                page.render(out, opts);
+                result.times.push(Date.now() - t0);
+            }
+            result.bytes = fs.size(out);
+            if (!c.keep) {
+                fs.remove(out);
+            }
+        }
+        console.log('RESULT ' + JSON.stringify(result));
+        page.close();
+        setTimeout(function () { run_case(i + 1); }, 0);
+    });
+}
+
+run_case(0);
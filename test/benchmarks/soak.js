@@ -0,0 +1,104 @@
+// Controller for the "soak" benchmark in run-tests.py.
+// Usage: soak.js <scenario> <iterations> <every>
+//
+// Runs one scenario <iterations> times in this process, each time
+// creating a webpage, loading a fixture from the test server, doing
+// something with it and closing the page again.  After every <every>
+// iterations it prints "SAMPLE <n>", n being the number completed so
+// far, so that the runner can read our RSS at that point; it prints
+// "DONE <ms>" with the total elapsed time at the end.
+//
+// Scenarios:
+//   open      load lib/www/bench/text.html
+//   render    load lib/www/bench/images.html and render it to PNG
+//   evaluate  load lib/www/bench/text.html and walk its DOM
+//   cookies   load lib/www/cookies.py, which sets cookies, and then
+//             clear the cookie jar
+//   iframes   load lib/www/frameset/index.html (nested frames)
+
+var system  = require('system');
+var webpage = require('webpage');
+
+var base       = system.env.TEST_HTTP_BASE;
+var scenario   = system.args[1];
+var iterations = +system.args[2];
+var every      = +system.args[3];
+
+var SCENARIOS = {
+    open: {
+        url: function () { return base + 'bench/text.html'; },
+        run: function (page) {}
+    },
+    render: {
+        url: function () { return base + 'bench/images.html'; },
+        run: function (page) {
+            if (!page.renderBase64('PNG')) {
+                fail('render produced no output');
+            }
+        }
+    },
+    evaluate: {
+        url: function () { return base + 'bench/text.html'; },
+        run: function (page) {
+            var n = page.evaluate(function () {
+                var texts = [];
+                Array.prototype.forEach.call(
+                    document.querySelectorAll('*'),
+                    function (el) { texts.push(el.textContent); });
+                return texts.length;
+            });
+            if (!n) {
+                fail('evaluate found no elements');
+            }
+        }
+    },
+    cookies: {
+        url: function (i) { return base + 'cookies?n=20&batch=' + i; },
+        run: function (page) {
+            phantom.clearCookies();
+        }
+    },
+    iframes: {
+        url: function () { return base + 'frameset/index.html'; },
+        run: function (page) {
+            if (page.framesCount < 1) {
+                fail('frameset has no frames');
+            }
+        }
+    }
+};
+
+function fail(message) {
+    console.log('FAIL ' + scenario + ': ' + message);
+    phantom.exit(1);
+}
+
+var s  = SCENARIOS[scenario];
+var t0 = Date.now();
+
+function iteration(i) {
+    if (i === iterations) {
+        console.log('DONE ' + (Date.now() - t0));
+        phantom.exit(0);
+        return;
+    }
+    var page = webpage.create();
+    page.open(s.url(i), function (status) {
+        if (status !== 'success') {
+            return fail('load failed: ' + status);
+        }
+        s.run(page);
+        page.close();
+        if ((i + 1) % every === 0) {
+            console.log('SAMPLE ' + (i + 1));
+        }
+        // Let the event loop run, so that deferred deletions happen.
+        setTimeout(function () { iteration(i + 1); }, 0);
+    });
+}
+
+if (s) {
+    iteration(0);
+} else {
+    fail('unknown scenario');
+}
@@ -0,0 +1,27 @@
+// Controller for the "startup" benchmark in run-tests.py.
+// Usage: startup.js [module ...]
+//
+// Records the time at which the script starts executing (i.e. after
+// Qt initialization and bootstrap.js), then requires each named core
+// module in turn, timing each one.  The pseudo-module "page" creates
+// a webpage object instead.  Prints one RESULT line and exits.
+
+var start = Date.now();
+var system = require('system');
+var steps = { system: Date.now() - start };
+
+system.args.slice(1).forEach(function (name) {
+    if (name === 'system') {
+        return; // already loaded, to read the arguments
+    }
+    var t0 = Date.now();
+    if (name === 'page') {
+        require('webpage').create();
+    } else {
+        require(name);
+    }
+    steps[name] = Date.now() - t0;
+});
+
+console.log('RESULT ' + JSON.stringify({ start: start, steps: steps }));
+phantom.exit(0);
@@ -0,0 +1,68 @@
+// Controller for the "stdio" benchmark in run-tests.py.
+// Usage: stdio.js readLine
+//        stdio.js read <chunk>
+//        stdio.js write <stdout|stderr> <chunk> <bytes>
+//
+// 'readLine' and 'read' consume standard input, which the runner
+// feeds with lines of text, until EOF: a line at a time with
+// system.stdin.readLine, or <chunk> characters at a time with
+// system.stdin.read.  'write' writes <bytes> characters of
+// 80-character lines to system.stdout or system.stderr, <chunk>
+// characters per call, for the runner to count.
+//
+// Prints one RESULT line on standard output when done, with the
+// characters transferred, the number of calls and the elapsed ms.
+
+var system = require('system');
+
+var args = system.args.slice(1);
+var op   = args[0];
+
+function makeChunk(n) {
+    var line = new Array(80).join('x') + '\n', parts = [], len = 0;
+    while (len < n) {
+        parts.push(line);
+        len += line.length;
+    }
+    return parts.join('').slice(0, n);
+}
+
+var bytes = 0, calls = 0, s, chunk, t0;
+
+if (op === 'readLine') {
+    t0 = Date.now();
+    // Lines are never empty, so an empty result means EOF.
+    while ((s = system.stdin.readLine())) {
+        bytes += s.length + 1;
+        calls++;
+    }
+} else if (op === 'read') {
+    chunk = +args[1];
+    t0 = Date.now();
+    while ((s = system.stdin.read(chunk))) {
+        bytes += s.length;
+        calls++;
+    }
+} else if (op === 'write') {
+    var out = system[args[1]], total = +args[3];
+    chunk = +args[2];
+    // Each write continues the line the previous one left off in.
+    var data = makeChunk(chunk + 80);
+    t0 = Date.now();
+    while (bytes < total) {
+        var n = Math.min(chunk, total - bytes), off = bytes % 80;
+        out.write(data.substr(off, n));
+        bytes += n;
+        calls++;
+    }
+    out.flush();
+} else {
+    console.log('unknown operation: ' + op);
+    phantom.exit(1);
+}
+
+console.log('RESULT ' + JSON.stringify({
+    op: op, chunk: chunk || null, bytes: bytes, calls: calls,
+    ms: Date.now() - t0
+}));
+phantom.exit(0);
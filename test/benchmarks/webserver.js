@@ -0,0 +1,30 @@
+// Target for the "webserver" benchmark in run-tests.py.
+// Usage: webserver.js <port> keepalive|close <body size>
+//
+// Answers every request with a fixed-size text body.  Nothing is
+// logged per request, so that console I/O does not distort the
+// measurement.
+
+var system = require('system');
+var server = require('webserver').create();
+
+var port      = system.args[1];
+var keepAlive = system.args[2] === 'keepalive';
+var body      = new Array(parseInt(system.args[3], 10) + 1).join('x');
+
+var listening = server.listen(port, { keepAlive: keepAlive },
+                              function (request, response) {
+    response.statusCode = 200;
+    response.headers = {
+        'Content-Type': 'text/plain',
+        'Content-Length': body.length
+    };
+    response.write(body);
+    response.close();
+});
+
+if (!listening) {
+    console.log('ERROR: could not listen on port ' + port);
+    phantom.exit(1);
+}
+console.log('READY ' + port);
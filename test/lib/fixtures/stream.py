@@ -0,0 +1,44 @@
+# Streaming helper for child_process tests and benchmarks.
+#   stream.py gen BYTES CHUNK  write BYTES bytes of text to stdout,
+#                              CHUNK bytes per write
+#   stream.py sink             read stdin to EOF, then write the number
+#                              of bytes read
+#   stream.py cat              copy stdin to stdout as it arrives
+# Uses os.read/os.write to avoid buffering and to be Python 2/3
+# agnostic.
+import os
+import sys
+
+def write_all(data):
+    while data:
+        data = data[os.write(1, data):]
+
+def main(argv):
+    mode = argv[1]
+    if mode == 'gen':
+        total, chunk = int(argv[2]), int(argv[3])
+        line = b'0123456789abcdefghijklmnopqrstuvwxyz' * 2 + b'\n'
+        block = (line * (chunk // len(line) + 1))[:chunk]
+        while total > 0:
+            write_all(block[:total])
+            total -= len(block)
+    elif mode == 'sink':
+        n = 0
+        while True:
+            data = os.read(0, 65536)
+            if not data:
+                break
+            n += len(data)
+        write_all(str(n).encode('ascii'))
+    elif mode == 'cat':
+        while True:
+            data = os.read(0, 65536)
+            if not data:
+                break
+            write_all(data)
+    else:
+        sys.stderr.write('usage: stream.py gen BYTES CHUNK | sink | cat\n')
+        return 2
+    return 0
+
+sys.exit(main(sys.argv))
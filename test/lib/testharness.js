@@ -755,7 +755,8 @@ Test.prototype.perform_step = function perform_step(stepdata) {
     // Arm the local timeout if it hasn't happened already.
     if (this.timeout_id === null && this.timeout_length !== null) {
         this.timeout_id = setTimeout(this.force_timeout.bind(this),
-                                     this.timeout_length);
+                                     this.timeout_length *
+                                     settings.timeout_scale);
     }
 
     var rv = undefined;
@@ -1017,7 +1018,8 @@ Tests.prototype.set_timeout = function set_timeout() {
     clearTimeout(this.timeout_id);
     if (this.harness_timeout_length !== null) {
         this.timeout_id = setTimeout(function () { this_obj.timeout(); },
-                                     this.harness_timeout_length);
+                                     this.harness_timeout_length *
+                                     settings.timeout_scale);
     }
 };
 
@@ -1450,13 +1452,20 @@ function process_command_line(sys) {
 
 var settings = {
     harness_timeout: 5000,
-    test_timeout: null
+    test_timeout: null,
+    timeout_scale: 1
 };
 
 var sys  = require('system');
 var fs   = require('fs');
 var args = process_command_line(sys);
 
+// run-tests.py sets this when the test runs under a profiler, which
+// slows it down; all timeouts are multiplied by it.
+if (sys.env['TEST_TIMEOUT_SCALE']) {
+    settings.timeout_scale = +sys.env['TEST_TIMEOUT_SCALE'];
+}
+
 if (args.test_script === "") {
     // process_command_line has already issued an error message.
     phantom.exit(2);
@@ -1466,6 +1475,10 @@ if (args.test_script === "") {
     expose(sys.env['TEST_HTTP_BASE'], 'TEST_HTTP_BASE');
     expose(sys.env['TEST_HTTPS_BASE'], 'TEST_HTTPS_BASE');
 
+    // ... and to the URLs of its HTTP and SOCKS5 forward proxies.
+    expose(sys.env['TEST_PROXY_BASE'], 'TEST_PROXY_BASE');
+    expose(sys.env['TEST_SOCKS_PROXY_BASE'], 'TEST_SOCKS_PROXY_BASE');
+
     // run-tests.py sets these environment variables to the full pathnames
     // of the PhantomJS binary and Python interpreter.
     expose(sys.env['PHANTOMJS'], 'PHANTOMJS');
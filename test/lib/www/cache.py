@@ -0,0 +1,122 @@
+# Cache-control-aware resources, for testing and benchmarking the
+# disk cache (--disk-cache).  Every request is counted, so a test can
+# ask afterward how many requests actually reached the server.
+#
+#   cache?mode=M&id=N&size=N&run=T
+#       A script resource padded to 'size' bytes, with caching headers
+#       chosen by 'mode':
+#         max-age        Cache-Control: max-age (fresh for a day)
+#         expires        Expires, one day in the future
+#         etag           ETag, must revalidate; 304 on If-None-Match
+#         last-modified  Last-Modified, must revalidate; 304 on
+#                        If-Modified-Since
+#         no-store       Cache-Control: no-store
+#       When run, the script increments window.__cache_loaded.
+#
+#   cache?kind=page&mode=M&n=N&size=N&run=T
+#       An uncacheable page that loads resources 0..n-1 of that mode.
+#
+#   cache?kind=stats&run=T
+#       JSON object mapping "mode/id" to {"full": N, "revalidated": N}
+#       for every resource requested with that run tag.
+#
+# 'run' is an arbitrary tag that keeps the counts of separate test
+# runs apart.
+import cStringIO as StringIO
+import email.utils
+import json
+import threading
+import time
+import urlparse
+
+LAST_MODIFIED = 'Thu, 01 Jan 2015 00:00:00 GMT'
+MODES = ('max-age', 'expires', 'etag', 'last-modified', 'no-store')
+
+counts_lock = threading.Lock()
+counts = {}
+
+def count(run, key, what):
+    with counts_lock:
+        c = counts.setdefault(run, {}).setdefault(
+            key, {'full': 0, 'revalidated': 0})
+        c[what] += 1
+
+def do_response(req, body, ctype, code=200, headers=()):
+    req.send_response(code)
+    if code != 304:
+        req.send_header('Content-Type', ctype)
+        req.send_header('Content-Length', str(len(body)))
+    for k, v in headers:
+        req.send_header(k, v)
+    req.end_headers()
+    return StringIO.StringIO(body)
+
+def resource(req, mode, rid, size, run):
+    key = '{}/{}'.format(mode, rid)
+    etag = '"{}-{}-{}"'.format(mode, rid, size)
+    headers = []
+    revalidated = False
+
+    if mode == 'max-age':
+        headers.append(('Cache-Control', 'public, max-age=86400'))
+    elif mode == 'expires':
+        headers.append(('Expires',
+                        email.utils.formatdate(time.time() + 86400,
+                                               usegmt=True)))
+    elif mode == 'etag':
+        headers.append(('Cache-Control', 'no-cache'))
+        headers.append(('ETag', etag))
+        revalidated = req.headers.get('If-None-Match') == etag
+    elif mode == 'last-modified':
+        headers.append(('Cache-Control', 'no-cache'))
+        headers.append(('Last-Modified', LAST_MODIFIED))
+        revalidated = req.headers.get('If-Modified-Since') == LAST_MODIFIED
+    else:
+        headers.append(('Cache-Control', 'no-store'))
+
+    if revalidated:
+        count(run, key, 'revalidated')
+        return do_response(req, '', None, code=304, headers=headers)
+
+    count(run, key, 'full')
+    body = 'window.__cache_loaded = (window.__cache_loaded || 0) + 1;\n'
+    # A comment takes at least three bytes; pad less with newlines.
+    pad = size - len(body)
+    if pad >= 3:
+        body += '//' + 'x' * (pad - 3) + '\n'
+    elif pad > 0:
+        body += '\n' * pad
+    return do_response(req, body, 'application/javascript', headers=headers)
+
+def page(req, mode, n, size, run):
+    body = ['<!doctype html><title>cache test</title>']
+    for i in range(n):
+        body.append('<script src="cache?mode={}&id={}&size={}&run={}">'
+                    '</script>'.format(mode, i, size, run))
+    return do_response(req, ''.join(body), 'text/html',
+                       headers=[('Cache-Control', 'no-store')])
+
+def handle_request(req):
+    url = urlparse.urlparse(req.path)
+    q = dict(urlparse.parse_qsl(url.query))
+    kind = q.get('kind', 'resource')
+    run  = q.get('run', '')
+    try:
+        if kind == 'stats':
+            with counts_lock:
+                body = json.dumps(counts.get(run, {}), sort_keys=True)
+            return do_response(req, body, 'application/json',
+                               headers=[('Cache-Control', 'no-store')])
+
+        mode = q.get('mode', 'max-age')
+        if mode not in MODES:
+            raise ValueError('unknown mode ' + mode)
+        size = int(q.get('size', 0))
+        if kind == 'page':
+            return page(req, mode, int(q.get('n', 1)), size, run)
+        elif kind == 'resource':
+            return resource(req, mode, int(q.get('id', 0)), size, run)
+        raise ValueError('unknown kind ' + kind)
+
+    except ValueError as e:
+        return do_response(req, str(e) + '\n', 'text/plain', code=400)
@@ -0,0 +1,55 @@
+# Cookie-setting resource, for growing a cookie jar to a large size
+# (see the "cookies" benchmark in run-tests.py).
+#
+#   cookies?n=N&batch=B&size=S
+#
+# sets N persistent cookies named bB_0 ... bB_{N-1}, each with a value
+# of S bytes (16 by default).  Each batch is scoped to its own path,
+# <dir>/cookie-scope/bB, below the directory of this resource, so the
+# cookies are stored but never sent back: the jar can grow to tens of
+# thousands of cookies without the Cookie header growing with it.
+# The response is a small HTML page whose title gives the number of
+# cookies the request carried.
+import cStringIO as StringIO
+import email.utils
+import posixpath
+import time
+import urlparse
+
+def handle_request(req):
+    url = urlparse.urlparse(req.path)
+    try:
+        q = dict(urlparse.parse_qsl(url.query))
+        n     = int(q.get('n', 0))
+        batch = int(q.get('batch', 0))
+        size  = int(q.get('size', 16))
+        if n < 0 or size < 0:
+            raise ValueError("parameters out of range")
+    except ValueError as e:
+        body = str(e) + '\n'
+        req.send_response(400)
+        req.send_header('Content-Type', 'text/plain')
+        req.send_header('Content-Length', str(len(body)))
+        req.end_headers()
+        return StringIO.StringIO(body)
+
+    cookie = req.headers.get('Cookie', '')
+    received = len([c for c in cookie.split(';') if c.strip()])
+    body = ('<!doctype html><title>{} cookies received</title>\n'
+            .format(received))
+
+    scope = posixpath.join(posixpath.dirname(url.path),
+                           'cookie-scope', 'b{}'.format(batch))
+    expires = email.utils.formatdate(time.time() + 86400, usegmt=True)
+    value = 'v' * size
+
+    req.send_response(200)
+    req.send_header('Content-Type', 'text/html')
+    req.send_header('Content-Length', str(len(body)))
+    req.send_header('Cache-Control', 'no-store')
+    for i in range(n):
+        req.send_header('Set-Cookie',
+                        'b{}_{}={}; Path={}; Expires={}'.format(
+                            batch, i, value, scope, expires))
+    req.end_headers()
+    return StringIO.StringIO(body)
@@ -0,0 +1,121 @@
+# Synthetic page generator, for performance tests and benchmarks that
+# need large inputs without checking large files in.
+#
+#   gen?nodes=N&imgs=N&scripts=N&work=N&imgsize=N&seed=N
+#
+# produces an HTML document whose <div id="gen"> contains exactly
+# 'nodes' descendant elements, arranged as a tree with random fan-out,
+# followed by 'imgs' images and 'scripts' external scripts.  Each
+# script runs a loop of 'work' iterations and then increments
+# window.__gen_scripts.  The subresources are served by this same
+# hook (gen?kind=img&..., gen?kind=js&...).  The output depends only on
+# the query, so the same URL always yields the same bytes.  Unknown
+# parameters are ignored, so callers can make a URL unique (to defeat
+# caching) by adding one.
+import cStringIO as StringIO
+import random
+import struct
+import urlparse
+import zlib
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+DEFAULTS = dict(nodes=100, imgs=0, scripts=0, work=1000, imgsize=16,
+                seed=0, n=0)
+
+def do_response(req, body, ctype, code=200):
+    req.send_response(code)
+    req.send_header('Content-Type', ctype)
+    req.send_header('Content-Length', str(len(body)))
+    req.end_headers()
+    return StringIO.StringIO(body)
+
+def gen_tree(rng, out, count):
+    # Emit 'count' elements: one element containing the rest, split
+    # evenly among a random number of subtrees.  Leaves are spans with
+    # a few words of text; interior nodes are divs.
+    rest = count - 1
+    if rest == 0:
+        out.append('<span>')
+        out.append(' '.join(rng.choice(WORDS)
+                            for _ in range(rng.randint(1, 4))))
+        out.append('</span>')
+        return
+
+    out.append('<div class="c{}">'.format(rng.randint(0, 9)))
+    k = min(rest, rng.randint(2, 8))
+    for i in range(k):
+        part = rest // k + (1 if i < rest % k else 0)
+        gen_tree(rng, out, part)
+    out.append('</div>')
+
+def gen_page(p):
+    rng = random.Random(p['seed'])
+    out = ['<!doctype html><html><head><meta charset="utf-8">'
+           '<title>generated page {}</title>'
+           '<style>.c0{{color:#333}}.c1{{margin:1px}}'
+           'span{{padding:0 2px}}</style>'
+           '</head><body><div id="gen">'.format(p['seed'])]
+    if p['nodes'] > 0:
+        gen_tree(rng, out, p['nodes'])
+    out.append('</div>')
+    for i in range(p['imgs']):
+        out.append('<img src="gen?kind=img&n={}&imgsize={}&seed={}">'
+                   .format(i, p['imgsize'], p['seed']))
+    for i in range(p['scripts']):
+        out.append('<script src="gen?kind=js&n={}&work={}&seed={}">'
+                   '</script>'.format(i, p['work'], p['seed']))
+    out.append('</body></html>\n')
+    return ''.join(out)
+
+def gen_png(p):
+    # A solid-color RGB PNG whose color is determined by seed and n.
+    rng = random.Random(p['seed'] * 1000003 + p['n'])
+    rgb = ''.join(chr(rng.randint(0, 255)) for _ in range(3))
+    size = p['imgsize']
+    raw = ''.join('\x00' + rgb * size for _ in range(size))
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(raw)) +
+            chunk('IEND', ''))
+
+def gen_js(p):
+    return ('(function () {{'
+            'var x = {seed};'
+            'for (var i = 0; i < {work}; i++) {{'
+            'x = (x * 1103515245 + 12345 + {n}) % 2147483648;'
+            '}}'
+            'window.__gen_checksum = ((window.__gen_checksum || 0) + x) %'
+            ' 2147483648;'
+            'window.__gen_scripts = (window.__gen_scripts || 0) + 1;'
+            '}})();\n'.format(**p))
+
+def handle_request(req):
+    url = urlparse.urlparse(req.path)
+    p = dict(DEFAULTS)
+    kind = 'html'
+    try:
+        for key, value in urlparse.parse_qsl(url.query):
+            if key == 'kind':
+                kind = value
+            elif key in p:
+                p[key] = int(value)
+        if kind not in ('html', 'img', 'js'):
+            raise ValueError("unknown kind " + kind)
+        if min(p.values()) < 0 or p['imgsize'] == 0:
+            raise ValueError("parameters out of range")
+    except ValueError as e:
+        return do_response(req, str(e) + '\n', 'text/plain', code=400)
+
+    if kind == 'img':
+        return do_response(req, gen_png(p), 'image/png')
+    elif kind == 'js':
+        return do_response(req, gen_js(p), 'application/javascript')
+    else:
+        return do_response(req, gen_page(p), 'text/html; charset=utf-8')
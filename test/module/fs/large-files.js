@@ -0,0 +1,91 @@
+// Streaming reads and writes of files much larger than any one chunk.
+
+var CHUNK = 65536,
+    CHUNKS = 16;        // 1 MiB in all
+
+var fs = require('fs');
+var system = require('system');
+
+// A fresh directory under the system's temporary directory, removed
+// when test T is done.
+function tempDir(t) {
+    var dir = fs.join(system.env.TMPDIR || system.env.TEMP || "/tmp",
+                      "phantomjs-large-files." + system.pid);
+    assert_is_true(fs.makeTree(dir));
+    t.add_cleanup(function () { fs.removeTree(dir); });
+    return dir;
+}
+
+// Chunk 'i' of the binary file: every byte value, rotated by i, so
+// that misplaced or dropped chunks are detected.
+function binaryChunk(i) {
+    var codes = [], parts = [], j;
+    for (j = 0; j < 256; j++) {
+        codes.push((i + j) & 0xff);
+    }
+    var unit = String.fromCharCode.apply(String, codes);
+    for (j = 0; j < CHUNK; j += 256) {
+        parts.push(unit);
+    }
+    return parts.join("");
+}
+
+test(function () {
+    var FILENAME_BIN = fs.join(tempDir(this), "large.bin");
+    var f = fs.open(FILENAME_BIN, "wb");
+    this.add_cleanup(function () { f.close(); });
+
+    var i;
+    for (i = 0; i < CHUNKS; i++) {
+        assert_is_true(f.write(binaryChunk(i)));
+    }
+    f.close();
+    assert_equals(fs.size(FILENAME_BIN), CHUNK * CHUNKS);
+
+    // Read back in chunks of a different size from the ones written.
+    f = fs.open(FILENAME_BIN, "rb");
+    var expected = "", got, n = 0;
+    for (i = 0; i < CHUNKS; i += 4) {
+        expected = binaryChunk(i) + binaryChunk(i + 1) +
+            binaryChunk(i + 2) + binaryChunk(i + 3);
+        got = f.read(CHUNK * 4);
+        assert_equals(got.length, CHUNK * 4);
+        assert_is_true(got === expected, "chunk " + i + " intact");
+        n += got.length;
+    }
+    assert_equals(f.read(CHUNK), "");
+    assert_is_true(f.atEnd());
+    assert_equals(n, CHUNK * CHUNKS);
+
+}, "stream 1 MiB of binary data through a file");
+
+test(function () {
+    var line = "ligne n°", lines = 5000;
+
+    var FILENAME_TXT = fs.join(tempDir(this), "large.txt");
+    var f = fs.open(FILENAME_TXT, { mode: "w", charset: "UTF-8" });
+    this.add_cleanup(function () { f.close(); });
+
+    var i;
+    for (i = 0; i < lines; i++) {
+        f.writeLine(line + i);
+    }
+    f.close();
+
+    // "°" is two bytes in UTF-8; allow for DOS line endings.
+    var bytes = 0;
+    for (i = 0; i < lines; i++) {
+        bytes += line.length + 1 + String(i).length + 1;
+    }
+    assert_greater_than_equal(fs.size(FILENAME_TXT), bytes);
+
+    f = fs.open(FILENAME_TXT, { mode: "r", charset: "UTF-8" });
+    for (i = 0; !f.atEnd(); i++) {
+        var got = f.readLine().replace(/\r?\n$/, "");
+        if (got !== line + i) {
+            assert_equals(got, line + i, "line " + i);
+        }
+    }
+    assert_equals(i, lines);
+
+}, "stream a large UTF-8 text file line by line");
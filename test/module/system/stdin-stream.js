@@ -0,0 +1,30 @@
+//! stdin-file: lib/fixtures/stdin.json
+//! stdin-lines: 20000 zwölf Boxkämpfer
+
+//^ a file, then twenty thousand generated lines, on one input stream
+
+var stdin;
+setup(function () { stdin = require("system").stdin; });
+
+test(function () {
+    var data = JSON.parse(stdin.readLine());
+    assert_equals(data.name, "stdin-file");
+    assert_equals(data.lines[0],
+        "Victor jagt zwölf Boxkämpfer quer über den großen Sylter Deich");
+}, "input from stdin-file");
+
+test(function () {
+    var line, n = 0;
+    while (n < 20000) {
+        line = stdin.readLine();
+        n++;
+        if (line !== n + " zwölf Boxkämpfer") {
+            break;
+        }
+    }
+    assert_equals(line, "20000 zwölf Boxkämpfer");
+}, "input from stdin-lines");
+
+test(function () {
+    assert_equals(stdin.readLine(), "");
+}, "end of input");
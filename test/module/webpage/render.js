@@ -1,3 +1,5 @@
+//! compare-renders: renders/
+
 var fs      = require("fs");
 var system  = require("system");
 var webpage = require("webpage");
@@ -11,7 +13,7 @@ function clean_pdf(data) {
     return data;
 }
 
-function render_test(format, option) {
+function render_test(format, option, variant, xfail) {
     var opt = option || {};
     var scratch = "temp_render";
     if (!opt.format) {
@@ -28,6 +30,19 @@ function render_test(format, option) {
     p.open(TEST_HTTP_BASE + "render/", this.step_func_done(function (status) {
         p.render(scratch, opt);
         this.add_cleanup(function () { fs.remove(scratch); });
+
+        // run-tests.py also compares raster renders with the references
+        // within a tolerance, and reports how much they differ; those
+        // in the xfail subdirectory are expected to differ.
+        if (format !== "pdf" && system.env.TEST_RENDER_DIR) {
+            var dir = system.env.TEST_RENDER_DIR;
+            if (xfail) {
+                dir = fs.join(dir, "xfail");
+                fs.makeTree(dir);
+            }
+            fs.copy(scratch, fs.join(dir, "test" + (opt.quality || "") + "." +
+                                          variant + "." + format));
+        }
         var content = fs.read(scratch, "b");
 
         // expected variation in PDF output
@@ -42,26 +57,29 @@ function render_test(format, option) {
 }
 
 [
-    ["PDF",                               "pdf", {}],
-    ["PDF (format option)",               "pdf", {format: "pdf"}],
-    ["PNG",                               "png", {}],
-    ["PNG (format option)",               "png", {format: "png"}],
-    ["JPEG",                              "jpg", {}],
-    ["JPEG (format option)",              "jpg", {format: "jpg"}],
-    ["JPEG (quality option)",             "jpg", {quality: 50}],
-    ["JPEG (format and quality options)", "jpg", {format: "jpg", quality: 50}],
+    ["PDF",                               "pdf", {}, "plain"],
+    ["PDF (format option)",               "pdf", {format: "pdf"}, "format"],
+    ["PNG",                               "png", {}, "plain"],
+    ["PNG (format option)",               "png", {format: "png"}, "format"],
+    ["JPEG",                              "jpg", {}, "plain"],
+    ["JPEG (format option)",              "jpg", {format: "jpg"}, "format"],
+    ["JPEG (quality option)",             "jpg", {quality: 50}, "quality"],
+    ["JPEG (format and quality options)", "jpg", {format: "jpg", quality: 50},
+     "format-quality"],
 ]
 .forEach(function (arr) {
-    var label  = arr[0];
-    var format = arr[1];
-    var opt    = arr[2];
-    var props  = {};
+    var label   = arr[0];
+    var format  = arr[1];
+    var opt     = arr[2];
+    var variant = arr[3];
+    var props   = {};
 
     // All tests fail on Linux.  All tests except JPG fail on Mac.
     // Currently unknown which tests fail on Windows.
     if (format !== "jpg" || system.os.name !== "mac")
         props.expected_fail = true;
 
-    async_test(function () { render_test.call(this, format, opt); },
-               label, props);
+    async_test(function () {
+        render_test.call(this, format, opt, variant, props.expected_fail);
+    }, label, props);
 });
@@ -1,27 +1,53 @@
 #!/usr/bin/env python
 
 import argparse
+import base64
+import BaseHTTPServer
 import collections
+import ctypes
+import ctypes.util
+import distutils.spawn
 import errno
+import fnmatch
 import glob
+import hashlib
+import httplib
 import imp
+import itertools
+import json
+import mmap
 import os
 import platform
 import posixpath
+import Queue
 import re
+import select
 import shlex
+import shutil
+import signal
 import SimpleHTTPServer
 import socket
 import SocketServer
 import ssl
 import string
 import cStringIO as StringIO
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 import traceback
 import urllib
+import urlparse
+
+# NumPy and Pillow are needed only to compare rendered images with
+# their references (see RenderCheck); without them, that is skipped.
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = Image = None
 
 # All files matching one of these glob patterns will be run as tests.
 TESTS = [
@@ -35,6 +61,12 @@ TIMEOUT    = 7     # Maximum duration of PhantomJS execution (in seconds).
                    # This is a backstop; testharness.js imposes a shorter
                    # timeout.  Both can be increased if necessary.
 
+BENCH_DIR  = 'benchmarks'  # Controller scripts for the --bench scenarios
+                           # live here.  They are not run as tests.
+
+TOLERANCE  = 10    # A benchmark measurement this many percent worse than
+                   # its stored baseline is reported as a failure.
+
 #
 # Utilities
 #
@@ -95,6 +127,248 @@ def activate_colorization(options):
 def colorize(color, message):
     return _COLORS[color] + message + _COLORS["_"]
 
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers; VALUES need not be
+       sorted.  Returns None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def linear_fit(xs, ys):
+    """Least-squares fit of the line YS = slope * XS + intercept.
+       Returns (slope, intercept)."""
+    n = float(len(xs))
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if not sxx:
+        return 0.0, my
+    slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+    return slope, my - slope * mx
+
+def log2_bucket(value):
+    """Upper bound of the log2 histogram bucket holding VALUE."""
+    bound = 0.125
+    while value > bound:
+        bound *= 2
+    return bound
+
+def format_size(nbytes):
+    """Format NBYTES compactly, e.g. '512 B', '64 KiB', '1 MiB'."""
+    for unit in ("B", "KiB", "MiB"):
+        if nbytes < 1024 or nbytes % 1024:
+            break
+        nbytes //= 1024
+    return "{} {}".format(nbytes, unit)
+
+def format_histogram(samples, unit="ms", width=40):
+    """Render SAMPLES as a log2-bucketed text histogram, one line per
+       bucket, suitable for inclusion in a report."""
+    if not samples:
+        return ["(no samples)"]
+    buckets = collections.OrderedDict()
+    for s in sorted(samples):
+        bound = log2_bucket(s)
+        buckets[bound] = buckets.get(bound, 0) + 1
+    peak = max(buckets.values())
+    lines = []
+    for bound, count in buckets.items():
+        bar = "#" * max(1, int(round(float(count) / peak * width)))
+        lines.append("<= {:>9.3f} {}: {:>7} {}".format(bound, unit,
+                                                      count, bar))
+    return lines
+
+def find_free_port():
+    """Ask the OS for an unused TCP port on localhost.  There is an
+       unavoidable race between this and the eventual bind, but it is
+       only used for processes (like PhantomJS's webserver module) that
+       cannot report back a port chosen with bind(0)."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def read_proc_status(pid, field):
+    """Return a memory field (e.g. VmRSS, VmHWM) of process PID, in
+       bytes, from /proc/PID/status.  Returns None where that is
+       unavailable (not Linux, or the process has already exited)."""
+    try:
+        with open("/proc/{}/status".format(pid), "rt") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def read_proc_cpu_time(pid):
+    """Return the user plus system CPU time, in seconds, consumed so
+       far by process PID, from /proc/PID/stat.  Returns None where
+       that is unavailable."""
+    try:
+        with open("/proc/{}/stat".format(pid), "rt") as f:
+            # The command name is parenthesized and may contain spaces.
+            fields = f.read().rpartition(")")[2].split()
+        return ((int(fields[11]) + int(fields[12])) /
+                float(os.sysconf("SC_CLK_TCK")))
+    except (IOError, IndexError, ValueError, OSError):
+        return None
+
+# os.sendfile was only added in Python 3.3; on Linux we can call the
+# system call through ctypes instead.
+def find_sendfile():
+    """Return a function sendfile(out_fd, in_fd, offset, count) that
+       wraps sendfile(2) and returns the number of bytes sent, or None
+       if it is unavailable."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        func = getattr(libc, "sendfile64", None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        n = func(out_fd, in_fd, ctypes.byref(off), count)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+    return sendfile
+
+SENDFILE = find_sendfile()
+
+def find_inotify():
+    """Return a pair of functions (init, add_watch) that wrap
+       inotify_init1(2), with the descriptor nonblocking and
+       close-on-exec, and inotify_add_watch(2), or None if they are
+       unavailable."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        init1 = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    init1.argtypes = [ctypes.c_int]
+    init1.restype = ctypes.c_int
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    add_watch.restype = ctypes.c_int
+
+    def check(n):
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+
+    def init():
+        # IN_CLOEXEC is O_CLOEXEC, which this os module does not have.
+        return check(init1(os.O_NONBLOCK | 0o2000000))
+
+    def watch(fd, path, mask):
+        return check(add_watch(fd, path, mask))
+    return init, watch
+
+class Tracer(object):
+    """Records where the runner's own time goes, as Chrome trace
+       events, for --trace.  Spans are 'complete' events tagged with
+       the process and thread they ran on, so that concurrent activity
+       and gaps between steps show up in a trace viewer.  Server worker
+       processes record into their own copy, inherited across fork(),
+       whose events come back with their request statistics (see
+       ServerWorkerPool).  Until enabled, nothing is recorded.
+
+       There is one tracer, TRACER, which is global for the same reason
+       the colorization mode is: it is used at every level.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events  = []
+        self.seen    = set()
+        self.lock    = threading.Lock()
+        self.t0      = time.time()
+
+    def enable(self):
+        self.enabled = True
+        self.t0 = time.time()
+
+    def us(self, t):
+        return int(round((t - self.t0) * 1e6))
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        pid, tid = os.getpid(), thread.ident
+        event["pid"], event["tid"] = pid, tid
+        with self.lock:
+            if (pid, tid) not in self.seen:
+                self.seen.add((pid, tid))
+                self.events.append({"ph": "M", "name": "thread_name",
+                                    "pid": pid, "tid": tid,
+                                    "args": {"name": thread.name}})
+            self.events.append(event)
+
+    def complete(self, name, cat, start, end=None, args=None):
+        """Record a span from START to END (default: now), times being
+           as returned by time.time()."""
+        if not self.enabled:
+            return
+        if end is None:
+            end = time.time()
+        self._add({"ph": "X", "name": name, "cat": cat,
+                   "ts": self.us(start), "dur": self.us(end) - self.us(start),
+                   "args": args or {}})
+
+    def span(self, name, cat="runner", args=None):
+        """Context manager recording a span around its body."""
+        return TraceSpan(self, name, cat, args)
+
+    def drain(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def merge(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def write(self, path):
+        events = self.drain()
+        me = os.getpid()
+        for pid in sorted(set(e["pid"] for e in events) | set([me])):
+            events.append({"ph": "M", "name": "process_name", "pid": pid,
+                           "args": {"name": "run-tests.py" if pid == me
+                                    else "HTTP server worker"}})
+        with open(path, "wt") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            f.write("\n")
+
+class TraceSpan(object):
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name   = name
+        self.cat    = cat
+        self.args   = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *dontcare):
+        self.tracer.complete(self.name, self.cat, self.start, None, self.args)
+
+TRACER = Tracer()
+
 # create_default_context and SSLContext were only added in 2.7.9,
 # which is newer than the python2 that ships with OSX :-(
 # The fallback tries to mimic what create_default_context(CLIENT_AUTH)
@@ -134,13 +408,62 @@ class ResponseHookImporter(object):
             imp.load_source('test_www', www_path + '/__init__.py')
 
         self.tr = string.maketrans('-./%', '____')
+        self.lock = threading.Lock()
+        self.www_path = www_path
+        self.code = {}
+
+    # Compiled code is cached along with the modification time of its
+    # source, so that a hook edited while the servers are up (as with
+    # --watch) is recompiled, and its modules re-created, on next use.
+    def compile(self, path):
+        mtime = os.stat(path).st_mtime
+        cached = self.code.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rU') as f:
+                cached = self.code[path] = (mtime,
+                                            compile(f.read(), path, 'exec'))
+        return cached
+
+    def preload(self):
+        """Compile every hook below www_path now, so that processes
+           forked afterward share the compiled code."""
+        for dirpath, dirnames, filenames in os.walk(self.www_path):
+            for fn in filenames:
+                if fn.endswith('.py') and fn != '__init__.py':
+                    self.compile(os.path.join(dirpath, fn))
+
+    # Each server namespace (see HTTPTestServer.namespace) gets its own
+    # copy of every hook module, so module-level state in a hook cannot
+    # leak from one test to another.
+    def modname(self, path, namespace):
+        if namespace is None:
+            return 'test_www.' + path.translate(self.tr)
+        return 'test_www.ns_{}__{}'.format(namespace.translate(self.tr),
+                                           path.translate(self.tr))
+
+    def __call__(self, path, namespace=None):
+        modname = self.modname(path, namespace)
+        with self.lock:
+            mtime, code = self.compile(path)
+            mod = sys.modules.get(modname)
+            if mod is not None and mod.__hook_mtime__ == mtime:
+                return mod
+            mod = imp.new_module(modname)
+            mod.__file__ = path
+            mod.__hook_mtime__ = mtime
+            sys.modules[modname] = mod
+            try:
+                exec code in mod.__dict__
+            except:
+                del sys.modules[modname]
+                raise
+            return mod
 
-    def __call__(self, path):
-        modname = 'test_www.' + path.translate(self.tr)
-        try:
-            return sys.modules[modname]
-        except KeyError:
-            return imp.load_source(modname, path)
+    def release(self, namespace):
+        prefix = self.modname('', namespace)
+        with self.lock:
+            for modname in [m for m in sys.modules if m.startswith(prefix)]:
+                del sys.modules[modname]
 
 # This should also be in the standard library somewhere, and
 # definitely isn't.
@@ -155,21 +478,75 @@ try:
 except:
     devnull = os.open(os.devnull, os.O_RDONLY)
 
-def do_call_subprocess(command, verbose, stdin_data, timeout):
-
-    def read_thread(linebuf, fp):
+def file_blocks(path, size=65536):
+    """Yield the contents of the file at PATH, SIZE bytes at a time."""
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(size), ""):
+            yield block
+
+def numbered_lines(count, text="", batch=1024):
+    """Yield COUNT lines of input, 'N TEXT' for N from 1, BATCH lines
+       at a time."""
+    suffix = " " + text + "\n" if text else "\n"
+    for start in xrange(1, count + 1, batch):
+        yield "".join(str(n) + suffix
+                      for n in xrange(start, min(start + batch, count + 1)))
+
+def text_blocks(nbytes, line_length=80, size=65536):
+    """Yield NBYTES of text in lines of LINE_LENGTH characters
+       (including the newline), about SIZE bytes at a time."""
+    line = "x" * (line_length - 1) + "\n"
+    block = line * max(size // line_length, 1)
+    while nbytes > 0:
+        yield block[:nbytes]
+        nbytes -= len(block)
+
+def do_call_subprocess(command, verbose, stdin_data, timeout, env=None,
+                       watch=None):
+    """Run COMMAND and return (exit code, stdout lines, stderr lines).
+       STDIN_DATA is an iterable of strings to be written to its
+       standard input, which may be a generator of any length.
+       If WATCH is given, it is called as WATCH('stdout' or 'stderr',
+       line) for each line as it arrives, instead of the lines being
+       collected; if it returns False, the process is terminated."""
+
+    def read_thread(linebuf, fp, what):
         while True:
             line = fp.readline().rstrip()
             if not line: break # EOF
             line = line.rstrip()
             if line:
-                linebuf.append(line)
+                with first_lock:
+                    if not first_output:
+                        first_output.append(time.time())
+                        TRACER.complete("first output", "process", t_spawn,
+                                        first_output[0], {"stream": what})
+                if watch is None:
+                    linebuf.append(line)
+                elif not watch(what, line):
+                    kill()
                 if verbose >= 3:
                     sys.stdout.write(line + '\n')
 
+    def kill():
+        try:
+            if proc.returncode is None:
+                proc.terminate()
+        except OSError:
+            pass
+
     def write_thread(data, fp):
-        fp.writelines(data)
-        fp.close()
+        try:
+            fp.writelines(data)
+        except IOError as e:
+            # The process need not read all of its input.
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            try:
+                fp.close()
+            except IOError:
+                pass
 
     def reap_thread(proc, timed_out):
         if proc.returncode is None:
@@ -185,10 +562,15 @@ def do_call_subprocess(command, verbose, stdin_data, timeout):
     else:
         stdin = devnull
 
+    first_output = []
+    first_lock = threading.Lock()
+    t_spawn = time.time()
     proc = subprocess.Popen(command,
                             stdin=stdin,
                             stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
+                            stderr=subprocess.PIPE,
+                            env=env)
+    TRACER.complete("spawn", "process", t_spawn)
 
     if stdin_data:
         sithrd = threading.Thread(target=write_thread,
@@ -199,8 +581,10 @@ def do_call_subprocess(command, verbose, stdin_data, timeout):
     stdout = []
     stderr = []
     timed_out = [False]
-    sothrd = threading.Thread(target=read_thread, args=(stdout, proc.stdout))
-    sethrd = threading.Thread(target=read_thread, args=(stderr, proc.stderr))
+    sothrd = threading.Thread(target=read_thread,
+                              args=(stdout, proc.stdout, "stdout"))
+    sethrd = threading.Thread(target=read_thread,
+                              args=(stderr, proc.stderr, "stderr"))
     rpthrd = threading.Timer(timeout, reap_thread, args=(proc, timed_out))
 
     sithrd.start()
@@ -210,6 +594,8 @@ def do_call_subprocess(command, verbose, stdin_data, timeout):
 
     proc.wait()
     if not timed_out[0]: rpthrd.cancel()
+    TRACER.complete(os.path.basename(command[0]), "process", t_spawn, None,
+                    {"pid": proc.pid, "exit": proc.returncode})
 
     sithrd.join()
     sothrd.join()
@@ -217,10 +603,14 @@ def do_call_subprocess(command, verbose, stdin_data, timeout):
     rpthrd.join()
 
     if timed_out[0]:
-        stderr.append("TIMEOUT: Process terminated after {} seconds."
-                      .format(timeout))
+        message = ("TIMEOUT: Process terminated after {} seconds."
+                   .format(timeout))
+        if watch is None:
+            stderr.append(message)
+        else:
+            watch("stderr", message)
         if verbose >= 3:
-            sys.stdout.write(stderr[-1] + "\n")
+            sys.stdout.write(message + "\n")
 
     rc = proc.returncode
     if verbose >= 3:
@@ -230,18 +620,692 @@ def do_call_subprocess(command, verbose, stdin_data, timeout):
             sys.stdout.write("## exit {}\n".format(rc))
     return proc.returncode, stdout, stderr
 
+class BackgroundProcess(object):
+    """A process that is kept running while the runner does something
+       else, e.g. a PhantomJS webserver being driven by a benchmark.
+       stdout and stderr are merged and drained continuously by a
+       reader thread, so the child never blocks on a full pipe; the
+       lines are kept for diagnostics and can be waited for.
+    """
+    def __init__(self, command, verbose, env=None):
+        self.command = command
+        self.verbose = verbose
+        self.output  = []
+        self._lines  = Queue.Queue()
+        self.proc = subprocess.Popen(command,
+                                     stdin=devnull,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     env=env)
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def _read(self):
+        for line in iter(self.proc.stdout.readline, ''):
+            line = line.rstrip()
+            self.output.append(line)
+            self._lines.put(line)
+            if self.verbose >= 3:
+                sys.stdout.write("## [{}] {}\n".format(self.proc.pid, line))
+        self._lines.put(None)
+
+    def wait_for(self, pattern, timeout):
+        """Wait until the process prints a line matching the regular
+           expression PATTERN, and return the match object.  Raises
+           RuntimeError if the process exits or TIMEOUT expires first."""
+        pattern = re.compile(pattern)
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0: raise Queue.Empty
+                line = self._lines.get(timeout=remaining)
+            except Queue.Empty:
+                raise RuntimeError("timed out waiting for {!r} from {}"
+                                   .format(pattern.pattern, self.command[0]))
+            if line is None:
+                raise RuntimeError("{} exited before printing {!r}:\n{}"
+                                   .format(self.command[0], pattern.pattern,
+                                           "\n".join(self.output)))
+            m = pattern.search(line)
+            if m:
+                return m
+
+    def stop(self):
+        if self.proc.returncode is None:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass
+        self.proc.wait()
+        self._reader.join()
+        return self.proc.returncode
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        self.stop()
+
+def drive_http_load(host, port, path, concurrency, duration, keepalive):
+    """Issue GET requests for PATH against HOST:PORT from CONCURRENCY
+       threads for DURATION seconds.  With KEEPALIVE, each thread reuses
+       one persistent connection; otherwise it opens a new connection
+       per request.  Returns (latencies in ms, error count, elapsed).
+    """
+    latencies = []
+    errors    = [0]
+    lock      = threading.Lock()
+    stop_at   = [None]
+
+    def worker():
+        mine = []
+        failed = 0
+        conn = None
+        headers = {} if keepalive else {'Connection': 'close'}
+        while time.time() < stop_at[0]:
+            if conn is None:
+                conn = httplib.HTTPConnection(host, port, timeout=TIMEOUT)
+            t0 = time.time()
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    failed += 1
+                else:
+                    mine.append((time.time() - t0) * 1000)
+                if not keepalive or resp.will_close:
+                    conn.close()
+                    conn = None
+            except (socket.error, httplib.HTTPException):
+                failed += 1
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    stop_at[0] = start + duration
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return latencies, errors[0], time.time() - start
+
 #
 # HTTP/HTTPS server, presented on localhost to the tests
 #
 
+class RequestStats(object):
+    """Request accounting for the test servers, kept per test.  Each
+       test's record counts requests per URL path, bytes served,
+       connections accepted, TLS handshakes, and a log2 histogram of
+       request latency in milliseconds.
+
+       Handler threads update one of several independently locked
+       shards, assigned to each thread in turn, so they rarely contend
+       with each other; reading a record merges the shards.
+
+       A request is attributed to the test named by its X-Test-Id
+       header or __test query parameter, or failing that to the test
+       most recently passed to begin().  Connections are always
+       attributed to the current test, since they are accepted before
+       any request is read.
+
+       When the servers run in worker processes (see ServerWorkerPool),
+       each worker keeps its own RequestStats, and 'remote' is set to
+       the pool in the parent; begin() is then passed on to the
+       workers, and reading a record first merges in everything the
+       workers have counted since the last read.
+
+       The forward proxies (see ProxyServer) add a "proxy" object to
+       the records of the tests that use them, holding counts of
+       connections, requests, tunnels, upstream connections, failed
+       authentications and bytes for each kind of proxy.
+
+       If 'trace' is set, each record also has a "trace" list of
+       timestamped events, one per connection and one per request,
+       from which write_request_trace() draws a waterfall.  A
+       connection's event is only complete once it is closed, which
+       its handler thread may notice after the client has exited, so
+       when the runner collects a finished test with settle=True, it
+       first waits (for at most CLOSE_WAIT seconds, in every worker)
+       for the open connections to be closed.
+    """
+    N_SHARDS = 8
+    CLOSE_WAIT = 1.0
+
+    def __init__(self, trace=False):
+        self.current = None
+        self.remote  = None
+        self.trace   = trace
+        self._shards = [(threading.Lock(), {}) for _ in range(self.N_SHARDS)]
+        self._thread = threading.local()
+        self._next   = itertools.count()
+        self._open   = 0
+        self._closed = threading.Condition()
+
+    def begin(self, test_id):
+        self.current = test_id
+        if self.remote is not None:
+            self.remote.begin(test_id)
+
+    @staticmethod
+    def _empty():
+        return { "requests": {}, "bytes": 0, "connections": 0,
+                 "tls_handshakes": 0, "latency_ms": {} }
+
+    def _update(self, test_id, func):
+        if test_id is None:
+            test_id = self.current
+        # Not the thread ident modulo N_SHARDS: idents are addresses,
+        # aligned so that they would all map to the same shard.
+        try:
+            lock, records = self._thread.shard
+        except AttributeError:
+            lock, records = self._thread.shard = \
+                self._shards[next(self._next) % self.N_SHARDS]
+        with lock:
+            rec = records.get(test_id)
+            if rec is None:
+                rec = records[test_id] = self._empty()
+            func(rec)
+
+    def count_connection(self, tls):
+        def f(rec):
+            rec["connections"] += 1
+            if tls:
+                rec["tls_handshakes"] += 1
+        self._update(None, f)
+
+    def count_request(self, test_id, path, nbytes, ms):
+        def f(rec):
+            rec["requests"][path] = rec["requests"].get(path, 0) + 1
+            rec["bytes"] += nbytes
+            bucket = log2_bucket(ms)
+            rec["latency_ms"][bucket] = rec["latency_ms"].get(bucket, 0) + 1
+        self._update(test_id, f)
+
+    def count_proxy(self, test_id, kind, what, n=1):
+        def f(rec):
+            counts = rec.setdefault("proxy", {}).setdefault(kind, {})
+            counts[what] = counts.get(what, 0) + n
+        self._update(test_id, f)
+
+    def trace_event(self, test_id, event):
+        def f(rec):
+            rec.setdefault("trace", []).append(event)
+        self._update(test_id, f)
+
+    def connection_opened(self):
+        with self._closed:
+            self._open += 1
+        self._thread.connection = True
+
+    def connection_closed(self, test_id, event):
+        self.trace_event(test_id, event)
+        self._thread.connection = False
+        with self._closed:
+            self._open -= 1
+            self._closed.notify_all()
+
+    def _settle(self):
+        # A handler thread's own connection will not close while it
+        # waits.
+        mine = 1 if getattr(self._thread, "connection", False) else 0
+        deadline = time.time() + self.CLOSE_WAIT
+        with self._closed:
+            while self._open > mine:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._closed.wait(remaining)
+
+    @staticmethod
+    def _add(total, rec):
+        for k in ("bytes", "connections", "tls_handshakes"):
+            total[k] += rec[k]
+        for k in ("requests", "latency_ms"):
+            for key, n in rec[k].items():
+                total[k][key] = total[k].get(key, 0) + n
+        for kind, counts in rec.get("proxy", {}).items():
+            kind_total = total.setdefault("proxy", {}).setdefault(kind, {})
+            for what, n in counts.items():
+                kind_total[what] = kind_total.get(what, 0) + n
+        if "trace" in rec:
+            total.setdefault("trace", []).extend(rec["trace"])
+
+    def _pull(self, settle=False):
+        if self.remote is not None:
+            self.merge(self.remote.drain(settle))
+        elif settle:
+            self._settle()
+
+    def _merged(self, test_ids=None):
+        """Merge the shards' records for TEST_IDS, or for all tests."""
+        totals = {}
+        for lock, records in self._shards:
+            with lock:
+                for test_id in (records if test_ids is None else test_ids):
+                    rec = records.get(test_id)
+                    if rec is not None:
+                        total = totals.get(test_id)
+                        if total is None:
+                            total = totals[test_id] = self._empty()
+                        self._add(total, rec)
+        return totals
+
+    def collect(self, test_id, settle=False):
+        """Return the merged record for TEST_ID.  With SETTLE, wait for
+           open connections to be closed first."""
+        self._pull(settle)
+        return self._merged([test_id]).get(test_id) or self._empty()
+
+    def drain(self, settle=False):
+        """Remove and return all records, as (test_id, record) pairs
+           that can be passed through JSON.  With SETTLE, wait for open
+           connections to be closed first."""
+        if settle:
+            self._settle()
+        pairs = []
+        for lock, records in self._shards:
+            with lock:
+                pairs.extend(records.items())
+                records.clear()
+        return pairs
+
+    def merge(self, pairs):
+        """Add records returned by another instance's drain()."""
+        lock, records = self._shards[0]
+        with lock:
+            for test_id, rec in pairs:
+                # JSON turned the latency buckets into strings.
+                rec["latency_ms"] = dict((float(b), n) for b, n
+                                         in rec["latency_ms"].items())
+                total = records.get(test_id)
+                if total is None:
+                    total = records[test_id] = self._empty()
+                self._add(total, rec)
+
+    def collect_all(self):
+        self._pull()
+        return self._merged()
+
+    def discard(self, test_id):
+        for lock, records in self._shards:
+            with lock:
+                records.pop(test_id, None)
+
+def format_request_stats(stats):
+    text = ("server: {} requests for {} paths, {} bytes, {} connections,"
+            " {} TLS handshakes".format(sum(stats["requests"].values()),
+                                        len(stats["requests"]),
+                                        stats["bytes"], stats["connections"],
+                                        stats["tls_handshakes"]))
+    for kind, counts in sorted(stats.get("proxy", {}).items()):
+        text += "; {} proxy: {}".format(kind, ", ".join(
+            "{} {}".format(n, what.replace("_", " "))
+            for what, n in sorted(counts.items())))
+    return text
+
+def iso_time(t):
+    return (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) +
+            ".{:03d}Z".format(int(t * 1000) % 1000))
+
+def chrome_trace(traces):
+    """Convert TRACES, a list of (test name, trace events) pairs, to the
+       Chrome trace event format, as read by chrome://tracing and
+       Perfetto.  Each test is a process, and each connection a thread
+       within it, spanning the requests made over it; a counter tracks
+       how many requests were in flight at once."""
+    starts = [ev.get("open", ev.get("start")) for _, trace in traces
+              for ev in trace]
+    t0 = min(starts) if starts else 0
+
+    def us(t):
+        return int(round((t - t0) * 1e6))
+
+    events = []
+    for pid, (name, trace) in enumerate(traces, 1):
+        events.append({"ph": "M", "name": "process_name", "pid": pid,
+                       "tid": 0, "args": {"name": name}})
+        tids = {}
+
+        def tid(ev):
+            if ev["conn"] not in tids:
+                tids[ev["conn"]] = len(tids) + 1
+                events.append({"ph": "M", "name": "thread_name",
+                               "pid": pid, "tid": tids[ev["conn"]],
+                               "args": {"name": "{} connection {}".format(
+                                   "HTTPS" if ev["tls"] else "HTTP",
+                                   len(tids))}})
+            return tids[ev["conn"]]
+
+        changes = []
+        for ev in sorted(trace, key=lambda e: e.get("open", e.get("start"))):
+            if ev["type"] == "connection":
+                events.append({"ph": "X", "cat": "connection",
+                               "name": "connection", "pid": pid,
+                               "tid": tid(ev), "ts": us(ev["open"]),
+                               "dur": us(ev["close"]) - us(ev["open"])})
+                continue
+            headers = ev.get("headers", ev["end"])
+            events.append({"ph": "X", "cat": "request",
+                           "name": ev["method"] + " " + ev["path"],
+                           "pid": pid, "tid": tid(ev),
+                           "ts": us(ev["start"]),
+                           "dur": us(ev["end"]) - us(ev["start"]),
+                           "args": {"url": ev["url"],
+                                    "status": ev.get("status"),
+                                    "bytes": ev["bytes"],
+                                    "wait_ms": (headers - ev["start"]) * 1000}})
+            scheme = "https" if ev["tls"] else "http"
+            changes.append((ev["start"], 1, scheme))
+            changes.append((ev["end"], -1, scheme))
+
+        in_flight = {"http": 0, "https": 0}
+        for t, delta, scheme in sorted(changes):
+            in_flight[scheme] += delta
+            events.append({"ph": "C", "name": "requests in flight",
+                           "pid": pid, "ts": us(t),
+                           "args": dict(in_flight)})
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def har_trace(traces):
+    """Convert TRACES, as for chrome_trace, to an HTTP Archive (HAR
+       1.2), with one page per test.  The timings are the server's
+       view: 'wait' runs from reading the request line to sending the
+       response headers, and 'receive' from there to the end of the
+       response body."""
+    pages = []
+    entries = []
+    for name, trace in traces:
+        requests = sorted((ev for ev in trace if ev["type"] == "request"),
+                          key=lambda e: e["start"])
+        if not requests:
+            continue
+        pages.append({"id": name, "title": name,
+                      "startedDateTime": iso_time(requests[0]["start"]),
+                      "pageTimings": {}})
+        for ev in requests:
+            headers = ev.get("headers", ev["end"])
+            wait = (headers - ev["start"]) * 1000
+            receive = (ev["end"] - headers) * 1000
+            entries.append({
+                "pageref": name,
+                "startedDateTime": iso_time(ev["start"]),
+                "time": wait + receive,
+                "request": {"method": ev["method"], "url": ev["url"],
+                            "httpVersion": ev["version"], "cookies": [],
+                            "headers": [], "queryString": [],
+                            "headersSize": -1, "bodySize": -1},
+                "response": {"status": ev.get("status", 0),
+                             "statusText": "", "httpVersion": ev["version"],
+                             "cookies": [], "headers": [],
+                             "content": {"size": ev["bytes"],
+                                         "mimeType": ""},
+                             "redirectURL": "", "headersSize": -1,
+                             "bodySize": ev["bytes"]},
+                "cache": {},
+                "timings": {"send": 0, "wait": wait, "receive": receive},
+                "serverIPAddress": "127.0.0.1",
+                "connection": ev["conn"],
+            })
+    return {"log": {"version": "1.2",
+                    "creator": {"name": "run-tests.py", "version": "1"},
+                    "pages": pages, "entries": entries}}
+
+def write_request_trace(path, traces):
+    """Write TRACES to PATH, as a HAR file if PATH ends in .har and
+       otherwise as a Chrome trace."""
+    if path.endswith(".har"):
+        data = har_trace(traces)
+    else:
+        data = chrome_trace(traces)
+    with open(path, "wt") as f:
+        json.dump(data, f)
+        f.write("\n")
+
+class CountingWriter(object):
+    """Wraps a file object, counting the bytes written through it."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+def www_file_path(www_path, path):
+    """Resolve the URL path PATH (with no query string, fragment or
+       namespace prefix) to a file below WWW_PATH."""
+    # Ensure consistent encoding of special characters, then
+    # lowercase everything so that the tests behave consistently
+    # whether or not the local filesystem is case-sensitive.
+    path = urllib.quote(urllib.unquote(path)).lower()
+
+    # Prevent access to files outside www/.
+    # At this point we want specifically POSIX-like treatment of 'path'
+    # because it is still a URL component and not a filesystem path.
+    # SimpleHTTPRequestHandler.send_head() expects us to preserve the
+    # distinction between paths with and without a trailing slash, but
+    # posixpath.normpath() discards that distinction.
+    trailing_slash = path.endswith('/')
+    path = posixpath.normpath(path)
+    while path.startswith('/'):
+        path = path[1:]
+    while path.startswith('../'):
+        path = path[3:]
+
+    # Now resolve the normalized, clamped path relative to the www/
+    # directory, according to local OS conventions.
+    path = os.path.normpath(os.path.join(www_path, *path.split('/')))
+    if trailing_slash:
+        # it must be a '/' even on Windows
+        path += '/'
+    return path
+
+def www_dependency(www_path, url_path):
+    """The file below WWW_PATH that serves URL_PATH.  As in
+       FileHandler.send_head, that is either the file itself, or a
+       response hook with the same name plus '.py'; a directory is
+       served by its index page, if any."""
+    path = www_file_path(www_path, url_path)
+    if os.path.isdir(path):
+        for index in ("index.html", "index.htm"):
+            if os.path.isfile(os.path.join(path, index)):
+                return os.path.join(path, index)
+    elif not os.path.exists(path) and os.path.isfile(path + '.py'):
+        path += '.py'
+    return path
+
 class FileHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, object):
 
+    namespace_r = re.compile(r'^/__ns/([A-Za-z0-9_-]+)(/.*)?$')
+    conn_ids = itertools.count(1)
+
     def __init__(self, *args, **kwargs):
         self._cached_untranslated_path = None
         self._cached_translated_path = None
         self.postdata = None
+        self._stats_key = None
+        self._trace = None
+        self.namespace = None
+        self.local_path = None
         super(FileHandler, self).__init__(*args, **kwargs)
 
+    def setup(self):
+        super(FileHandler, self).setup()
+        self.wfile = CountingWriter(self.wfile)
+        if self.stats.trace:
+            # Connections belong to the current test, as in
+            # RequestStats.count_connection.  Worker processes each
+            # number their own connections.
+            self.conn_id = "{}.{}".format(os.getpid(), next(self.conn_ids))
+            self.conn_open = (self.stats.current, time.time())
+            self.stats.connection_opened()
+
+    def finish(self):
+        try:
+            super(FileHandler, self).finish()
+        finally:
+            if self.stats.trace:
+                test_id, t0 = self.conn_open
+                self.stats.connection_closed(test_id, {
+                    "type": "connection", "conn": self.conn_id,
+                    "tls": self.server.is_ssl, "open": t0,
+                    "close": time.time(),
+                })
+
+    # Account every request to RequestStats.  parse_request runs as
+    # soon as the request line has been read, so idle time on a
+    # keep-alive connection is not counted as latency.
+    def parse_request(self):
+        self._stats_key = None
+        self._trace = None
+        self.namespace = None
+        if not super(FileHandler, self).parse_request():
+            return False
+
+        test_id = self.headers.get('X-Test-Id')
+        path, _, query = self.path.partition('?')
+        if query:
+            params = query.split('&')
+            kept = [p for p in params if not p.startswith('__test=')]
+            if len(kept) != len(params):
+                test_id = urllib.unquote(
+                    [p for p in params if p.startswith('__test=')][-1][7:])
+                self.path = path + ('?' + '&'.join(kept) if kept else '')
+
+        # URLs beginning /__ns/TOKEN/ belong to a server namespace.
+        # The prefix is kept in self.path, so that relative URLs and
+        # redirects stay inside the namespace, but is otherwise ignored.
+        m = self.namespace_r.match(path)
+        if m:
+            self.namespace = m.group(1)
+            path = m.group(2) or '/'
+            if test_id is None:
+                test_id = self.namespaces.get(self.namespace, self.namespace)
+        self.local_path = path
+
+        if path != '/__stats':
+            now = time.time()
+            self._stats_key = (test_id, path, now, self.wfile.count)
+            if self.stats.trace:
+                self._trace = {
+                    "type": "request", "conn": self.conn_id,
+                    "tls": self.server.is_ssl, "method": self.command,
+                    "version": self.request_version, "path": path,
+                    "start": now,
+                    "url": "{}://localhost:{}{}".format(
+                        "https" if self.server.is_ssl else "http",
+                        self.server.server_address[1], self.path),
+                }
+        return True
+
+    def handle_one_request(self):
+        super(FileHandler, self).handle_one_request()
+        if self._stats_key is not None:
+            test_id, path, t0, nbytes = self._stats_key
+            self._stats_key = None
+            now = time.time()
+            self.stats.count_request(test_id, path,
+                                     self.wfile.count - nbytes,
+                                     (now - t0) * 1000)
+            TRACER.complete(path, "server", t0, now,
+                            {"test": test_id, "tls": self.server.is_ssl})
+            if self._trace is not None:
+                self._trace["end"] = now
+                self._trace["bytes"] = self.wfile.count - nbytes
+                self.stats.trace_event(test_id, self._trace)
+                self._trace = None
+
+    def send_response(self, code, message=None):
+        if self._trace is not None:
+            self._trace["status"] = code
+        super(FileHandler, self).send_response(code, message)
+
+    def end_headers(self):
+        super(FileHandler, self).end_headers()
+        if self._trace is not None and "headers" not in self._trace:
+            self._trace["headers"] = time.time()
+
+    def send_stats(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        if 'test' in query:
+            stats = self.stats.collect(query['test'][0])
+        elif self.namespace is not None:
+            stats = self.stats.collect(self.namespaces.get(self.namespace,
+                                                           self.namespace))
+        else:
+            stats = self.stats.collect_all()
+        body = json.dumps(stats, indent=2, sort_keys=True) + '\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        return StringIO.StringIO(body)
+
+    # Static files served over plain HTTP bypass Python's file and
+    # socket buffering: they are handed to the kernel with sendfile()
+    # where possible, and otherwise written straight from an mmap.
+    # Everything else, including all HTTPS responses, takes the
+    # ordinary path.  (Kernel TLS would allow the same for HTTPS, but
+    # the Python 2 ssl module has no way to set it up.)
+    def copyfile(self, source, outputfile):
+        if (self.server.is_ssl or outputfile is not self.wfile or
+            not isinstance(source, file)):
+            return super(FileHandler, self).copyfile(source, outputfile)
+
+        self.wfile.flush()
+        fd = source.fileno()
+        offset = source.tell()
+        size = os.fstat(fd).st_size
+        sent = 0
+        if SENDFILE is not None:
+            sent = self.sendfile(fd, offset, size)
+        if offset + sent < size:
+            m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            try:
+                self.connection.sendall(buffer(m, offset + sent))
+            finally:
+                m.close()
+            sent = size - offset
+        self.wfile.count += sent
+
+    def sendfile(self, fd, offset, size):
+        out_fd = self.connection.fileno()
+        pos = offset
+        while pos < size:
+            try:
+                n = SENDFILE(out_fd, fd, pos, size - pos)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                # Not supported for this file or socket; let the
+                # caller fall back.
+                if pos == offset and e.errno in (errno.EINVAL,
+                                                 errno.ENOSYS):
+                    break
+                raise
+            if n == 0:
+                break
+            pos += n
+        return pos - offset
+
     def log_message(self, format, *args):
         if self.verbose >= 3:
             sys.stdout.write("## " +
@@ -270,6 +1334,9 @@ class FileHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, object):
     # allow provision of a .py file that will be interpreted to
     # produce the response.
     def send_head(self):
+        if self.local_path == '/__stats':
+            return self.send_stats()
+
         path = self.translate_path(self.path)
 
         if self.verbose >= 3:
@@ -293,7 +1360,7 @@ class FileHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, object):
         py = path + '.py'
         if os.path.exists(py):
             try:
-                mod = self.get_response_hook(py)
+                mod = self.get_response_hook(py, self.namespace)
                 return mod.handle_request(self)
             except:
                 self.send_error(500, 'Internal Server Error in '+py)
@@ -321,36 +1388,22 @@ class FileHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, object):
         if x != -1: path = path[:x]
         x = path.find('#')
         if x != -1: path = path[:x]
-
-        # Ensure consistent encoding of special characters, then
-        # lowercase everything so that the tests behave consistently
-        # whether or not the local filesystem is case-sensitive.
-        path = urllib.quote(urllib.unquote(path)).lower()
-
-        # Prevent access to files outside www/.
-        # At this point we want specifically POSIX-like treatment of 'path'
-        # because it is still a URL component and not a filesystem path.
-        # SimpleHTTPRequestHandler.send_head() expects us to preserve the
-        # distinction between paths with and without a trailing slash, but
-        # posixpath.normpath() discards that distinction.
-        trailing_slash = path.endswith('/')
-        path = posixpath.normpath(path)
-        while path.startswith('/'):
-            path = path[1:]
-        while path.startswith('../'):
-            path = path[3:]
-
-        # Now resolve the normalized, clamped path relative to the www/
-        # directory, according to local OS conventions.
-        path = os.path.normpath(os.path.join(self.www_path, *path.split('/')))
-        if trailing_slash:
-            # it must be a '/' even on Windows
-            path += '/'
+        m = self.namespace_r.match(path)
+        if m: path = m.group(2) or '/'
+        path = www_file_path(self.www_path, path)
 
         self._cached_untranslated_path = orig_path
         self._cached_translated_path = path
         return path
 
+def format_server_error(exc_info):
+    """Reduce EXC_INFO to (traceback lines, message), the form in which
+       errors in the test servers are passed to the runner.  Unlike a
+       traceback object, this can be sent between processes."""
+    ty, val, tb = exc_info
+    return (traceback.format_tb(tb, 5),
+            traceback.format_exception_only(ty, val)[-1])
+
 class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     # This is how you are officially supposed to set SO_REUSEADDR per
     # https://docs.python.org/2/library/socketserver.html#SocketServer.BaseServer.allow_reuse_address
@@ -363,6 +1416,13 @@ class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self._signal_error = signal_error
         self.is_ssl = use_ssl
 
+    def process_request(self, request, client_address):
+        # For the HTTPS server, the handshake has already completed
+        # by the time accept() returns.
+        self.RequestHandlerClass.stats.count_connection(self.is_ssl)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
     def handle_error(self, request, client_address):
         # Ignore errors which can occur naturally if the client
         # disconnects in the middle of a request.  EPIPE and
@@ -373,16 +1433,502 @@ class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
             return
 
         # Otherwise, report the error to the test runner.
-        self._signal_error(sys.exc_info())
+        self._signal_error(format_server_error(sys.exc_info()))
+
+def relay_sockets(a, b, timeout=TIMEOUT):
+    """Copy data in both directions between the sockets A and B until
+       either of them is closed, or neither has anything to send for
+       TIMEOUT seconds.  Return the number of bytes copied."""
+    total = 0
+    while True:
+        readable, _, _ = select.select([a, b], [], [], timeout)
+        if not readable:
+            return total
+        for src in readable:
+            data = src.recv(65536)
+            if not data:
+                return total
+            (b if src is a else a).sendall(data)
+            total += len(data)
+
+# Headers that apply to a single connection, and so are not passed on
+# by the forward proxy.
+HOP_BY_HOP_HEADERS = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade",
+))
+
+class HTTPProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler, object):
+    """An HTTP forward proxy.  Requests for absolute http: URLs are
+       passed on over upstream connections that are kept alive, one
+       per client connection and origin, so that the upstream
+       connection count shows how well the client reuses its
+       connection to the proxy.  CONNECT requests open a tunnel, as
+       used for https: URLs."""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super(HTTPProxyHandler, self).setup()
+        self.upstream = {}
+
+    def finish(self):
+        for conn in self.upstream.values():
+            conn.close()
+        super(HTTPProxyHandler, self).finish()
+
+    def log_message(self, format, *args):
+        if self.server.verbose >= 3:
+            sys.stdout.write("## {} proxy: {}\n".format(self.server.kind,
+                                                        format % args))
+            sys.stdout.flush()
+
+    def check_auth(self):
+        """Return True if the request carries the proxy's credentials;
+           otherwise send a 407 challenge and return False."""
+        expected = self.server.auth_header
+        if (expected is None or
+            self.headers.get("Proxy-Authorization") == expected):
+            return True
+        self.server.count(None, "auth_failures")
+        body = "Proxy authentication required\n"
+        self.send_response(407)
+        self.send_header("Proxy-Authenticate", 'Basic realm="run-tests"')
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return False
+
+    def do_CONNECT(self):
+        if not self.check_auth():
+            return
+        host, _, port = self.path.rpartition(":")
+        host = host.strip("[]")
+        if not self.server.allowed(host):
+            self.send_error(403, "Proxy connects only to localhost")
+            return
+        try:
+            upstream = self.server.connect(host, port)
+        except (socket.error, ValueError):
+            self.send_error(502, "Cannot connect to " + self.path)
+            return
+        self.server.count(None, "tunnels")
+        # Clients do not send anything through the tunnel before they
+        # have seen this response, so nothing is left behind in rfile.
+        try:
+            self.send_response(200, "Connection established")
+            self.end_headers()
+            self.wfile.flush()
+            self.server.count(None, "bytes",
+                              relay_sockets(self.connection, upstream))
+        finally:
+            upstream.close()
+        self.close_connection = 1
+
+    def forward(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return
+        body = self.rfile.read(length) if length else None
+        if not self.check_auth():
+            return
+
+        url = urlparse.urlsplit(self.path)
+        if url.scheme != "http" or not url.hostname:
+            self.send_error(400, "Not a proxy request")
+            return
+        if not self.server.allowed(url.hostname):
+            self.send_error(403, "Proxy connects only to localhost")
+            return
+
+        # Attribute the request as the test server will.
+        test_id = self.headers.get("X-Test-Id")
+        m = FileHandler.namespace_r.match(url.path)
+        if test_id is None and m:
+            test_id = self.server.namespaces.get(m.group(1), m.group(1))
+        self.server.count(test_id, "requests")
+
+        headers = dict((name, value) for name, value in self.headers.items()
+                       if name not in HOP_BY_HOP_HEADERS)
+        headers["Via"] = "1.1 run-tests"
+        path = (url.path or "/") + ("?" + url.query if url.query else "")
+        key = (url.hostname, url.port or 80)
+        while True:
+            conn = self.upstream.get(key)
+            reused = conn is not None
+            if not reused:
+                conn = self.upstream[key] = httplib.HTTPConnection(
+                    key[0], key[1], timeout=TIMEOUT)
+                self.server.count(test_id, "upstream_connections")
+            try:
+                conn.request(self.command, path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                del self.upstream[key]
+                # The server may have closed a kept-alive connection
+                # while it was idle; retry once on a fresh one.
+                if not reused:
+                    self.send_error(502, "Upstream request failed")
+                    return
+        if resp.will_close:
+            conn.close()
+            del self.upstream[key]
+
+        # The body has been read in full, so it is always passed on
+        # with a Content-Length, whatever framing the origin used.
+        has_body = not (self.command == "HEAD" or resp.status < 200 or
+                        resp.status in (204, 304))
+        self.log_request(resp.status)
+        lines = ["HTTP/1.1 {} {}\r\n".format(resp.status, resp.reason)]
+        keep = False
+        for line in resp.msg.headers:
+            if line[:1] not in (" ", "\t"):
+                name = line.split(":", 1)[0].strip().lower()
+                keep = name not in HOP_BY_HOP_HEADERS and not (
+                    has_body and name == "content-length")
+            if keep:
+                lines.append(line)
+        if has_body:
+            lines.append("Content-Length: {}\r\n".format(len(data)))
+        if self.close_connection:
+            lines.append("Connection: close\r\n")
+        lines.append("\r\n")
+        # One write, so that Nagle's algorithm does not hold back the
+        # body until the client acknowledges the headers.
+        if has_body:
+            lines.append(data)
+            self.server.count(test_id, "bytes", len(data))
+        self.wfile.write("".join(lines))
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_OPTIONS = forward
+
+class SOCKSProxyHandler(SocketServer.StreamRequestHandler, object):
+    """A SOCKS5 proxy (RFC 1928), supporting the CONNECT command only,
+       with username/password authentication (RFC 1929) when the proxy
+       has credentials."""
+    # Unbuffered, so that nothing the client sends after the handshake
+    # is read ahead of relay_sockets.
+    rbufsize = 0
+
+    def read(self, n):
+        data = self.rfile.read(n)
+        if len(data) != n:
+            raise EOFError
+        return data
+
+    def reply(self, code):
+        self.wfile.write(struct.pack(">BBBB4sH", 5, code, 0, 1, "\0" * 4, 0))
+
+    def handshake(self):
+        """Authenticate the client and read its request.  Return the
+           (host, port) to connect to, or None after replying with an
+           error."""
+        version, nmethods = struct.unpack("BB", self.read(2))
+        if version != 5:
+            return None
+        methods = self.read(nmethods)
+        credentials = self.server.credentials
+        method = "\x02" if credentials else "\x00"
+        if method not in methods:
+            if credentials:
+                self.server.count(None, "auth_failures")
+            self.wfile.write("\x05\xff")
+            return None
+        self.wfile.write("\x05" + method)
+        if credentials:
+            self.read(1)
+            user = self.read(ord(self.read(1)))
+            password = self.read(ord(self.read(1)))
+            if user + ":" + password != credentials:
+                self.server.count(None, "auth_failures")
+                self.wfile.write("\x01\x01")
+                return None
+            self.wfile.write("\x01\x00")
+
+        _, command, _, atyp = struct.unpack("BBBB", self.read(4))
+        if atyp == 1:
+            host = socket.inet_ntoa(self.read(4))
+        elif atyp == 3:
+            host = self.read(ord(self.read(1)))
+        elif atyp == 4:
+            host = socket.inet_ntop(socket.AF_INET6, self.read(16))
+        else:
+            self.reply(8)           # address type not supported
+            return None
+        port, = struct.unpack(">H", self.read(2))
+        if command != 1:
+            self.reply(7)           # command not supported
+            return None
+        if not self.server.allowed(host):
+            self.reply(2)           # not allowed by ruleset
+            return None
+        return host, port
+
+    def handle(self):
+        try:
+            target = self.handshake()
+        except EOFError:
+            return
+        if target is None:
+            return
+        try:
+            upstream = self.server.connect(*target)
+        except socket.error:
+            self.reply(5)           # connection refused
+            return
+        self.server.count(None, "tunnels")
+        try:
+            self.reply(0)
+            self.server.count(None, "bytes",
+                              relay_sockets(self.connection, upstream))
+        finally:
+            upstream.close()
+
+class ProxyServer(TCPServer):
+    """A forward proxy to the test servers, of kind 'http' (an HTTP
+       proxy, which also tunnels with CONNECT) or 'socks5'.  Its URL,
+       for PhantomJS's --proxy option, is in 'base'.  If CREDENTIALS
+       ('user:password') are given, clients must present them.
+
+       Connections, requests, tunnels, upstream connections, failed
+       authentications and bytes relayed are counted in STATS (see
+       RequestStats.count_proxy).  Only requests passed on in the
+       clear can be attributed by namespace; everything else belongs
+       to the current test.  The proxy connects only to localhost, so
+       that no test can reach the network through it by accident.
+
+       Proxies always run in the runner process, even when the test
+       servers have worker processes.
+    """
+    daemon_threads = True
+    HANDLERS = { "http": HTTPProxyHandler, "socks5": SOCKSProxyHandler }
+    LOCAL_HOSTS = frozenset(("localhost", "127.0.0.1", "::1"))
+
+    def __init__(self, kind, stats, namespaces, signal_error,
+                 credentials=None, verbose=0):
+        SocketServer.TCPServer.__init__(self, ('localhost', 0),
+                                        self.HANDLERS[kind])
+        self._signal_error = signal_error
+        self.is_ssl      = False
+        self.kind        = kind
+        self.stats       = stats
+        self.namespaces  = namespaces
+        self.credentials = credentials
+        self.auth_header = ("Basic " + base64.b64encode(credentials)
+                            if credentials else None)
+        self.verbose     = verbose
+        self.base = '{}://localhost:{}/'.format(kind, self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def process_request(self, request, client_address):
+        self.count(None, "connections")
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def count(self, test_id, what, n=1):
+        self.stats.count_proxy(test_id, self.kind, what, n)
+
+    def allowed(self, host):
+        return host.lower() in self.LOCAL_HOSTS
+
+    def connect(self, host, port):
+        sock = socket.create_connection((host, int(port)), TIMEOUT)
+        self.count(None, "upstream_connections")
+        return sock
+
+class ServerWorkerPool(object):
+    """Worker processes that serve the test servers' listening sockets,
+       so that static fixtures can be served from more than one core.
+       Python 2 cannot set SO_REUSEPORT portably, so the workers simply
+       inherit the sockets across fork() and the kernel hands each new
+       connection to whichever worker accepts it first.  Response hooks
+       are compiled before forking.
+
+       Each worker has a control channel to the parent, which carries
+       one JSON object per line in each direction.  The parent uses it
+       to announce the current test and the server namespaces, and to
+       collect each worker's request statistics and errors; every
+       message is acknowledged, so a namespace is known to all workers
+       by the time namespace() returns.
+
+       State kept by a hook module, and the /__stats URL, are per
+       worker; tests that depend on either have a no-server-workers
+       directive, and are skipped when there is more than one worker.
+    """
+    def __init__(self, server, nworkers):
+        self.server   = server
+        self.nworkers = nworkers
+        self.workers  = []
+        self.lock     = threading.Lock()
+
+    def start(self):
+        FileHandler.get_response_hook.preload()
+        for _ in range(self.nworkers):
+            ours, theirs = socket.socketpair()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    ours.close()
+                    for _, sock, rfile in self.workers:
+                        rfile.close()
+                        sock.close()
+                    self.worker_main(theirs)
+                except:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    sys.stdout.flush()
+                    os._exit(status)
+            theirs.close()
+            self.workers.append((pid, ours, ours.makefile('rb')))
+        self.server.stats.remote = self
+
+    def stop(self):
+        # Pick up anything counted or reported since the last drain,
+        # then close the control channels, which tells the workers to
+        # exit.
+        try:
+            self.server.stats.merge(self.drain(settle=True))
+        finally:
+            for _, sock, rfile in self.workers:
+                rfile.close()
+                sock.close()
+            for pid, _, _ in self.workers:
+                os.waitpid(pid, 0)
+            self.workers = []
+            self.server.stats.remote = None
+
+    def worker_main(self, ctl):
+        # The parent handles ^C; it will shut us down.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        errors = []
+        for srv in (self.server.httpd, self.server.httpsd):
+            srv._signal_error = errors.append
+            thread = threading.Thread(target=srv.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+        stats = self.server.stats
+        namespaces = self.server.namespaces
+        # (Iterating over the file directly would read ahead.)
+        for line in iter(ctl.makefile('rb').readline, ''):
+            msg = json.loads(line)
+            op = msg["op"]
+            token = str(msg.get("token"))
+            reply = {}
+            if op == "begin":
+                stats.begin(msg["test_id"])
+            elif op == "register":
+                namespaces[token] = msg["owner"]
+            elif op == "release":
+                FileHandler.get_response_hook.release(token)
+                namespaces.pop(token, None)
+            elif op == "drain":
+                errs = errors[:]
+                del errors[:len(errs)]
+                reply = { "stats": stats.drain(msg.get("settle", False)),
+                          "errors": errs,
+                          "trace": TRACER.drain() }
+            ctl.sendall(json.dumps(reply) + "\n")
+
+    def pids(self):
+        return [pid for pid, _, _ in self.workers]
+
+    def send(self, op, **args):
+        """Send OP to every worker and return their replies."""
+        line = json.dumps(dict(args, op=op)) + "\n"
+        with self.lock:
+            for _, sock, _ in self.workers:
+                sock.sendall(line)
+            replies = []
+            for pid, _, rfile in self.workers:
+                reply = rfile.readline()
+                if not reply:
+                    raise RuntimeError("HTTP server worker {} exited"
+                                       .format(pid))
+                replies.append(json.loads(reply))
+            return replies
+
+    def begin(self, test_id):
+        self.send("begin", test_id=test_id)
+
+    def drain(self, settle=False):
+        pairs = []
+        for reply in self.send("drain", settle=settle):
+            pairs.extend(reply["stats"])
+            TRACER.merge(reply["trace"])
+            for tb_lines, message in reply["errors"]:
+                self.server.signal_error((tb_lines, message))
+        return pairs
+
+class ServerNamespace(object):
+    """A private URL namespace on the test servers, for one test.
+       Requests under it are attributed to that test's statistics, and
+       it has its own copy of every response hook module.  Its base
+       URLs are published to the test through ENV, which should be
+       merged into the environment of the processes it runs; the
+       runner's own environment is left alone, so that any number of
+       tests may be in flight at once.
+    """
+    def __init__(self, server, owner, token):
+        self.server = server
+        self.owner  = owner
+        self.token  = token
+        self.env = {
+            'TEST_HTTP_BASE':  '{}__ns/{}/'.format(server.http_base, token),
+            'TEST_HTTPS_BASE': '{}__ns/{}/'.format(server.https_base, token),
+            'TEST_PROXY_BASE': server.proxies['http'].base,
+            'TEST_SOCKS_PROXY_BASE': server.proxies['socks5'].base,
+            'TEST_ID':         owner,
+        }
+
+    def environ(self):
+        env = dict(os.environ)
+        env.update(self.env)
+        return env
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        self.server.release_namespace(self.token)
 
 class HTTPTestServer(object):
-    def __init__(self, base_path, signal_error, verbose):
+    def __init__(self, base_path, signal_error, verbose, stats=None,
+                 workers=1):
         self.httpd        = None
         self.httpsd       = None
+        self.http_base    = None
+        self.https_base   = None
         self.base_path    = base_path
         self.www_path     = os.path.join(base_path, 'lib/www')
         self.signal_error = signal_error
         self.verbose      = verbose
+        self.stats        = stats if stats is not None else RequestStats()
+        self.namespaces   = {}
+        self.ns_counter   = 0
+        self.ns_lock      = threading.Lock()
+        self.workers      = workers
+        self.pool         = None
+        self.proxies      = {}
 
     def __enter__(self):
         handler = FileHandler
@@ -396,36 +1942,98 @@ class HTTPTestServer(object):
         handler.www_path = self.www_path
         handler.get_response_hook = ResponseHookImporter(self.www_path)
         handler.verbose = self.verbose
+        handler.stats = self.stats
+        handler.namespaces = self.namespaces
 
         self.httpd  = TCPServer(False, handler,
                                 self.base_path, self.signal_error)
-        os.environ['TEST_HTTP_BASE'] = \
+        self.http_base = \
             'http://localhost:{}/'.format(self.httpd.server_address[1])
-        httpd_thread = threading.Thread(target=self.httpd.serve_forever)
-        httpd_thread.daemon = True
-        httpd_thread.start()
         if self.verbose >= 3:
-            sys.stdout.write("## HTTP server at {}\n".format(
-                os.environ['TEST_HTTP_BASE']))
+            sys.stdout.write("## HTTP server at {}\n".format(self.http_base))
 
         self.httpsd = TCPServer(True, handler,
                                 self.base_path, self.signal_error)
-        os.environ['TEST_HTTPS_BASE'] = \
+        self.https_base = \
             'https://localhost:{}/'.format(self.httpsd.server_address[1])
-        httpsd_thread = threading.Thread(target=self.httpsd.serve_forever)
-        httpsd_thread.daemon = True
-        httpsd_thread.start()
         if self.verbose >= 3:
             sys.stdout.write("## HTTPS server at {}\n".format(
-                os.environ['TEST_HTTPS_BASE']))
+                self.https_base))
+
+        if self.workers > 1:
+            if self.verbose >= 3:
+                sys.stdout.write("## {} server worker processes\n"
+                                 .format(self.workers))
+            self.pool = ServerWorkerPool(self, self.workers)
+            self.pool.start()
+        else:
+            for srv in (self.httpd, self.httpsd):
+                thread = threading.Thread(target=srv.serve_forever)
+                thread.daemon = True
+                thread.start()
+
+        # The proxies are started after forking any workers, so that
+        # only the runner listens on them.
+        for kind in ("http", "socks5"):
+            self.proxies[kind] = self.proxy_server(kind).start()
+            if self.verbose >= 3:
+                sys.stdout.write("## {} proxy at {}\n".format(
+                    kind, self.proxies[kind].base))
 
         return self
 
     def __exit__(self, *dontcare):
-        self.httpd.shutdown()
-        del os.environ['TEST_HTTP_BASE']
-        self.httpsd.shutdown()
-        del os.environ['TEST_HTTPS_BASE']
+        for proxy in self.proxies.values():
+            proxy.stop()
+        self.proxies = {}
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+            self.httpd.server_close()
+            self.httpsd.server_close()
+        else:
+            self.httpd.shutdown()
+            self.httpsd.shutdown()
+
+    def cpu_time(self):
+        """Return the CPU time, in seconds, used so far by the processes
+           serving requests, or None if it cannot be measured.  Without
+           worker processes this is the runner's own CPU time, which
+           includes the little it spends outside the servers."""
+        if self.pool is None:
+            t = os.times()
+            return t[0] + t[1]
+        total = 0
+        for pid in self.pool.pids():
+            t = read_proc_cpu_time(pid)
+            if t is None:
+                return None
+            total += t
+        return total
+
+    def proxy_server(self, kind, credentials=None):
+        """Create a ProxyServer of KIND in front of these servers, which
+           counts into their statistics.  The caller must start() and
+           stop() it."""
+        return ProxyServer(kind, self.stats, self.namespaces,
+                           self.signal_error, credentials, self.verbose)
+
+    def namespace(self, owner):
+        """Create a ServerNamespace for the test named OWNER."""
+        with self.ns_lock:
+            self.ns_counter += 1
+            token = 'n{}'.format(self.ns_counter)
+            self.namespaces[token] = owner
+        if self.pool is not None:
+            self.pool.send("register", token=token, owner=owner)
+        return ServerNamespace(self, owner, token)
+
+    def release_namespace(self, token):
+        if self.pool is not None:
+            self.pool.send("release", token=token)
+        FileHandler.get_response_hook.release(token)
+        with self.ns_lock:
+            del self.namespaces[token]
 
 #
 # Running tests and interpreting their results
@@ -484,6 +2092,9 @@ class TestGroup(object):
         self.name    = name
         self.n       = [0]*T.MAX
         self.details = []
+        self.server_stats = None
+        self.input_files = []
+        self.cacheable = True
 
     def parse(self, rc, out, err):
         raise NotImplementedError
@@ -542,6 +2153,10 @@ class TestGroup(object):
             if show_all or detail.dtype not in (T.PASS, T.XFAIL, T.SKIP):
                 detail.report(fp)
                 need_blank_line = True
+        if show_all and self.server_stats and self.server_stats["requests"]:
+            fp.write("  {}\n".format(
+                colorize("b", format_request_stats(self.server_stats))))
+            need_blank_line = True
         if need_blank_line:
             fp.write("\n")
 
@@ -563,15 +2178,36 @@ class ExpectTestGroup(TestGroup):
         TestGroup.__init__(self, name)
         if rc_exp is None: rc_exp = 0
         self.rc_exp = rc_exp
-        self.stdout_exp = stdout_exp
-        self.stderr_exp = stderr_exp
         self.rc_xfail = rc_xfail
-        self.stdout_xfail = stdout_xfail
-        self.stderr_xfail = stderr_xfail
+        self.matchers = {
+            "stdout": OutputMatcher("stdout", stdout_exp, stdout_xfail),
+            "stderr": OutputMatcher("stderr", stderr_exp, stderr_xfail),
+        }
+        self.killed = False
+
+    # Passed to run_phantomjs, so that output is checked as it arrives.
+    # Once a line differs the outcome is settled, so unless that was
+    # expected, the test is stopped there rather than left to finish
+    # or time out.
+    def watch(self, what, line):
+        if self.matchers[what].feed(line):
+            return True
+        self.killed = True
+        return False
 
     def parse(self, rc, out, err):
-        self.parse_output("stdout", self.stdout_exp, out, self.stdout_xfail)
-        self.parse_output("stderr", self.stderr_exp, err, self.stderr_xfail)
+        # OUT and ERR are empty unless the output was not watched
+        # (e.g. under a debugger).
+        for what, lines in (("stdout", out), ("stderr", err)):
+            matcher = self.matchers[what]
+            for line in lines:
+                matcher.feed(line)
+            self.parse_output(matcher)
+
+        if self.killed:
+            self.add_skip([], "exit code not checked after output"
+                          " diverged")
+            return
 
         exit_msg = ["expected exit code {} got {}"
                     .format(self.rc_exp, rc)]
@@ -589,19 +2225,9 @@ class ExpectTestGroup(TestGroup):
             else:
                 self.add_pass(exit_msg, exit_desc)
 
-    def parse_output(self, what, exp, got, xfail):
-        diff = []
-        le = len(exp)
-        lg = len(got)
-        for i in range(max(le, lg)):
-            e = ""
-            g = ""
-            if i < le: e = exp[i]
-            if i < lg: g = got[i]
-            if e != g:
-                diff.extend(("{}: line {} not as expected".format(what, i+1),
-                             "-" + repr(e)[1:-1],
-                             "+" + repr(g)[1:-1]))
+    def parse_output(self, matcher):
+        what, xfail = matcher.what, matcher.xfail
+        diff = matcher.finish(self.killed)
 
         if diff:
             desc = what + " not as expected"
@@ -617,6 +2243,83 @@ class ExpectTestGroup(TestGroup):
                 self.add_pass(diff, desc)
 
 
+class OutputMatcher(object):
+    """Compares one output stream of an ExpectTestGroup with the
+       expected lines, one line at a time as it arrives.  Lines are
+       compared by position, a missing line counting as empty.  Only a
+       bounded summary of the differences is kept, as a unified diff
+       with a little leading context, so arbitrarily long output takes
+       constant memory.
+    """
+    CONTEXT    = 2      # matching lines shown before each hunk
+    MAX_DIFF   = 20     # '-' and '+' lines kept in the summary
+    MAX_LENGTH = 200    # characters shown from any one line
+
+    def __init__(self, what, exp, xfail):
+        self.what    = what
+        self.exp     = exp
+        self.xfail   = xfail
+        self.n       = 0
+        self.context = collections.deque(maxlen=self.CONTEXT)
+        self.diff    = []
+        self.ndiff   = 0
+        self.dropped = 0
+        self.last    = None     # line number of the last mismatch
+
+    @classmethod
+    def show(cls, line):
+        line = repr(line)[1:-1]
+        if len(line) > cls.MAX_LENGTH:
+            line = line[:cls.MAX_LENGTH] + "..."
+        return line
+
+    def compare(self, i, e, g):
+        if e == g:
+            self.context.append(g)
+            return True
+        if self.ndiff >= self.MAX_DIFF:
+            self.dropped += 1
+            return False
+        if self.last != i - 1:
+            self.diff.append("@@ {} line {} @@".format(self.what, i + 1))
+            self.diff.extend(" " + self.show(c) for c in self.context)
+        if e is not None:
+            self.diff.append("-" + self.show(e))
+            self.ndiff += 1
+        if g is not None:
+            self.diff.append("+" + self.show(g))
+            self.ndiff += 1
+        self.context.clear()
+        self.last = i
+        return False
+
+    def feed(self, line):
+        """Check the next line of output.  Returns False if it was the
+           first not to match and that was not expected, i.e. if there
+           is no point in running the test any further."""
+        i = self.n
+        self.n += 1
+        e = self.exp[i] if i < len(self.exp) else ""
+        first = self.last is None
+        return self.compare(i, e or None, line) or not first or self.xfail
+
+    def finish(self, stopped=False):
+        """Account for expected lines that never appeared, unless the
+           process was STOPPED early, and return the summary of
+           differences (empty if there were none)."""
+        if not stopped:
+            for i in range(self.n, len(self.exp)):
+                if self.exp[i]:
+                    self.compare(i, self.exp[i], None)
+        if not self.diff:
+            return []
+        diff = ["--- expected " + self.what,
+                "+++ actual " + self.what] + self.diff
+        if self.dropped:
+            diff.append("... and {} more differing lines"
+                        .format(self.dropped))
+        return diff
+
 class TAPTestGroup(TestGroup):
     """Test group whose output is interpreted according to a variant of the
        Test Anything Protocol (http://testanything.org/tap-specification.html).
@@ -761,6 +2464,537 @@ class TAPTestGroup(TestGroup):
             if pt not in points_already_used:
                 self.add_fail([], "test {} did not report status".format(pt))
 
+class BenchmarkGroup(TestGroup):
+    """Test group holding the measurements taken by one benchmark.
+       Each measurement is compared with the stored baseline (if any);
+       one that is worse than the baseline by more than the tolerance
+       is a failure, anything else passes.  Free-form notes (such as
+       latency histograms) are printed after the measurements.
+    """
+    def __init__(self, name):
+        TestGroup.__init__(self, name)
+        self.metrics = collections.OrderedDict()
+        self.notes   = []
+
+    def record(self, metric, value, unit, higher_is_better=True):
+        self.metrics[metric] = dict(value=value, unit=unit,
+                                    higher_is_better=higher_is_better)
+
+    def note(self, lines):
+        if not isinstance(lines, list):
+            lines = [lines]
+        self.notes.extend(lines)
+
+    def compare(self, baseline, tolerance):
+        for metric, m in self.metrics.items():
+            label = "{}: {:.3f} {}".format(metric, m["value"],
+                                           m["unit"]).rstrip()
+            base = baseline.get(metric)
+            if base is None or not base["value"]:
+                self.add_pass(["no baseline"], label)
+                continue
+
+            change = (m["value"] - base["value"]) * 100.0 / base["value"]
+            msg = ["baseline {:.3f} {} ({:+.1f}%)"
+                   .format(base["value"], base["unit"], change)]
+            if not m["higher_is_better"]:
+                change = -change
+            if change < -tolerance:
+                self.add_fail(msg, label + " [regressed]")
+            else:
+                self.add_pass(msg, label)
+
+    def as_baseline(self):
+        return dict(self.metrics)
+
+    def report(self, fp, show_all):
+        TestGroup.report(self, fp, show_all)
+        if show_all and self.notes:
+            for line in self.notes:
+                fp.write("  {}\n".format(line))
+            fp.write("\n")
+
+class CachedTestGroup(TestGroup):
+    """Test group replayed from the result cache (see ResultCache)."""
+    CODES = dict((code.idx, code) for code in (T.PASS, T.FAIL, T.XFAIL,
+                                               T.XPASS, T.ERROR, T.SKIP))
+
+    def __init__(self, name, details):
+        TestGroup.__init__(self, name)
+        for message, test_id, idx in details:
+            self._add_d([line.encode("utf-8") for line in message],
+                        test_id and test_id.encode("utf-8"),
+                        self.CODES[idx])
+
+    def line_summary(self, fp):
+        code = self.worst_code()
+        fp.write("{}: {} (cached)\n".format(colorize("^", self.name),
+                                            colorize(code.color, code.label)))
+
+class ResultCache(object):
+    """With --result-cache, the outcome of each successful test is
+       stored along with a key that hashes everything known to affect
+       it: the PhantomJS binary, this script, testharness.js, the test
+       script itself (including its directives), and every file below
+       lib/www that the test requested from the test servers, as seen
+       in the request accounting, as well as any file fed to it by a
+       stdin-file directive and any reference image that its renders
+       were compared with.  A test whose key is unchanged on the next
+       run is not run again; its stored result is replayed.
+
+       Files a test reads in any other way (with the fs module, or
+       from a file: URL) are not tracked, so after changing one of
+       those, delete the cache or run without it.
+    """
+    def __init__(self, path, base_path, phantomjs_exe):
+        self.path      = path
+        self.base_path = base_path
+        self.www_path  = os.path.join(base_path, 'lib/www')
+        self.digests   = {}
+        self.common    = [("phantomjs", self.digest(phantomjs_exe)),
+                          ("run-tests.py", self.digest(__file__)),
+                          ("testharness.js",
+                           self.digest(os.path.join(base_path,
+                                                    'lib/testharness.js')))]
+        try:
+            with open(path, "rt") as f:
+                self.entries = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.entries = {}
+        except ValueError:
+            # Unreadable, probably from an interrupted write; start over.
+            self.entries = {}
+        self.hits = 0
+
+    def digest(self, path):
+        """SHA-1 of the contents of PATH, or None if it is not a file.
+           Each file is hashed at most once per run."""
+        d = self.digests.get(path, False)
+        if d is False:
+            d = None
+            if os.path.isfile(path):
+                h = hashlib.sha1()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(65536), ""):
+                        h.update(block)
+                d = h.hexdigest()
+            self.digests[path] = d
+        return d
+
+    def www_dependency(self, url_path):
+        """The file below lib/www that serves URL_PATH, relative to the
+           test directory."""
+        return os.path.relpath(www_dependency(self.www_path, url_path),
+                               self.base_path)
+
+    def key(self, script, deps):
+        h = hashlib.sha1()
+        for name, d in self.common + [("script", self.digest(script))]:
+            h.update("{} {}\n".format(name, d))
+        for dep in deps:
+            h.update("{} {}\n".format(
+                dep, self.digest(os.path.join(self.base_path, dep))))
+        return h.hexdigest()
+
+    def lookup(self, name, script):
+        """Return a CachedTestGroup for NAME if its stored key is still
+           current, otherwise None."""
+        entry = self.entries.get(name)
+        if entry is None or entry["key"] != self.key(script, entry["deps"]):
+            return None
+        self.hits += 1
+        return CachedTestGroup(name, entry["details"])
+
+    def store(self, name, script, grp):
+        """Record the result GRP for NAME if it was successful, and
+           otherwise forget any earlier result."""
+        if not grp.is_successful():
+            self.entries.pop(name, None)
+            return
+        deps = set(os.path.relpath(path, self.base_path)
+                   for path in grp.input_files)
+        if grp.server_stats:
+            deps.update(self.www_dependency(url_path)
+                        for url_path in grp.server_stats["requests"])
+        deps = sorted(deps)
+        self.entries[name] = {
+            "key":     self.key(script, deps),
+            "deps":    deps,
+            "details": [(d.message, d.test_id, d.dtype.idx)
+                        for d in grp.details],
+        }
+
+    def save(self):
+        # Write to a temporary file and rename it into place, so that
+        # an interrupted run cannot leave a truncated cache behind.
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".result-cache.")
+        with os.fdopen(fd, "wt") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+            f.write("\n")
+        os.rename(tmp, self.path)
+
+#
+# Comparing rendered images
+#
+ImageDiff = collections.namedtuple("ImageDiff", (
+    "max_diff", "bad_fraction", "psnr", "ssim"))
+
+LUMA = (0.299, 0.587, 0.114)
+
+def load_image(path):
+    """Decode the image at PATH into a float array of shape (height,
+       width, 3): its RGB values, composited over white."""
+    img = Image.open(path)
+    try:
+        rgba = numpy.asarray(img.convert("RGBA"), dtype=numpy.float32)
+    finally:
+        img.close()
+    alpha = rgba[:, :, 3:] / 255.0
+    return rgba[:, :, :3] * alpha + 255.0 * (1.0 - alpha)
+
+def box_mean(a, k):
+    """Return the mean of every K x K window lying wholly inside the
+       2-D array A, computed from a summed-area table."""
+    s = numpy.zeros((a.shape[0] + 1, a.shape[1] + 1))
+    s[1:, 1:] = a.cumsum(0).cumsum(1)
+    return (s[k:, k:] - s[:-k, k:] - s[k:, :-k] + s[:-k, :-k]) / (k * k)
+
+def compare_images(actual, expected, tolerance, window=8):
+    """Compare two images of the same size, as returned by load_image.
+       Return an ImageDiff and the per-pixel difference (the largest
+       over the channels).  'bad_fraction' is the fraction of pixels
+       that differ by more than TOLERANCE.  SSIM is computed on
+       luminance with uniform WINDOW x WINDOW windows rather than the
+       usual Gaussian weights, which ranks renders as well and costs
+       only a few passes over the image."""
+    delta = actual - expected
+    diff = numpy.abs(delta).max(axis=2)
+    if not diff.any():
+        return ImageDiff(0.0, 0.0, float("inf"), 1.0), diff
+    mse = float((delta * delta).mean())
+    psnr = float(10 * numpy.log10(255.0 ** 2 / mse))
+
+    # A window with no differing pixel in it has an SSIM of exactly 1,
+    # so only the windows overlapping the bounding box of the
+    # differences need to be computed.
+    h, w = diff.shape
+    k = min(window, h, w)
+    rows = numpy.flatnonzero(diff.any(axis=1))
+    cols = numpy.flatnonzero(diff.any(axis=0))
+    top, bottom = max(rows[0] - k + 1, 0), min(rows[-1] + k, h)
+    left, right = max(cols[0] - k + 1, 0), min(cols[-1] + k, w)
+    x = actual[top:bottom, left:right].dot(LUMA).astype(numpy.float64)
+    y = expected[top:bottom, left:right].dot(LUMA).astype(numpy.float64)
+    mx, my = box_mean(x, k), box_mean(y, k)
+    vx = box_mean(x * x, k) - mx * mx
+    vy = box_mean(y * y, k) - my * my
+    cov = box_mean(x * y, k) - mx * my
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim = (((2 * mx * my + c1) * (2 * cov + c2)) /
+            ((mx * mx + my * my + c1) * (vx + vy + c2)))
+    windows = (h - k + 1) * (w - k + 1)
+    ssim = (float(ssim.sum()) + windows - ssim.size) / windows
+    return ImageDiff(float(diff.max()), float((diff > tolerance).mean()),
+                     psnr, ssim), diff
+
+def write_image_diff(path, actual, expected, diff):
+    """Write a PNG to PATH showing EXPECTED, ACTUAL and a heat map of
+       DIFF side by side.  The heat map is the expected image faded to
+       grey, with each pixel that differs colored from red (slightly)
+       to yellow (by 64 or more)."""
+    grey = expected.dot(LUMA) * 0.25 + 191.25
+    heat = numpy.repeat(grey[:, :, numpy.newaxis], 3, axis=2)
+    changed = diff > 0
+    heat[changed, 0] = 255
+    heat[changed, 1] = numpy.minimum(diff[changed] * 4, 255)
+    heat[changed, 2] = 0
+    out = numpy.concatenate((expected, actual, heat), axis=1)
+    Image.fromarray(out.round().astype(numpy.uint8), "RGB").save(path)
+
+def format_image_diff(d, tolerance):
+    return ("{:.2f}% of pixels off by more than {:g} (max {:g}),"
+            " PSNR {:.1f} dB, SSIM {:.4f}".format(d.bad_fraction * 100,
+                                                  tolerance, d.max_diff,
+                                                  d.psnr, d.ssim))
+
+class RenderCheck(object):
+    """Compare the images a test renders with references, as set up by
+       its compare-renders directive:
+
+           //! compare-renders: DIR [tolerance=N] [max-bad=PCT]
+                                    [min-psnr=DB] [min-ssim=X]
+
+       The test writes renders into the directory named by the
+       TEST_RENDER_DIR environment variable.  Each one, NAME.EXT or
+       NAME.VARIANT.EXT, is compared with DIR/NAME.EXT, DIR being
+       relative to the test script.  It passes if at most PCT percent
+       of its pixels are off by more than N in some channel, and its
+       PSNR and SSIM are at least DB and X.  For each that fails, the
+       reference, the render and a heat map of the differences are
+       written side by side to a PNG in the --render-diff-dir.
+
+       Renders that the test writes to the XFAIL_DIR subdirectory
+       instead are known to differ on this platform: their failures
+       are expected failures.  Passing is still a pass, since this
+       comparison is more lenient than whatever the test found to fail.
+
+       PDFs are not compared.  Without NumPy and Pillow, nothing is
+       compared and the check is reported as skipped.
+    """
+    LIMITS = collections.OrderedDict((
+        ("tolerance", 8.0),
+        ("max-bad",   0.1),
+        ("min-psnr",  30.0),
+        ("min-ssim",  0.95),
+    ))
+    NOT_IMAGES = (".pdf",)
+    XFAIL_DIR  = "xfail"
+
+    def __init__(self, ref_dir, options):
+        if not os.path.isdir(ref_dir):
+            raise ValueError("compare-renders: not a directory: " + ref_dir)
+        self.ref_dir = ref_dir
+        self.limits  = dict(self.LIMITS)
+        for opt in options:
+            key, sep, value = opt.partition("=")
+            if not sep or key not in self.LIMITS:
+                raise ValueError("compare-renders: unrecognized option: "
+                                 + opt)
+            self.limits[key] = float(value)
+
+    def reference(self, name):
+        stem, ext = os.path.splitext(name)
+        return os.path.join(self.ref_dir, stem.split(".")[0] + ext)
+
+    def renders(self, render_dir):
+        """Yield (name, path, known to differ) for each image in
+           RENDER_DIR and its XFAIL_DIR subdirectory, in order."""
+        for xfail, path in ((False, render_dir),
+                            (True, os.path.join(render_dir, self.XFAIL_DIR))):
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                if (os.path.isfile(os.path.join(path, name)) and
+                    os.path.splitext(name)[1].lower() not in self.NOT_IMAGES):
+                    yield name, os.path.join(path, name), xfail
+
+    def check(self, grp, render_dir, diff_dir):
+        """Compare each render in RENDER_DIR with its reference, adding
+           a result to GRP for each, and the references to its
+           input files."""
+        renders = list(self.renders(render_dir))
+        if not renders:
+            return
+        if numpy is None:
+            grp.add_skip(["image comparison needs NumPy and Pillow"],
+                         "compare-renders")
+            return
+
+        tolerance = self.limits["tolerance"]
+        for name, path, xfail in renders:
+            label = "render " + name
+            fail = grp.add_xfail if xfail else grp.add_fail
+            ref = self.reference(name)
+            if not os.path.isfile(ref):
+                fail(["no reference image " + ref], label)
+                continue
+            grp.input_files.append(ref)
+            try:
+                actual = load_image(path)
+                expected = load_image(ref)
+            except IOError as e:
+                fail([str(e)], label)
+                continue
+            if actual.shape != expected.shape:
+                fail(["size {1}x{0}, reference {3}x{2}".format(
+                    *(actual.shape[:2] + expected.shape[:2]))], label)
+                continue
+
+            d, diff = compare_images(actual, expected, tolerance)
+            summary = format_image_diff(d, tolerance)
+            if (d.bad_fraction * 100 <= self.limits["max-bad"] and
+                d.psnr >= self.limits["min-psnr"] and
+                d.ssim >= self.limits["min-ssim"]):
+                grp.add_pass([summary], label)
+                continue
+            if not os.path.isdir(diff_dir):
+                os.makedirs(diff_dir)
+            diff_path = os.path.join(diff_dir,
+                                     re.sub(r'[^A-Za-z0-9_.-]+', '.',
+                                            grp.name + "-" + name)
+                                     + ".diff.png")
+            write_image_diff(diff_path, actual, expected, diff)
+            fail([summary, "reference | render | difference: " + diff_path],
+                 label)
+
+class FileWatcher(object):
+    """Waits for files to change below a set of directories, for
+       --watch.  On Linux this uses inotify, watching every directory
+       below each root (and those created later); elsewhere, or if
+       inotify is unavailable, it polls modification times once a
+       second.  A root may also be a single file, in which case its
+       directory is watched, but not recursively.
+    """
+    # From <sys/inotify.h>.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
+
+    # Editors tend to write a file in several steps, so after the
+    # first change, wait until none has arrived for this long.
+    SETTLE = 0.1
+    POLL_INTERVAL = 1
+
+    def __init__(self, roots):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.fd = None
+        self.wds = {}
+        inotify = find_inotify()
+        if inotify is not None:
+            init, self.add_watch = inotify
+            try:
+                self.fd = init()
+            except OSError:
+                pass
+        if self.fd is None:
+            self.snapshot = self.scan()
+            return
+        try:
+            for root in self.roots:
+                if os.path.isdir(root):
+                    self.watch_tree(root)
+                else:
+                    self.watch_dir(os.path.dirname(root))
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @staticmethod
+    def ignored(name):
+        """True for the names of editor backup, swap and lock files,
+           and of Python's compiled files."""
+        return (name.startswith((".", "#")) or name.endswith("~") or
+                os.path.splitext(name)[1] in (".swp", ".swx", ".pyc"))
+
+    def watch_dir(self, path):
+        try:
+            wd = self.add_watch(self.fd, path, self.MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise OSError(e.errno, "too many directories to watch;"
+                              " raise fs.inotify.max_user_watches")
+            # It went away again before we got to it.
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return
+        self.wds[wd] = path
+
+    def watch_tree(self, root):
+        """Watch ROOT and every directory below it, and return the
+           files found there."""
+        files = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not self.ignored(d)]
+            self.watch_dir(dirpath)
+            files.update(os.path.join(dirpath, fn) for fn in filenames
+                         if not self.ignored(fn))
+        return files
+
+    def scan(self):
+        snapshot = {}
+        for root in self.roots:
+            if os.path.isdir(root):
+                paths = set()
+                for dirpath, dirnames, filenames in os.walk(root):
+                    dirnames[:] = [d for d in dirnames
+                                   if not self.ignored(d)]
+                    paths.update(os.path.join(dirpath, fn)
+                                 for fn in filenames
+                                 if not self.ignored(fn))
+            else:
+                paths = [root]
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def poll(self):
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            snapshot = self.scan()
+            changed = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed:
+                return changed
+
+    def read_events(self, changed):
+        """Add the paths named by pending events to CHANGED.  Return
+           False if events were lost, so that it is incomplete."""
+        complete = True
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        off = 0
+        while off < len(buf):
+            wd, mask, cookie, n = struct.unpack_from("iIII", buf, off)
+            name = buf[off + 16:off + 16 + n].rstrip("\0")
+            off += 16 + n
+            if mask & self.IN_Q_OVERFLOW:
+                complete = False
+                continue
+            if mask & self.IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            dirpath = self.wds.get(wd)
+            if dirpath is None or not name or self.ignored(name):
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & self.IN_ISDIR:
+                # Files in a directory created or moved here count as
+                # changed; those in one moved away or deleted are not
+                # tracked individually.
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    changed.update(self.watch_tree(path))
+                continue
+            changed.add(path)
+        return complete
+
+    def wait(self):
+        """Block until something changes, then return the set of paths
+           that changed (including those created and deleted), or None
+           if changes were lost and anything may have changed."""
+        if self.fd is None:
+            return self.poll()
+        changed = set()
+        complete = True
+        while not changed and complete:
+            select.select([self.fd], [], [])
+            while select.select([self.fd], [], [], self.SETTLE)[0]:
+                complete = self.read_events(changed) and complete
+        return changed if complete else None
+
 class TestRunner(object):
     def __init__(self, base_path, phantomjs_exe, options):
         self.base_path       = base_path
@@ -770,7 +3004,28 @@ class TestRunner(object):
         self.verbose         = options.verbose
         self.debugger        = options.debugger
         self.to_run          = options.to_run
+        self.benchmarks      = options.bench
+        self.bench_params    = dict(options.bench_params)
+        self.baseline_file   = options.baseline
+        self.save_baseline   = options.save_baseline
+        self.tolerance       = options.tolerance
         self.server_errs     = []
+        self.server          = None
+        self.request_stats   = RequestStats(trace=bool(options.request_trace))
+        self.request_trace   = options.request_trace
+        self.request_traces  = []
+        self.trace_file      = options.trace
+        self.server_workers  = options.server_workers
+        self.render_diff_dir = options.render_diff_dir
+        self.watch_mode      = options.watch
+        self.test_deps       = {}
+        self.profiler        = None
+        if options.profile:
+            self.profiler = PROFILERS[options.profile](options.profile_dir)
+        self.result_cache    = None
+        if options.result_cache:
+            self.result_cache = ResultCache(options.result_cache,
+                                            base_path, phantomjs_exe)
         self.prepare_environ()
 
     def prepare_environ(self):
@@ -802,8 +3057,32 @@ class TestRunner(object):
         # usually written, e.g. UTC+1 would be xxx-1:00.
         os.environ["TZ"] = "CIST-12:45:00"
 
-    def signal_server_error(self, exc_info):
-        self.server_errs.append(exc_info)
+    def signal_server_error(self, error):
+        self.server_errs.append(error)
+
+    def collect_server_stats(self, grp):
+        grp.server_stats = self.request_stats.collect(grp.name, settle=True)
+        trace = grp.server_stats.pop("trace", None)
+        if trace:
+            self.request_traces.append((grp.name, trace))
+
+    def write_traces(self):
+        if self.request_trace:
+            write_request_trace(self.request_trace, self.request_traces)
+            if self.verbose:
+                sys.stdout.write(colorize("b", "## request trace written"
+                                          " to " + self.request_trace) + "\n")
+        if self.trace_file:
+            TRACER.write(self.trace_file)
+            if self.verbose:
+                sys.stdout.write(colorize("b", "## runner trace written"
+                                          " to " + self.trace_file) + "\n")
+
+    def server_error_group(self):
+        grp = TestGroup("HTTP server errors")
+        for tb_lines, message in self.server_errs:
+            grp.add_error(tb_lines, message)
+        return grp
 
     def get_base_command(self, debugger):
         if debugger is None:
@@ -819,7 +3098,8 @@ class TestRunner(object):
 
     def run_phantomjs(self, script,
                       script_args=[], pjs_args=[], stdin_data=[],
-                      timeout=TIMEOUT, silent=False):
+                      timeout=TIMEOUT, silent=False, env=None,
+                      profile_name=None, watch=None):
         verbose  = self.verbose
         debugger = self.debugger
         if silent:
@@ -834,6 +3114,13 @@ class TestRunner(object):
             command.append('--verbose={}'.format(verbose))
         command.extend(script_args)
 
+        if self.profiler is not None and profile_name is not None:
+            command = self.profiler.wrap(command, profile_name)
+            timeout *= self.profiler.TIMEOUT_SCALE
+            # testharness.js scales its own timeouts likewise.
+            env = dict(os.environ if env is None else env)
+            env["TEST_TIMEOUT_SCALE"] = str(self.profiler.TIMEOUT_SCALE)
+
         if verbose >= 3:
             sys.stdout.write("## running {}\n".format(" ".join(command)))
 
@@ -841,17 +3128,65 @@ class TestRunner(object):
             # FIXME: input-feed mode doesn't work with a debugger,
             # because how do you tell the debugger that the *debuggee*
             # needs to read from a pipe?
-            subprocess.call(command)
+            subprocess.call(command, env=env)
             return 0, [], []
         else:
-            return do_call_subprocess(command, verbose, stdin_data, timeout)
-
-    def run_test(self, script, name):
+            return do_call_subprocess(command, verbose, stdin_data, timeout,
+                                      env, watch)
+
+    def spawn_phantomjs(self, script, script_args=[], pjs_args=[], env=None):
+        """Start PhantomJS in the background and return the
+           BackgroundProcess.  SCRIPT may be None, e.g. for --webdriver
+           mode.  Debuggers are not supported here."""
+        command = [self.phantomjs_exe]
+        command.extend(pjs_args)
+        if script is not None:
+            command.append(script)
+        command.extend(script_args)
+        if self.verbose >= 3:
+            sys.stdout.write("## spawning {}\n".format(" ".join(command)))
+        return BackgroundProcess(command, self.verbose, env)
+
+    def run_bench_script(self, name, script_args=[], pjs_args=[],
+                         timeout=TIMEOUT, env=None, stdin_data=[],
+                         watch=None):
+        """Run one of the benchmarks/ controller scripts to completion.
+           Unlike run_phantomjs, no harness arguments are passed.
+           STDIN_DATA and WATCH are as for do_call_subprocess."""
+        command = [self.phantomjs_exe]
+        command.extend(pjs_args)
+        command.append(self.bench_script(name))
+        command.extend(script_args)
+        if self.verbose >= 3:
+            sys.stdout.write("## running {}\n".format(" ".join(command)))
+        return do_call_subprocess(command, self.verbose, stdin_data,
+                                  timeout, env, watch)
+
+    def bench_script(self, name):
+        return os.path.join(self.base_path, BENCH_DIR, name)
+
+    def bench_param(self, name, default):
+        """Look up a --bench-param setting, converting it to the type of
+           DEFAULT.  A list default means a comma-separated list of
+           values of the type of its first element."""
+        value = self.bench_params.get(name)
+        if value is None:
+            return default
+        if isinstance(default, list):
+            return [type(default[0])(v) for v in value.split(",")]
+        if isinstance(default, bool):
+            return value.lower() in ("1", "yes", "true", "on")
+        return type(default)(value)
+
+    def run_test(self, script, name, env=None):
         script_args = []
         pjs_args = []
         use_harness = True
         use_snakeoil = True
+        single_server = False
         stdin_data = []
+        input_files = []
+        render_check = None
         stdout_exp = []
         stderr_exp = []
         rc_exp = None
@@ -867,6 +3202,7 @@ class TestRunner(object):
         if self.verbose >= 3:
             sys.stdout.write(colorize("^", name) + ":\n")
         # Parse any directives at the top of the script.
+        t_parse = time.time()
         try:
             with open(script, "rt") as s:
                 for line in s:
@@ -884,6 +3220,8 @@ class TestRunner(object):
                             use_harness = False
                         elif tok == "no-snakeoil":
                             use_snakeoil = False
+                        elif tok == "no-server-workers":
+                            single_server = True
                         elif tok == "expect-exit-fails":
                             rc_xfail = True
                         elif tok == "expect-stdout-fails":
@@ -910,7 +3248,33 @@ class TestRunner(object):
                             break
                         elif tok == "stdin:":
                             require_args(tok, i, tokens)
-                            stdin_data.append(" ".join(tokens[(i+1):]) + "\n")
+                            stdin_data.append(
+                                [" ".join(tokens[(i+1):]) + "\n"])
+                            break
+                        elif tok == "stdin-file:":
+                            require_args(tok, i, tokens)
+                            path = os.path.join(self.base_path, tokens[i+1])
+                            if not os.path.isfile(path):
+                                raise ValueError("stdin-file not found: " +
+                                                 tokens[i+1])
+                            stdin_data.append(file_blocks(path))
+                            input_files.append(path)
+                            skip = True
+                        elif tok == "stdin-lines:":
+                            require_args(tok, i, tokens)
+                            count = int(tokens[i+1])
+                            if count < 0:
+                                raise ValueError("stdin-lines count must not"
+                                                 " be negative")
+                            stdin_data.append(numbered_lines(
+                                count, " ".join(tokens[(i+2):])))
+                            break
+                        elif tok == "compare-renders:":
+                            require_args(tok, i, tokens)
+                            render_check = RenderCheck(
+                                os.path.join(os.path.dirname(script),
+                                             tokens[i+1]),
+                                tokens[(i+2):])
                             break
                         elif tok == "expect-stdout:":
                             require_args(tok, i, tokens)
@@ -932,54 +3296,269 @@ class TestRunner(object):
                 grp.add_error([], '{} ({}): {}\n'
                               .format(name, script, str(e)))
             return grp
+        TRACER.complete("parse directives", "runner", t_parse)
+
+        if single_server and self.server_workers > 1:
+            grp = TestGroup(name)
+            grp.add_skip(["the test servers are running in {} worker"
+                          " processes".format(self.server_workers)],
+                         "test needs a single server process")
+            # Not a result to replay on a run with one server process.
+            grp.cacheable = False
+            return grp
 
         if use_harness:
             script_args.insert(0, script)
             script = self.harness
 
+        # Each stdin directive contributed an iterable of strings, which
+        # are written out in order as the process consumes them.
+        if stdin_data:
+            stdin_data = itertools.chain.from_iterable(stdin_data)
+
         if use_snakeoil:
             pjs_args.insert(0, '--ssl-certificates-path=' + self.cert_path)
 
-        rc, out, err = self.run_phantomjs(script, script_args, pjs_args,
-                                          stdin_data, timeout)
-
         if rc_exp or stdout_exp or stderr_exp:
             grp = ExpectTestGroup(name,
                                   rc_exp, stdout_exp, stderr_exp,
                                   rc_xfail, stdout_xfail, stderr_xfail)
+            watch = grp.watch
         else:
             grp = TAPTestGroup(name)
-        grp.parse(rc, out, err)
+            watch = None
+
+        render_dir = None
+        if render_check is not None:
+            render_dir = tempfile.mkdtemp(prefix="pjs-renders-")
+            env = dict(env if env is not None else os.environ,
+                       TEST_RENDER_DIR=render_dir)
+        try:
+            rc, out, err = self.run_phantomjs(script, script_args, pjs_args,
+                                              stdin_data, timeout, env=env,
+                                              profile_name=name, watch=watch)
+            grp.input_files = input_files
+            with TRACER.span("parse output"):
+                grp.parse(rc, out, err)
+            if render_check is not None:
+                with TRACER.span("compare renders"):
+                    render_check.check(grp, render_dir, self.render_diff_dir)
+        finally:
+            if render_dir is not None:
+                shutil.rmtree(render_dir, ignore_errors=True)
         return grp
 
-    def run_tests(self):
-        start = time.time()
-        base = self.base_path
-        nlen = len(base) + 1
+    def selected(self, tname):
+        if not self.to_run:
+            return True
+        for to_run in self.to_run:
+            if to_run in tname:
+                return True
+        return False
 
-        results = []
+    def test_name(self, test_script):
+        return os.path.splitext(test_script)[0][len(self.base_path) + 1:]
 
+    def discover_tests(self):
+        tests = []
         for test_glob in TESTS:
-            test_glob = os.path.join(base, test_glob)
-
+            test_glob = os.path.join(self.base_path, test_glob)
             for test_script in sorted(glob.glob(test_glob)):
-                tname = os.path.splitext(test_script)[0][nlen:]
-                if self.to_run:
-                    for to_run in self.to_run:
-                        if to_run in tname:
-                            break
-                    else:
-                        continue
+                tname = self.test_name(test_script)
+                if self.selected(tname):
+                    tests.append((test_script, tname))
+        return tests
+
+    def test_dependencies(self, tname, grp):
+        """The files below the test directory that the result GRP of
+           test TNAME depended on, as for the result cache: those below
+           lib/www it requested, and its input files.  For a result
+           replayed from the cache, those recorded with it."""
+        if isinstance(grp, CachedTestGroup):
+            return set(os.path.join(self.base_path, dep) for dep in
+                       self.result_cache.entries[tname]["deps"])
+        deps = set(os.path.normpath(path) for path in grp.input_files)
+        if grp.server_stats:
+            www_path = os.path.join(self.base_path, 'lib/www')
+            deps.update(www_dependency(www_path, url_path)
+                        for url_path in grp.server_stats["requests"])
+        return deps
+
+    def run_tests(self, tests=None):
+        start = time.time()
+        results = []
 
-                any_executed = True
-                grp = self.run_test(test_script, tname)
-                grp.report_for_verbose_level(sys.stdout, self.verbose)
+        if tests is None:
+            with TRACER.span("discover tests"):
+                tests = self.discover_tests()
+
+        for test_script, tname in tests:
+            with TRACER.span(tname, "test"):
+                grp = None
+                if self.result_cache is not None:
+                    grp = self.result_cache.lookup(tname, test_script)
+                if grp is None:
+                    nerrs = len(self.server_errs)
+                    self.request_stats.begin(tname)
+                    with self.server.namespace(tname) as ns:
+                        grp = self.run_test(test_script, tname, ns.environ())
+                    self.collect_server_stats(grp)
+                    # A server error may have been the test's fault.
+                    if (self.result_cache is not None and grp.cacheable and
+                        len(self.server_errs) == nerrs):
+                        self.result_cache.store(tname, test_script, grp)
+                self.test_deps[tname] = self.test_dependencies(tname, grp)
+                with TRACER.span("report"):
+                    grp.report_for_verbose_level(sys.stdout, self.verbose)
                 results.append(grp)
 
-        grp = TestGroup("HTTP server errors")
-        for ty, val, tb in self.server_errs:
-            grp.add_error(traceback.format_tb(tb, 5),
-                          traceback.format_exception_only(ty, val)[-1])
+        if self.result_cache is not None:
+            self.result_cache.save()
+        self.write_traces()
+
+        grp = self.server_error_group()
+        grp.report_for_verbose_level(sys.stdout, self.verbose)
+        results.append(grp)
+
+        sys.stdout.write("\n")
+        if self.profiler is not None:
+            self.profiler.report(sys.stdout)
+        return self.report(results, time.time() - start)
+
+    def is_test_script(self, path):
+        rel = os.path.relpath(path, self.base_path).split(os.sep)
+        for test_glob in TESTS:
+            parts = test_glob.split('/')
+            if len(parts) == len(rel) and all(
+                    fnmatch.fnmatch(r, g) for r, g in zip(rel, parts)):
+                return True
+        return False
+
+    def affected_tests(self, changed, tests):
+        """Return the tests, from the inventory TESTS (a dict of test
+           names by script), affected by changes to the paths CHANGED,
+           in order, after updating TESTS for scripts that were added
+           or removed.  CHANGED is None if anything may have changed."""
+        if changed is None:
+            tests.clear()
+            tests.update((script, tname)
+                         for script, tname in self.discover_tests())
+            return sorted(tests.items())
+
+        names = set()
+        for path in changed:
+            if path in (self.harness, self.phantomjs_exe):
+                names.update(tests.values())
+            elif self.is_test_script(path):
+                tname = self.test_name(path)
+                if not os.path.isfile(path):
+                    tests.pop(path, None)
+                    self.test_deps.pop(tname, None)
+                elif self.selected(tname):
+                    tests[path] = tname
+                    names.add(tname)
+            else:
+                names.update(tname for tname, deps in self.test_deps.items()
+                             if path in deps)
+                # Helper scripts and other files next to the tests, for
+                # them to load or spawn, are not tracked: assume they
+                # affect every test in or below their directory.
+                if not path.startswith(os.path.join(self.base_path, 'lib')
+                                       + os.sep):
+                    names.update(tname for script, tname in tests.items()
+                                 if path.startswith(os.path.dirname(script)
+                                                    + os.sep))
+        return sorted((script, tname) for script, tname in tests.items()
+                      if tname in names)
+
+    def watch(self):
+        """Run the selected tests, then, keeping the test servers up,
+           rerun those affected by each change to the test scripts, to
+           the files below lib/ that they depend on, or to the PhantomJS
+           binary, until interrupted.  Returns the status of the last
+           run."""
+        with TRACER.span("discover tests"):
+            tests = dict(self.discover_tests())
+        rc = self.run_tests(sorted(tests.items()))
+
+        roots = [os.path.join(self.base_path, test_glob.split('/')[0])
+                 for test_glob in TESTS]
+        roots += [os.path.join(self.base_path, 'lib'), self.phantomjs_exe,
+                  os.path.abspath(__file__)]
+        watcher = FileWatcher(sorted(set(roots)))
+        try:
+            while True:
+                sys.stdout.write(colorize("b", "## watching for changes"
+                                          " (interrupt to stop)") + "\n")
+                sys.stdout.flush()
+                while True:
+                    changed = watcher.wait()
+                    if changed is not None and \
+                       os.path.abspath(__file__) in changed:
+                        sys.stdout.write(colorize("b", "## run-tests.py"
+                                                  " changed; restart to use"
+                                                  " the new version") + "\n")
+                    affected = self.affected_tests(changed, tests)
+                    if affected:
+                        break
+                sys.stdout.write(colorize("b", "## rerunning {} of {} tests"
+                                          .format(len(affected), len(tests)))
+                                 + "\n")
+                del self.server_errs[:]
+                del self.request_traces[:]
+                if self.result_cache is not None:
+                    self.result_cache.hits = 0
+                rc = self.run_tests(affected)
+        except KeyboardInterrupt:
+            sys.stdout.write("\n")
+            return rc
+        finally:
+            watcher.close()
+
+    def load_baseline(self):
+        try:
+            with open(self.baseline_file, "rt") as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+    def run_benchmarks(self):
+        start = time.time()
+        baseline = self.load_baseline()
+        results = []
+
+        for name in self.benchmarks:
+            if self.verbose >= 3:
+                sys.stdout.write(colorize("^", name) + ":\n")
+            grp = BenchmarkGroup(name)
+            self.request_stats.begin(name)
+            try:
+                with self.server.namespace(name) as ns, \
+                     TRACER.span(name, "benchmark"):
+                    BENCHMARKS[name](self, ns.environ()).run(grp)
+            except Exception:
+                ty, val, tb = sys.exc_info()
+                grp.add_error(traceback.format_tb(tb, 5),
+                              traceback.format_exception_only(ty, val)[-1])
+            self.collect_server_stats(grp)
+            grp.compare(baseline.get(name, {}), self.tolerance)
+            # The measurements are the point of a benchmark, so they
+            # are always shown in full.
+            grp.report(sys.stdout, True)
+            results.append(grp)
+
+        if self.save_baseline:
+            for grp in results:
+                if grp.metrics and grp.n[T.ERROR] == 0:
+                    baseline[grp.name] = grp.as_baseline()
+            with open(self.baseline_file, "wt") as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+                f.write("\n")
+        self.write_traces()
+
+        grp = self.server_error_group()
         grp.report_for_verbose_level(sys.stdout, self.verbose)
         results.append(grp)
 
@@ -995,7 +3574,9 @@ class TestRunner(object):
         n = [0] * T.MAX
 
         for grp in results:
-            if self.verbose == 0 and not grp.is_successful():
+            # Benchmark groups have already been reported in full.
+            if (self.verbose == 0 and not grp.is_successful() and
+                not isinstance(grp, BenchmarkGroup)):
                 grp.report(sys.stdout, False)
             for i, x in enumerate(grp.n): n[i] += x
 
@@ -1003,12 +3584,1565 @@ class TestRunner(object):
         for s in (T.PASS, T.FAIL, T.XPASS, T.XFAIL, T.ERROR, T.SKIP):
             if n[s]:
                 sys.stdout.write(" {:>4} {}\n".format(n[s], s.long_label))
+        if self.result_cache is not None and self.result_cache.hits:
+            sys.stdout.write(" {:>4} test files replayed from the result"
+                             " cache\n".format(self.result_cache.hits))
 
         if n[T.FAIL] == 0 and n[T.XPASS] == 0 and n[T.ERROR] == 0:
             return 0
         else:
             return 1
 
+#
+# Profiling
+#
+# With --profile, every test is run under a profiler, one profile per
+# test, and the profiles are aggregated into a report of the hottest
+# functions once the tests are done.  Output capture and TAP parsing
+# work as usual.
+#
+
+def profile_file_name(test_name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '.', test_name)
+
+class Profiler(object):
+    """Base class for the --profile tools.  Subclasses provide the
+       command prefix to run a test under, and a parser that extracts
+       per-function costs (and, if available, call stacks) from one
+       profile."""
+    # How much longer a test may take under the profiler.
+    TIMEOUT_SCALE = 1
+    TOOL = None
+    UNIT = None
+
+    def __init__(self, out_dir):
+        self.out_dir  = out_dir
+        self.profiles = []
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+    def wrap(self, command, test_name):
+        """Return COMMAND modified to run under the profiler, writing
+           a profile for TEST_NAME."""
+        path = os.path.join(self.out_dir,
+                            self.file_name(profile_file_name(test_name)))
+        self.profiles.append((test_name, path))
+        return self.prefix(path) + command
+
+    def file_name(self, base):
+        raise NotImplementedError
+
+    def prefix(self, path):
+        raise NotImplementedError
+
+    def parse(self, path):
+        """Return (self cost, inclusive cost, folded stacks) for the
+           profile at PATH; each is a dict mapping function (or, for
+           stacks, 'outer;...;inner') to a cost."""
+        raise NotImplementedError
+
+    def report(self, fp, top=25):
+        """Aggregate all the profiles taken, write hot-functions.txt
+           and (if there are stacks) folded.txt to the output
+           directory, and print the TOP hottest functions to FP."""
+        self_cost = collections.Counter()
+        incl_cost = collections.Counter()
+        stacks    = collections.Counter()
+        parsed = 0
+        for test_name, path in self.profiles:
+            if not os.path.exists(path):
+                continue
+            try:
+                s, i, f = self.parse(path)
+            except (EnvironmentError, ValueError) as e:
+                fp.write(colorize("y", "## can't read profile for {}: {}"
+                                  .format(test_name, e)) + "\n")
+                continue
+            self_cost.update(s)
+            incl_cost.update(i)
+            stacks.update(f)
+            parsed += 1
+
+        total = sum(self_cost.values())
+        lines = ["{:>8} {:>8}  function".format("self", "total")]
+        for func, cost in self_cost.most_common():
+            lines.append("{:>7.2f}% {:>7.2f}%  {}".format(
+                cost * 100.0 / total, incl_cost[func] * 100.0 / total, func))
+        with open(os.path.join(self.out_dir, "hot-functions.txt"), "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        if stacks:
+            with open(os.path.join(self.out_dir, "folded.txt"), "wt") as f:
+                for stack, n in sorted(stacks.items()):
+                    f.write("{} {}\n".format(stack, n))
+
+        fp.write(colorize("^", "Profile") + ": {} ({} profiles, {} {}) in {}\n"
+                 .format(self.TOOL, parsed, total, self.UNIT, self.out_dir))
+        if total:
+            for line in lines[:top + 1]:
+                fp.write("  " + line + "\n")
+        fp.write("\n")
+
+class PerfProfiler(Profiler):
+    """Sampling profiles with Linux 'perf record', with call stacks
+       (frame-pointer based, so frames from code built without frame
+       pointers may be missing)."""
+    TIMEOUT_SCALE = 2
+    TOOL = "perf"
+    UNIT = "samples"
+    FREQUENCY = 999
+
+    frame_r = re.compile(r'^\s*[0-9a-f]+\s+(.*?)(?:\+0x[0-9a-f]+)?'
+                         r'(?:\s+\((.*)\))?$')
+
+    def file_name(self, base):
+        return base + ".perf.data"
+
+    def prefix(self, path):
+        return ["perf", "record", "-q", "-g", "-F", str(self.FREQUENCY),
+                "-o", path, "--"]
+
+    def parse(self, path):
+        proc = subprocess.Popen(["perf", "script", "-i", path,
+                                 "-F", "ip,sym,dso"],
+                                stdin=devnull, stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, "w"))
+        self_cost = collections.Counter()
+        incl_cost = collections.Counter()
+        stacks    = collections.Counter()
+
+        def flush(frames):
+            if not frames:
+                return
+            self_cost[frames[0]] += 1
+            for func in set(frames):
+                incl_cost[func] += 1
+            stacks[";".join(reversed(frames))] += 1
+
+        frames = []
+        for line in proc.stdout:
+            line = line.rstrip()
+            if not line:
+                flush(frames)
+                frames = []
+                continue
+            m = self.frame_r.match(line)
+            if not m:
+                continue
+            func, dso = m.groups()
+            if func in ("", "[unknown]"):
+                func = "[{}]".format(os.path.basename(dso or "unknown"))
+            frames.append(func.replace(";", ","))
+        flush(frames)
+        if proc.wait() != 0:
+            raise ValueError("perf script exited with code {}"
+                             .format(proc.returncode))
+        return self_cost, incl_cost, stacks
+
+class CallgrindProfiler(Profiler):
+    """Instruction-level profiles with valgrind's callgrind tool.
+       Callgrind records caller/callee pairs rather than stacks, so no
+       folded stacks are produced."""
+    TIMEOUT_SCALE = 50
+    TOOL = "callgrind"
+    UNIT = "instructions"
+
+    def file_name(self, base):
+        return "callgrind.out." + base
+
+    def prefix(self, path):
+        return ["valgrind", "-q", "--tool=callgrind",
+                "--callgrind-out-file=" + path]
+
+    def parse(self, path):
+        # See "Callgrind Format Specification" in the valgrind manual.
+        self_cost = collections.Counter()
+        incl_cost = collections.Counter()
+        names = {}
+        fn = None
+        in_call = False
+
+        def name(spec):
+            # "(id) name" defines a compressed name, "(id)" reuses it.
+            m = re.match(r'^\((\d+)\)\s*(.*)$', spec)
+            if not m:
+                return spec
+            if m.group(2):
+                names[m.group(1)] = m.group(2)
+            return names.get(m.group(1), spec)
+
+        with open(path, "rt") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+                c = line[0]
+                if c.isdigit() or c in "+-*":
+                    costs = line.split()[1:]
+                    cost = int(costs[0]) if costs else 0
+                    if fn is not None:
+                        if in_call:
+                            incl_cost[fn] += cost
+                        else:
+                            self_cost[fn] += cost
+                            incl_cost[fn] += cost
+                    in_call = False
+                elif line.startswith("fn="):
+                    fn = name(line[3:])
+                elif line.startswith("cfn="):
+                    # Only to record a compressed name.
+                    name(line[4:])
+                elif line.startswith("calls="):
+                    in_call = True
+        return self_cost, incl_cost, {}
+
+PROFILERS = collections.OrderedDict((
+    ("perf",      PerfProfiler),
+    ("callgrind", CallgrindProfiler),
+))
+
+#
+# Benchmarks
+#
+# Each benchmark is a class with a 'run' method that takes measurements
+# and records them in a BenchmarkGroup.  They are selected with --bench
+# and tuned with --bench-param NAME=VALUE; see each class for the
+# parameters it understands.
+#
+
+class Benchmark(object):
+    def __init__(self, runner, env):
+        self.runner = runner
+        self.env    = env
+
+    def spawn(self, name, script_args=[], pjs_args=[]):
+        """Start a controller script in the background."""
+        return self.runner.spawn_phantomjs(self.runner.bench_script(name),
+                                           script_args, pjs_args, self.env)
+
+    def param(self, name, default, choices=None):
+        """The --bench-param setting NAME (see TestRunner.bench_param),
+           which must be one of CHOICES, if given."""
+        value = self.runner.bench_param(name, default)
+        if choices is not None and value not in choices:
+            raise ValueError("--bench-param {}={}: expected one of: {}"
+                             .format(name, value, ", ".join(choices)))
+        return value
+
+    def run(self, grp):
+        raise NotImplementedError
+
+    def run_script(self, grp, name, script_args=[], pjs_args=[],
+                   timeout=TIMEOUT):
+        """Run a controller script and return the JSON objects it
+           printed on lines beginning with 'RESULT '.  Output on stderr
+           and unsuccessful exits are recorded as errors in GRP."""
+        rc, out, err = self.runner.run_bench_script(name, script_args,
+                                                    pjs_args, timeout,
+                                                    self.env)
+        results = []
+        for line in out:
+            if line.startswith("RESULT "):
+                results.append(json.loads(line[len("RESULT "):]))
+        if err:
+            grp.add_error(err, name + ": unexpected output on stderr")
+        if rc != 0:
+            grp.add_error([], name + ": PhantomJS exited with code {}"
+                          .format(rc))
+        return results
+
+    def server_get_json(self, path):
+        """GET PATH from the test HTTP server and decode it as JSON."""
+        base = urlparse.urlparse(self.env['TEST_HTTP_BASE'])
+        conn = httplib.HTTPConnection(base.hostname, base.port,
+                                      timeout=TIMEOUT)
+        try:
+            conn.request('GET', base.path + path)
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status != 200:
+                raise RuntimeError("GET {} -> {} {}".format(path, resp.status,
+                                                           body.strip()))
+            return json.loads(body)
+        finally:
+            conn.close()
+
+class WebserverBenchmark(Benchmark):
+    """Load-test the 'webserver' module.  A PhantomJS process runs
+       benchmarks/webserver.js and is hammered with GET requests.
+
+       Parameters:
+         concurrency  comma-separated client thread counts (1,4,16)
+         keepalive    'yes', 'no', or 'both' (both)
+         duration     seconds of load per configuration (5)
+         body_size    response body size in bytes (1024)
+    """
+    def run(self, grp):
+        concurrency = self.param("concurrency", [1, 4, 16])
+        keepalive   = self.param("keepalive", "both", ("yes", "no", "both"))
+        duration    = self.param("duration", 5.0)
+        body_size   = self.param("body_size", 1024)
+
+        modes = {"yes": [True], "no": [False], "both": [True, False]}
+        for ka in modes[keepalive]:
+            port = find_free_port()
+            args = [str(port), "keepalive" if ka else "close", str(body_size)]
+            with self.spawn("webserver.js", args) as pjs:
+                pjs.wait_for(r"^READY\b", TIMEOUT)
+                for c in concurrency:
+                    self.run_one(grp, port, c, ka, duration)
+
+    def run_one(self, grp, port, concurrency, keepalive, duration):
+        lat, errors, elapsed = drive_http_load("localhost", port, "/",
+                                               concurrency, duration,
+                                               keepalive)
+        tag = "c={}, {}".format(concurrency,
+                                "keep-alive" if keepalive else "close")
+        if errors:
+            grp.add_fail([], "{}: {} requests failed".format(tag, errors))
+        if not lat:
+            return
+
+        grp.record("requests/sec ({})".format(tag),
+                   len(lat) / elapsed, "req/s")
+        grp.record("p50 latency ({})".format(tag),
+                   percentile(lat, 50), "ms", higher_is_better=False)
+        grp.record("p99 latency ({})".format(tag),
+                   percentile(lat, 99), "ms", higher_is_better=False)
+        grp.note(["latency histogram ({}, {} requests):"
+                  .format(tag, len(lat))] + format_histogram(lat))
+
+class RenderBenchmark(Benchmark):
+    """Measure page.render throughput over a matrix of fixture pages
+       (lib/www/bench) and output formats, using benchmarks/render.js.
+
+       Parameters:
+         iterations  renders per case, after the page has loaded (5)
+         pages       comma-separated subset of: text, images, large
+         formats     comma-separated subset of: png, jpg, gif, pdf
+         timeout     seconds allowed for the whole matrix (300)
+         validate    'yes' to check that every raster render of a
+                     case matches the first one, which needs NumPy
+                     and Pillow (no)
+         tolerance   with validate, how far a pixel may be off in
+                     any channel (0)
+    """
+    PAGES = collections.OrderedDict((
+        ("text",   ("bench/text.html",   {"width": 1024, "height": 768})),
+        ("images", ("bench/images.html", {"width": 1024, "height": 768})),
+        ("large",  ("bench/text.html",   {"width": 1920, "height": 6000})),
+    ))
+
+    # format, JPEG quality, zoom factor, PDF paper size
+    VARIANTS = [
+        ("png", None, 1, None),
+        ("png", None, 2, None),
+        ("jpg", None, 1, None),
+        ("jpg", 50,   1, None),
+        ("gif", None, 1, None),
+        ("pdf", None, 1, {"format": "A4", "orientation": "portrait",
+                          "margin": "1cm"}),
+        ("pdf", None, 1, {"format": "Letter", "orientation": "landscape",
+                          "margin": "1cm"}),
+    ]
+
+    def cases(self):
+        iterations = self.param("iterations", 5)
+        pages      = self.param("pages", list(self.PAGES))
+        formats    = self.param("formats", ["png", "jpg", "gif", "pdf"])
+        validate   = self.param("validate", "no", ("yes", "no")) == "yes"
+
+        for page in pages:
+            url, viewport = self.PAGES[page]
+            for fmt, quality, zoom, paper in self.VARIANTS:
+                if fmt not in formats:
+                    continue
+                label = [page, fmt]
+                if quality: label.append("q={}".format(quality))
+                if zoom != 1: label.append("zoom={}".format(zoom))
+                if paper:
+                    label.extend((paper["format"], paper["orientation"]))
+                yield " ".join(label), dict(url=url, viewport=viewport,
+                                            format=fmt, quality=quality,
+                                            zoom=zoom, paperSize=paper,
+                                            iterations=iterations,
+                                            keep=validate and fmt != "pdf")
+
+    def run(self, grp):
+        labels, cases = zip(*self.cases())
+        if any(c["keep"] for c in cases) and numpy is None:
+            raise RuntimeError("validate=yes needs NumPy and Pillow")
+        scratch = tempfile.mkdtemp(prefix="pjs-render-")
+        try:
+            case_file = os.path.join(scratch, "cases.json")
+            with open(case_file, "wt") as f:
+                json.dump(cases, f)
+            results = self.run_script(grp, "render.js", [case_file, scratch],
+                                      timeout=self.param("timeout", 300.0))
+            self.validate(grp, labels, results)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        for r in results:
+            label = labels[r["index"]]
+            if r["status"] != "success":
+                grp.add_error([], "{}: page load {}".format(label, r["status"]))
+                continue
+            times = r["times"]
+            grp.record("ms/render ({})".format(label),
+                       percentile(times, 50), "ms", higher_is_better=False)
+            grp.record("bytes ({})".format(label),
+                       r["bytes"], "bytes", higher_is_better=False)
+            grp.note("{}: min {} / median {} / max {} ms over {} renders"
+                     .format(label, min(times), percentile(times, 50),
+                             max(times), len(times)))
+
+    def validate(self, grp, labels, results):
+        """Compare each render kept by render.js with the first render
+           of the same case, since the page does not change between
+           them, and note how long the comparisons took."""
+        tolerance = self.param("tolerance", 0.0)
+        count, t0 = 0, time.time()
+        for r in results:
+            files = r.get("files")
+            if not files:
+                continue
+            label = labels[r["index"]]
+            first = load_image(files[0])
+            for n, path in enumerate(files[1:], 1):
+                image = load_image(path)
+                count += 1
+                if image.shape != first.shape:
+                    grp.add_fail([], "{}: render {} is not the size of"
+                                 " render 0".format(label, n))
+                    continue
+                d, _ = compare_images(image, first, tolerance)
+                if d.bad_fraction > 0:
+                    grp.add_fail([format_image_diff(d, tolerance)],
+                                 "{}: render {} differs from render 0"
+                                 .format(label, n))
+        if count:
+            elapsed = time.time() - t0
+            grp.note("validated {} renders in {:.2f} s ({:.1f} ms each)"
+                     .format(count, elapsed, elapsed * 1000 / count))
+
+class MultipageBenchmark(Benchmark):
+    """Measure how page-load throughput and memory scale with the
+       number of webpage objects loading concurrently in one PhantomJS
+       process, using benchmarks/multipage.js.  Each concurrency level
+       gets a fresh process.  The CPU time the test server spends per
+       MiB served is also recorded.
+
+       Parameters:
+         concurrency  comma-separated page counts (1,2,4,8,16,32,64)
+         pages        pages loaded per concurrency level (128)
+         url          page to load, relative to the test server
+                      (hello.html); a distinct query is appended
+         timeout      seconds allowed per concurrency level (120)
+    """
+    def run(self, grp):
+        levels  = self.param("concurrency", [1, 2, 4, 8, 16, 32, 64])
+        total   = self.param("pages", 128)
+        url     = self.param("url", "hello.html")
+        timeout = self.param("timeout", 120.0)
+
+        curve = ["{:>11} {:>10} {:>8} {:>8} {:>8} {:>10}".format(
+            "concurrency", "pages/sec", "p50 ms", "p95 ms", "p99 ms",
+            "peak RSS")]
+        stats = self.runner.request_stats
+        for c in levels:
+            cpu0 = self.runner.server.cpu_time()
+            bytes0 = stats.collect(self.env["TEST_ID"])["bytes"]
+            with self.spawn("multipage.js", [str(c), str(total), url]) as pjs:
+                m = pjs.wait_for(r"^RESULT (.*)$", timeout)
+                peak = read_proc_status(pjs.pid, "VmHWM")
+            r = json.loads(m.group(1))
+            cpu1 = self.runner.server.cpu_time()
+            served = stats.collect(self.env["TEST_ID"])["bytes"] - bytes0
+
+            tag = "c={}".format(c)
+            if r["failed"]:
+                grp.add_fail([], "{}: {} of {} pages failed to load"
+                             .format(tag, r["failed"], total))
+            rate = total * 1000.0 / max(r["elapsed"], 1)
+            grp.record("pages/sec ({})".format(tag), rate, "pages/s")
+            grp.record("p95 onLoadFinished ({})".format(tag),
+                       percentile(r["times"], 95), "ms",
+                       higher_is_better=False)
+            if peak is not None:
+                grp.record("peak RSS ({})".format(tag),
+                           peak / 1048576.0, "MiB", higher_is_better=False)
+            if cpu0 is not None and cpu1 is not None and served > 0:
+                grp.record("server CPU per MiB ({})".format(tag),
+                           (cpu1 - cpu0) * 1000 / (served / 1048576.0),
+                           "ms", higher_is_better=False)
+            curve.append("{:>11} {:>10.1f} {:>8} {:>8} {:>8} {:>10}".format(
+                c, rate, percentile(r["times"], 50),
+                percentile(r["times"], 95), percentile(r["times"], 99),
+                "{:.1f} MiB".format(peak / 1048576.0) if peak else "n/a"))
+
+        grp.note(["scaling curve ({} pages of {}):".format(total, url)]
+                 + curve)
+
+class StartupBenchmark(Benchmark):
+    """Measure PhantomJS cold-start time (benchmarks/startup.js):
+       '--version', an empty script, a script requiring each core
+       module, and a script creating one webpage, each run many times.
+       The wall-clock times are broken down, using timestamps taken by
+       the script itself, into process start-up (exec and Qt
+       initialization, approximated by '--version'), JS bootstrap
+       (until the controller script starts running), and the time
+       spent in each require() and in the first webpage.create().
+
+       Parameters:
+         runs     process launches per scenario (20)
+         modules  comma-separated core modules to require
+                  (fs,system,webpage,webserver,child_process,cookiejar)
+    """
+    def time_launch(self, grp, label, script_args):
+        if script_args is None:
+            command = [self.runner.phantomjs_exe, "--version"]
+        else:
+            command = [self.runner.phantomjs_exe,
+                       self.runner.bench_script("startup.js")] + script_args
+
+        t0 = time.time()
+        rc, out, err = do_call_subprocess(command, self.runner.verbose,
+                                          [], TIMEOUT, self.env)
+        wall = (time.time() - t0) * 1000
+        if rc != 0 or err:
+            grp.add_error(err, "{}: exited with code {}".format(label, rc))
+            return wall, None
+
+        for line in out:
+            if line.startswith("RESULT "):
+                r = json.loads(line[len("RESULT "):])
+                r["start"] -= t0 * 1000
+                return wall, r
+        return wall, None
+
+    def run(self, grp):
+        runs    = self.param("runs", 20)
+        modules = self.param("modules", ["fs", "system", "webpage",
+                                         "webserver", "child_process",
+                                         "cookiejar"])
+
+        scenarios = [("--version", None), ("empty script", [])]
+        scenarios.extend(("require " + m, [m]) for m in modules)
+        scenarios.append(("first page", ["page"]))
+
+        walls  = collections.OrderedDict()
+        starts = collections.defaultdict(list)
+        steps  = collections.OrderedDict()
+        for label, script_args in scenarios:
+            walls[label] = []
+            for _ in range(runs):
+                wall, r = self.time_launch(grp, label, script_args)
+                walls[label].append(wall)
+                if r is None:
+                    continue
+                starts[label].append(r["start"])
+                for name in (script_args or []):
+                    if name in r["steps"]:
+                        steps.setdefault(name, []).append(r["steps"][name])
+
+        for label, samples in walls.items():
+            grp.record("wall ms ({})".format(label), percentile(samples, 50),
+                       "ms", higher_is_better=False)
+            grp.note("{:<22} min {:8.1f}  p50 {:8.1f}  p90 {:8.1f}"
+                     "  max {:8.1f} ms".format(label, min(samples),
+                                               percentile(samples, 50),
+                                               percentile(samples, 90),
+                                               max(samples)))
+
+        exec_ms = percentile(walls["--version"], 50)
+        script_start = percentile(starts["empty script"], 50)
+        breakdown = ["breakdown (medians):",
+                     "  {:<26} {:8.1f} ms".format("process exec + Qt init:",
+                                                  exec_ms)]
+        if script_start is not None:
+            bootstrap = max(script_start - exec_ms, 0)
+            grp.record("JS bootstrap", bootstrap, "ms",
+                       higher_is_better=False)
+            breakdown.append("  {:<26} {:8.1f} ms".format("JS bootstrap:",
+                                                          bootstrap))
+        for name, samples in steps.items():
+            label = ("first webpage.create()" if name == "page"
+                     else "require('{}')".format(name))
+            grp.record(label, percentile(samples, 50), "ms",
+                       higher_is_better=False)
+            breakdown.append("  {:<26} {:8.1f} ms".format(
+                label + ":", percentile(samples, 50)))
+        grp.note(breakdown)
+
+class DiskCacheBenchmark(Benchmark):
+    """Measure disk-cache effectiveness with the cache-control aware
+       resources of lib/www/cache.py.  For each cache size and caching
+       mode, a page of N resources is loaded several times, each time
+       by a fresh PhantomJS process sharing one --disk-cache-path, and
+       the server's per-resource request counts are compared.  A warm
+       load's hit ratio is the fraction of resources that did not need
+       a full fetch (304 revalidations count as hits).
+
+       With an unlimited cache, the expected behavior is also checked:
+       max-age and expires resources are not requested at all when
+       warm, etag and last-modified ones are only revalidated, and
+       no-store ones are always fetched in full.
+
+       Parameters:
+         cache_sizes  comma-separated --max-disk-cache-size values in
+                      KB; 0 means no limit (0,1024,64)
+         modes        comma-separated cache.py modes (all of them)
+         resources    resources per page (50)
+         size         bytes per resource (8192)
+         loads        loads per configuration, the first one cold (3)
+    """
+    MODES = ["max-age", "expires", "etag", "last-modified", "no-store"]
+
+    def run(self, grp):
+        sizes     = self.param("cache_sizes", [0, 1024, 64])
+        modes     = self.param("modes", self.MODES)
+        resources = self.param("resources", 50)
+        size      = self.param("size", 8192)
+        loads     = self.param("loads", 3)
+
+        table = ["{:<28} {:>5} {:>6} {:>6} {:>8}".format(
+            "configuration", "load", "full", "304", "ms")]
+        for kb in sizes:
+            for mode in modes:
+                self.run_one(grp, table, kb, mode, resources, size, loads)
+        grp.note(table)
+
+    def run_one(self, grp, table, kb, mode, n, size, loads):
+        tag = "{}, {}".format(mode, "{} KB".format(kb) if kb else "unlimited")
+        run = "{}-{}-{:.0f}".format(mode, kb, time.time() * 1000)
+        url = ("cache?kind=page&mode={}&n={}&size={}&run={}"
+               .format(mode, n, size, run))
+
+        cache_dir = tempfile.mkdtemp(prefix="pjs-cache-")
+        pjs_args = ["--disk-cache=true", "--disk-cache-path=" + cache_dir]
+        if kb:
+            pjs_args.append("--max-disk-cache-size={}".format(kb))
+
+        seen = {"full": 0, "revalidated": 0}
+        warm = {"full": 0, "revalidated": 0}
+        warm_ms = []
+        try:
+            for i in range(loads):
+                results = self.run_script(grp, "cache.js", [url], pjs_args)
+                if not results or results[0]["status"] != "success":
+                    grp.add_error([], "{}: load {} failed".format(tag, i))
+                    return
+                r = results[0]
+                if r["loaded"] != n:
+                    grp.add_fail([], "{}: load {} ran {} of {} resources"
+                                 .format(tag, i, r["loaded"], n))
+
+                stats = self.server_get_json("cache?kind=stats&run=" + run)
+                now = {"full": 0, "revalidated": 0}
+                for c in stats.values():
+                    now["full"] += c["full"]
+                    now["revalidated"] += c["revalidated"]
+                delta = dict((k, now[k] - seen[k]) for k in now)
+                seen = now
+
+                table.append("{:<28} {:>5} {:>6} {:>6} {:>8}".format(
+                    tag, "cold" if i == 0 else i, delta["full"],
+                    delta["revalidated"], r["ms"]))
+                if i > 0:
+                    warm_ms.append(r["ms"])
+                    for k in warm: warm[k] += delta[k]
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        if not warm_ms:
+            return
+        requested = n * len(warm_ms)
+        grp.record("hit ratio ({})".format(tag),
+                   1.0 - float(warm["full"]) / requested, "")
+        grp.record("warm load ms ({})".format(tag),
+                   percentile(warm_ms, 50), "ms", higher_is_better=False)
+
+        if kb:
+            return
+        if mode in ("max-age", "expires"):
+            expected = {"full": 0, "revalidated": 0}
+        elif mode in ("etag", "last-modified"):
+            expected = {"full": 0, "revalidated": requested}
+        else:
+            expected = {"full": requested, "revalidated": 0}
+        if warm != expected:
+            grp.add_fail(["expected {full} full fetches and {revalidated}"
+                          " revalidations".format(**expected),
+                          "got {full} and {revalidated}".format(**warm)],
+                         "{}: warm loads not served as expected".format(tag))
+
+class FsBenchmark(Benchmark):
+    """Measure the 'fs' module on large files and directory trees,
+       using benchmarks/fs.js: streaming reads and writes by chunk
+       size, mode (text or binary) and charset, line-by-line reads,
+       copy, and copyTree/list/removeTree over a tree of small files.
+       The fixtures are generated into a scratch directory.  Where
+       /proc/PID/io is available, the read and write system calls made
+       by each operation are recorded too.
+
+       Parameters:
+         size_mb      size of the read fixtures, and of each file
+                      written, in MiB (32)
+         chunks       comma-separated chunk sizes in bytes
+                      (4096,65536,1048576)
+         modes        comma-separated subset of: text, binary
+         charsets     comma-separated charsets for text mode
+                      (UTF-8,ISO-8859-1)
+         tree_depth   depth of the directory tree (3)
+         tree_fanout  subdirectories per directory (4)
+         tree_files   files per directory (8)
+         timeout      seconds allowed for the whole run (600)
+    """
+    TEXT_LINE = u"The na\u00efve caf\u00e9 served cr\u00e8me br\u00fbl\u00e9e.\n"
+
+    def run(self, grp):
+        size     = int(self.param("size_mb", 32.0) * 1048576)
+        chunks   = self.param("chunks", [4096, 65536, 1048576])
+        modes    = self.param("modes", ["text", "binary"])
+        charsets = self.param("charsets", ["UTF-8", "ISO-8859-1"])
+        depth    = self.param("tree_depth", 3)
+        fanout   = self.param("tree_fanout", 4)
+        files    = self.param("tree_files", 8)
+        timeout  = self.param("timeout", 600.0)
+
+        scratch = tempfile.mkdtemp(prefix="pjs-fs-")
+        try:
+            self.make_fixtures(scratch, size, depth, fanout, files)
+            config = dict(chunks=chunks, modes=modes, charsets=charsets,
+                          size=size)
+            results = self.run_script(grp, "fs.js",
+                                      [scratch, json.dumps(config)],
+                                      timeout=timeout)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        table = ["{:<36} {:>10} {:>10} {:>10}".format(
+            "operation", "MB/s", "reads", "writes")]
+        for r in results:
+            tag = self.describe(r)
+            ms = max(r["ms"], 1)
+            if "bytes" in r:
+                rate = r["bytes"] / 1048576.0 / (ms / 1000.0)
+                grp.record("{} MB/s".format(tag), rate, "MB/s")
+                rate = "{:.1f}".format(rate)
+            elif "entries" in r:
+                grp.record("{} entries/s".format(tag),
+                           r["entries"] / (ms / 1000.0), "entries/s")
+                rate = "-"
+            else:
+                grp.record("{} ms".format(tag), r["ms"], "ms",
+                           higher_is_better=False)
+                rate = "-"
+            if "syscr" in r:
+                grp.record("{} syscalls".format(tag),
+                           r["syscr"] + r["syscw"], "",
+                           higher_is_better=False)
+            table.append("{:<36} {:>10} {:>10} {:>10}".format(
+                tag, rate, r.get("syscr", "n/a"), r.get("syscw", "n/a")))
+        grp.note(["fs operations ({:.0f} MiB files):"
+                  .format(size / 1048576.0)] + table)
+
+    @staticmethod
+    def describe(r):
+        parts = [r.get(k) for k in ("mode", "charset")]
+        if r.get("chunk"):
+            parts.append(format_size(r["chunk"]))
+        parts = [p for p in parts if p]
+        return r["op"] + (" ({})".format(", ".join(parts)) if parts else "")
+
+    def make_fixtures(self, scratch, size, depth, fanout, files):
+        line = self.TEXT_LINE.encode("utf-8")
+        with open(os.path.join(scratch, "text.txt"), "wb") as f:
+            block = line * (65536 // len(line))
+            for _ in range(size // len(block) + 1):
+                f.write(block)
+        with open(os.path.join(scratch, "binary.bin"), "wb") as f:
+            for _ in range(size // 1048576 + 1):
+                f.write(os.urandom(1048576))
+
+        def tree(path, level):
+            os.mkdir(path)
+            for i in range(files):
+                with open(os.path.join(path, "f{}.txt".format(i)), "wb") as f:
+                    f.write(line * 32)
+            if level < depth:
+                for i in range(fanout):
+                    tree(os.path.join(path, "d{}".format(i)), level + 1)
+        tree(os.path.join(scratch, "tree"), 0)
+
+class ChildProcessBenchmark(Benchmark):
+    """Measure the 'child_process' module, using
+       benchmarks/child_process.js: the latency of spawning a trivial
+       command, spawns/sec with several children in flight, and
+       throughput streaming data from a child's stdout, into its stdin,
+       and through it both ways (lib/fixtures/stream.py), by chunk
+       size.  The number of stdout 'data' events is reported too,
+       since the per-event cost of the signal bridge is what small
+       chunks expose.
+
+       Parameters:
+         spawns       spawns per latency and concurrency case (50)
+         concurrency  comma-separated children in flight (1,4,16)
+         size_mb      MiB streamed per streaming case (16)
+         chunks       comma-separated chunk sizes in bytes, for the
+                      child's writes and for stdin.write
+                      (1024,65536,1048576)
+         timeout      seconds allowed for the whole run (600)
+    """
+    def run(self, grp):
+        spawns      = self.param("spawns", 50)
+        concurrency = self.param("concurrency", [1, 4, 16])
+        size        = int(self.param("size_mb", 16.0) * 1048576)
+        chunks      = self.param("chunks", [1024, 65536, 1048576])
+        timeout     = self.param("timeout", 600.0)
+
+        fixtures = os.path.join(self.runner.base_path, "lib", "fixtures")
+        if os.path.exists("/bin/true"):
+            cmd = ["/bin/true"]
+        else:
+            cmd = [sys.executable, os.path.join(fixtures, "echo.py")]
+        config = dict(cmd=cmd, python=sys.executable,
+                      stream=os.path.join(fixtures, "stream.py"),
+                      spawns=spawns, concurrency=concurrency,
+                      bytes=size, chunks=chunks)
+        results = self.run_script(grp, "child_process.js",
+                                  [json.dumps(config)], timeout=timeout)
+
+        table = ["{:<22} {:>10} {:>10} {:>12}".format(
+            "case", "MB/s", "events", "us/event")]
+        for r in results:
+            if r.get("failed"):
+                grp.add_fail([], "{}: {} spawns failed".format(r["op"],
+                                                               r["failed"]))
+            if r["op"] == "spawn":
+                grp.record("spawn latency p50", percentile(r["times"], 50),
+                           "ms", higher_is_better=False)
+                grp.record("spawn latency p95", percentile(r["times"], 95),
+                           "ms", higher_is_better=False)
+                grp.note(["spawn latency ({}):".format(" ".join(cmd))] +
+                         format_histogram(r["times"]))
+                continue
+            if r["op"] == "concurrent":
+                grp.record("spawns/sec (c={})".format(r["concurrency"]),
+                           r["spawns"] * 1000.0 / max(r["ms"], 1), "spawns/s")
+                continue
+
+            tag = "{} ({} chunks)".format(r["op"], format_size(r["chunk"]))
+            if r["code"] != 0 or r["bytes"] != r["expected"]:
+                grp.add_fail(["exit code {}, {} of {} bytes".format(
+                    r["code"], r["bytes"], r["expected"])], tag)
+                continue
+            rate = r["bytes"] / 1048576.0 / (max(r["ms"], 1) / 1000.0)
+            grp.record("{} MB/s".format(tag), rate, "MB/s")
+            per_event = ""
+            if r.get("events"):
+                per_event = r["ms"] * 1000.0 / r["events"]
+                grp.record("{} us/event".format(tag), per_event, "us",
+                           higher_is_better=False)
+                per_event = "{:.1f}".format(per_event)
+            table.append("{:<22} {:>10.1f} {:>10} {:>12}".format(
+                tag, rate, r.get("events", ""), per_event))
+        grp.note(["streaming ({:.0f} MiB per case):"
+                  .format(size / 1048576.0)] + table)
+
+class CookieJarBenchmark(Benchmark):
+    """Measure the cookie jar as it grows, using benchmarks/cookies.js
+       and lib/www/cookies.py.  One PhantomJS process, with a
+       --cookies-file, loads pages that each set a batch of persistent
+       cookies until the jar reaches each checkpoint size; at each
+       checkpoint the time per cookie-setting load, the time per plain
+       load (cookie lookup only) and RSS are recorded.  Then the size
+       of the cookies file and the time a fresh process takes to load
+       it at startup (compared with an empty jar) are recorded, and
+       the number of cookies it loads is checked.
+
+       The cookies are spread over many paths rather than hostnames,
+       since the test server is only reachable as localhost.
+
+       Parameters:
+         checkpoints   comma-separated jar sizes (1000,5000,20000)
+         per_response  cookies set per page load (100)
+         probes        plain page loads per checkpoint (20)
+         loads         process launches per startup measurement (5)
+         timeout       seconds allowed for growing the jar (600)
+    """
+    def run(self, grp):
+        checkpoints  = self.param("checkpoints", [1000, 5000, 20000])
+        per_response = self.param("per_response", 100)
+        probes       = self.param("probes", 20)
+        loads        = self.param("loads", 5)
+        timeout      = self.param("timeout", 600.0)
+
+        scratch = tempfile.mkdtemp(prefix="pjs-cookies-")
+        try:
+            jar = os.path.join(scratch, "cookies.txt")
+            results = self.run_script(
+                grp, "cookies.js",
+                ["grow", str(per_response), str(probes)] +
+                [str(c) for c in checkpoints],
+                ["--cookies-file=" + jar], timeout)
+
+            table = ["{:>8} {:>12} {:>12} {:>10}".format(
+                "cookies", "set ms/req", "get ms/req", "RSS")]
+            for r in results:
+                tag = "n={}".format(r["target"])
+                if r["set_ms"] is not None:
+                    grp.record("cookie-setting load ({})".format(tag),
+                               r["set_ms"], "ms", higher_is_better=False)
+                if r["get_ms"] is not None:
+                    grp.record("plain load ({})".format(tag),
+                               r["get_ms"], "ms", higher_is_better=False)
+                if r["rss"] is not None:
+                    grp.record("RSS ({})".format(tag),
+                               r["rss"] / 1048576.0, "MiB",
+                               higher_is_better=False)
+                table.append("{:>8} {:>12} {:>12} {:>10}".format(
+                    r["cookies"],
+                    "{:.1f}".format(r["set_ms"]) if r["set_ms"] else "-",
+                    "{:.1f}".format(r["get_ms"]) if r["get_ms"] else "-",
+                    "{:.1f} MiB".format(r["rss"] / 1048576.0)
+                    if r["rss"] else "n/a"))
+            grp.note(["jar growth ({} cookies per load):"
+                      .format(per_response)] + table)
+            if not results or not os.path.exists(jar):
+                grp.add_error([], "cookies.js did not produce a cookies file")
+                return
+
+            saved = results[-1]["cookies"]
+            grp.record("cookies file size (n={})".format(saved),
+                       os.path.getsize(jar) / 1024.0, "KiB",
+                       higher_is_better=False)
+
+            full, n = self.time_count(grp, jar, loads)
+            empty, _ = self.time_count(grp, os.path.join(scratch, "none.txt"),
+                                       loads)
+            if n != saved:
+                grp.add_fail(["saved {}, loaded {}".format(saved, n)],
+                             "cookies file did not round-trip")
+            if full is not None and empty is not None:
+                grp.record("cookies file load (n={})".format(saved),
+                           max(full - empty, 0), "ms",
+                           higher_is_better=False)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def time_count(self, grp, jar, loads):
+        """Launch cookies.js 'count' LOADS times with --cookies-file=JAR.
+           Returns the median wall-clock time in ms and the number of
+           cookies loaded."""
+        times, count = [], None
+        for _ in range(loads):
+            t0 = time.time()
+            results = self.run_script(grp, "cookies.js", ["count"],
+                                      ["--cookies-file=" + jar])
+            times.append((time.time() - t0) * 1000)
+            if results:
+                count = results[0]["cookies"]
+        return percentile(times, 50), count
+
+class SoakBenchmark(Benchmark):
+    """Look for memory leaks over many page lifetimes, as in a
+       long-running render daemon, using benchmarks/soak.js.  Each
+       scenario (create a webpage, load a fixture, do something with
+       it, close the page) is repeated many times in one PhantomJS
+       process, while the runner samples the process's RSS from
+       /proc/PID/status.  A least-squares line is fitted to the
+       samples taken after a warm-up period, and a scenario fails if
+       RSS grows by more than max_growth bytes per iteration.
+
+       Parameters:
+         scenarios   comma-separated, from open, render, evaluate,
+                     cookies, iframes (all of them)
+         iterations  iterations per scenario (2000)
+         samples     RSS samples per scenario (50)
+         warmup      fraction of the iterations left out of the fit
+                     (0.25)
+         max_growth  allowed RSS growth in bytes per iteration (1024)
+         timeout     seconds allowed per scenario (1800)
+    """
+    def run(self, grp):
+        scenarios  = self.param("scenarios", ["open", "render", "evaluate",
+                                              "cookies", "iframes"])
+        iterations = self.param("iterations", 2000)
+        samples    = self.param("samples", 50)
+        warmup     = self.param("warmup", 0.25)
+        max_growth = self.param("max_growth", 1024.0)
+        timeout    = self.param("timeout", 1800.0)
+
+        every = max(iterations // max(samples, 1), 1)
+        table = ["{:<10} {:>8} {:>10} {:>10} {:>11}".format(
+            "scenario", "ms/iter", "RSS first", "RSS last", "bytes/iter")]
+        for scenario in scenarios:
+            points, ms = self.soak(grp, scenario, iterations, every, timeout)
+            if points is None:
+                continue
+            fit = [(i, rss) for i, rss in points if i >= iterations * warmup]
+            if len(fit) < 2:
+                grp.add_error(["only {} RSS samples after warm-up"
+                               .format(len(fit))], scenario)
+                continue
+
+            slope, _ = linear_fit(*zip(*fit))
+            first, last = fit[0][1], fit[-1][1]
+            grp.record("{} ms/iteration".format(scenario),
+                       ms / iterations, "ms", higher_is_better=False)
+            grp.record("{} RSS growth".format(scenario),
+                       slope, "B/iter", higher_is_better=False)
+            grp.record("{} RSS after {} iterations".format(
+                scenario, points[-1][0]), points[-1][1] / 1048576.0,
+                       "MiB", higher_is_better=False)
+            if slope > max_growth:
+                grp.add_fail(["RSS grew {:.0f} bytes per iteration over"
+                              " iterations {} to {} (limit {:.0f}),"
+                              " from {:.1f} to {:.1f} MiB".format(
+                                  slope, fit[0][0], fit[-1][0], max_growth,
+                                  first / 1048576.0, last / 1048576.0)],
+                             "{} leaks memory".format(scenario))
+            table.append("{:<10} {:>8.2f} {:>6.1f} MiB {:>6.1f} MiB {:>11.0f}"
+                         .format(scenario, ms / iterations,
+                                 first / 1048576.0, last / 1048576.0, slope))
+        grp.note(["RSS growth over {} iterations, fitted after the first"
+                  " {:.0f}%:".format(iterations, warmup * 100)] + table)
+
+    def soak(self, grp, scenario, iterations, every, timeout):
+        """Run SCENARIO in soak.js, reading the RSS of PhantomJS at each
+           sample it reports.  Returns ([(iterations done, RSS), ...],
+           elapsed ms), or (None, None) after recording an error."""
+        points = []
+        deadline = time.time() + timeout
+        with self.spawn("soak.js", [scenario, str(iterations),
+                                    str(every)]) as pjs:
+            try:
+                while True:
+                    m = pjs.wait_for(r'^(SAMPLE|DONE|FAIL) (.*)$',
+                                     deadline - time.time())
+                    if m.group(1) == "FAIL":
+                        raise RuntimeError(m.group(0))
+                    if m.group(1) == "DONE":
+                        return points, float(m.group(2))
+                    rss = read_proc_status(pjs.pid, "VmRSS")
+                    if rss is None:
+                        raise RuntimeError("cannot read the RSS of PhantomJS"
+                                           " from /proc")
+                    points.append((int(m.group(2)), rss))
+            except RuntimeError as e:
+                grp.add_error(str(e).split("\n")[-20:], scenario)
+                return None, None
+
+class StdioBenchmark(Benchmark):
+    """Measure the throughput of PhantomJS's standard streams, using
+       benchmarks/stdio.js: reading standard input line by line with
+       system.stdin.readLine and in blocks with system.stdin.read, and
+       writing blocks to system.stdout and system.stderr.  The runner
+       feeds and drains the pipes, checks that every byte arrived, and
+       records MB/s and the time per call for each case.
+
+       Parameters:
+         size_mb  data per case, in 80-character lines (16)
+         chunks   comma-separated block sizes for read and write
+                  (1024,65536,1048576)
+         timeout  seconds allowed per case (300)
+    """
+    LINE = 80
+
+    def run(self, grp):
+        size    = int(self.param("size_mb", 16.0) * 1048576)
+        chunks  = self.param("chunks", [1024, 65536, 1048576])
+        timeout = self.param("timeout", 300.0)
+        size -= size % self.LINE
+
+        cases = ([("stdin", "readLine", None)] +
+                 [("stdin", "read", c) for c in chunks] +
+                 [(stream, "write", c) for stream in ("stdout", "stderr")
+                  for c in chunks])
+        table = ["{:<28} {:>8} {:>10} {:>10}".format(
+            "case", "MB/s", "calls", "us/call")]
+        for stream, op, chunk in cases:
+            label = "{} {}".format(stream, op)
+            if chunk is not None:
+                label += " ({} blocks)".format(format_size(chunk))
+            r = self.run_case(grp, label, stream, op, chunk, size, timeout)
+            if r is None:
+                continue
+            rate = size / 1048576.0 / (max(r["ms"], 1) / 1000.0)
+            per_call = r["ms"] * 1000.0 / max(r["calls"], 1)
+            grp.record("{} MB/s".format(label), rate, "MB/s")
+            table.append("{:<28} {:>8.1f} {:>10} {:>10.2f}".format(
+                label, rate, r["calls"], per_call))
+        grp.note(["{:.0f} MiB per case:".format(size / 1048576.0)] + table)
+
+    def run_case(self, grp, label, stream, op, chunk, size, timeout):
+        """Run one case of stdio.js, and return its RESULT, or None
+           after recording a failure or error."""
+        results = []
+        received = {"stdout": 0, "stderr": 0}
+        messages = collections.deque(maxlen=20)
+
+        # Output is counted as it arrives rather than collected; only
+        # the last few lines that are not data are kept, for errors.
+        def watch(what, line):
+            if what == "stdout" and line.startswith("RESULT "):
+                results.append(json.loads(line[len("RESULT "):]))
+            else:
+                received[what] += len(line) + 1
+                if line.strip("x"):
+                    messages.append(line)
+            return True
+
+        if stream == "stdin":
+            args = [op] + ([str(chunk)] if chunk else [])
+            stdin_data = text_blocks(size, self.LINE)
+        else:
+            args = [op, stream, str(chunk), str(size)]
+            stdin_data = []
+        rc, _, _ = self.runner.run_bench_script("stdio.js", args, [],
+                                                timeout, self.env,
+                                                stdin_data, watch)
+        if rc != 0 or not results:
+            grp.add_error(["stdio.js exited with code {}".format(rc)] +
+                          list(messages), label)
+            return None
+
+        r = results[0]
+        got = r["bytes"] if stream == "stdin" else received[stream]
+        stray = sum(n for s, n in received.items() if s != stream)
+        if got != size or stray:
+            grp.add_fail(["{} of {} bytes transferred, {} bytes of other"
+                          " output".format(got, size, stray)], label)
+            return None
+        return r
+
+class ProxyBenchmark(Benchmark):
+    """Measure page loads through a forward proxy, and how many
+       connections PhantomJS opens to it, using benchmarks/multipage.js
+       with --proxy pointing at a ProxyServer in front of the test
+       servers.  Each case loads pages over http: or https: (through a
+       CONNECT or SOCKS tunnel) with several pages in flight, in a
+       fresh PhantomJS process, and records pages/sec and the client
+       and upstream connections the proxy saw.
+
+       Parameters:
+         proxies      comma-separated proxy kinds (http,socks5)
+         schemes      comma-separated URL schemes (http,https)
+         concurrency  comma-separated page counts (1,8)
+         pages        pages loaded per case (128)
+         url          page to load, relative to the test servers
+                      (hello.html)
+         auth         require proxy credentials: 'yes', 'no' or
+                      'both' (no)
+         timeout      seconds allowed per case (120)
+    """
+    CREDENTIALS = "phantom:proxy-secret"
+
+    def run(self, grp):
+        kinds   = self.param("proxies", ["http", "socks5"])
+        schemes = self.param("schemes", ["http", "https"])
+        levels  = self.param("concurrency", [1, 8])
+        total   = self.param("pages", 128)
+        url     = self.param("url", "hello.html")
+        auth    = self.param("auth", "no", ("yes", "no", "both"))
+        timeout = self.param("timeout", 120.0)
+
+        modes = {"yes": [True], "no": [False], "both": [False, True]}
+        table = ["{:<32} {:>9} {:>8} {:>9} {:>9} {:>8}".format(
+            "case", "pages/sec", "conns", "upstream", "requests", "tunnels")]
+        for use_auth in modes[auth]:
+            credentials = self.CREDENTIALS if use_auth else None
+            for kind in kinds:
+                proxy = self.runner.server.proxy_server(kind, credentials)
+                proxy.start()
+                try:
+                    for scheme in schemes:
+                        for c in levels:
+                            row = self.run_one(grp, proxy, scheme, c, total,
+                                               url, timeout)
+                            if row is not None:
+                                table.append(row)
+                finally:
+                    proxy.stop()
+        grp.note(["{} pages of {} per case:".format(total, url)] + table)
+
+    def proxy_counts(self, kind):
+        stats = self.runner.request_stats.collect(self.env["TEST_ID"])
+        return stats.get("proxy", {}).get(kind, {})
+
+    def run_one(self, grp, proxy, scheme, c, total, url, timeout):
+        """Run one case and return its row of the summary table, or
+           None if it produced no result."""
+        tag = "{}, {}, c={}{}".format(proxy.kind, scheme, c,
+                                      ", auth" if proxy.credentials else "")
+        pjs_args = ["--proxy=localhost:{}".format(proxy.server_address[1]),
+                    "--proxy-type=" + proxy.kind]
+        if proxy.credentials:
+            pjs_args.append("--proxy-auth=" + proxy.credentials)
+        env = dict(self.env)
+        if scheme == "https":
+            # multipage.js loads pages from TEST_HTTP_BASE.
+            env["TEST_HTTP_BASE"] = env["TEST_HTTPS_BASE"]
+            pjs_args.append("--ssl-certificates-path=" + self.runner.cert_path)
+
+        before = self.proxy_counts(proxy.kind)
+        script = self.runner.bench_script("multipage.js")
+        try:
+            with self.runner.spawn_phantomjs(script, [str(c), str(total), url],
+                                             pjs_args, env) as pjs:
+                m = pjs.wait_for(r"^RESULT (.*)$", timeout)
+        except RuntimeError as e:
+            grp.add_error(str(e).split("\n")[-20:], tag)
+            return None
+        r = json.loads(m.group(1))
+        after = self.proxy_counts(proxy.kind)
+        delta = dict((what, n - before.get(what, 0))
+                     for what, n in after.items())
+
+        if r["failed"]:
+            grp.add_fail([], "{}: {} of {} pages failed to load"
+                         .format(tag, r["failed"], total))
+        if not delta.get("connections"):
+            grp.add_fail([], "{}: no connections through the proxy"
+                         .format(tag))
+            return None
+        rate = total * 1000.0 / max(r["elapsed"], 1)
+        grp.record("pages/sec ({})".format(tag), rate, "pages/s")
+        grp.record("proxy connections ({})".format(tag),
+                   delta["connections"], "conns", higher_is_better=False)
+        grp.record("upstream connections ({})".format(tag),
+                   delta.get("upstream_connections", 0), "conns",
+                   higher_is_better=False)
+        return "{:<32} {:>9.1f} {:>8} {:>9} {:>9} {:>8}".format(
+            tag, rate, delta["connections"],
+            delta.get("upstream_connections", 0), delta.get("requests", 0),
+            delta.get("tunnels", 0))
+
+class JSONWireClient(object):
+    """A minimal client for the Selenium JSON wire protocol, as spoken
+       by GhostDriver (phantomjs --webdriver), over one keep-alive
+       connection.  Every command is timed; the latencies in ms are
+       kept per command name in 'timings'."""
+    def __init__(self, host, port, timeout=TIMEOUT):
+        self.conn    = httplib.HTTPConnection(host, port, timeout=timeout)
+        self.timings = collections.OrderedDict()
+
+    def close(self):
+        self.conn.close()
+
+    def command(self, name, method, path, params=None):
+        """Send one command and return its 'value'.  Raises
+           RuntimeError if the command fails."""
+        return self.send(name, method, path, params).get("value")
+
+    def new_session(self, capabilities={}):
+        """Create a session and return its id."""
+        return self.send("new session", "POST", "/session",
+                         {"desiredCapabilities": capabilities})["sessionId"]
+
+    def send(self, name, method, path, params=None):
+        body = json.dumps(params) if params is not None else None
+        headers = {"Accept": "application/json"}
+        if body is not None:
+            headers["Content-Type"] = "application/json;charset=UTF-8"
+        t0 = time.time()
+        if self.conn.sock is None:
+            # Don't let Nagle's algorithm add to the measured latency.
+            self.conn.connect()
+            self.conn.sock.setsockopt(socket.IPPROTO_TCP,
+                                      socket.TCP_NODELAY, 1)
+        self.conn.request(method, path, body, headers)
+        resp = self.conn.getresponse()
+        data = resp.read()
+        self.timings.setdefault(name, []).append((time.time() - t0) * 1000)
+
+        try:
+            reply = json.loads(data) if data else {}
+        except ValueError:
+            reply = None
+        if (resp.status >= 400 or not isinstance(reply, dict) or
+            reply.get("status", 0) != 0):
+            raise RuntimeError("{} {}: HTTP {}: {}".format(
+                method, path, resp.status, data[:200].strip()))
+        return reply
+
+class WebDriverBenchmark(Benchmark):
+    """Measure GhostDriver command latency and session throughput.
+       PhantomJS runs in --webdriver mode and is driven directly over
+       the JSON wire protocol (no Selenium client is needed).  Each
+       session loads lib/www/bench/webdriver.html several times, and
+       each time finds and clicks a button, reads the result back with
+       executeScript, and takes a screenshot.
+
+       Parameters:
+         sessions    sessions created, one after another (10)
+         iterations  page loads per session (10)
+         screenshot  take a screenshot on every page load (yes)
+    """
+    COMMANDS = ["new session", "get", "findElement", "click",
+                "executeScript", "screenshot", "delete session"]
+
+    def run(self, grp):
+        sessions   = self.param("sessions", 10)
+        iterations = self.param("iterations", 10)
+        screenshot = self.param("screenshot", True)
+        url = self.env["TEST_HTTP_BASE"] + "bench/webdriver.html"
+
+        pjs, port = self.spawn_webdriver()
+        with pjs:
+            client = JSONWireClient("127.0.0.1", port)
+            try:
+                t0 = time.time()
+                for _ in range(sessions):
+                    self.run_session(client, url, iterations, screenshot)
+                elapsed = time.time() - t0
+            except (RuntimeError, EnvironmentError, httplib.HTTPException) \
+                    as e:
+                grp.add_error(pjs.output[-20:], "webdriver: {}".format(e))
+                return
+            finally:
+                client.close()
+
+        grp.record("sessions/sec", sessions / elapsed, "sessions/s")
+        table = ["{:<15} {:>6} {:>8} {:>8} {:>8}".format(
+            "command", "n", "p50 ms", "p95 ms", "p99 ms")]
+        for name in self.COMMANDS:
+            samples = client.timings.get(name)
+            if not samples:
+                continue
+            for pct in (50, 95, 99):
+                grp.record("p{} {}".format(pct, name),
+                           percentile(samples, pct), "ms",
+                           higher_is_better=False)
+            table.append("{:<15} {:>6} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                name, len(samples), percentile(samples, 50),
+                percentile(samples, 95), percentile(samples, 99)))
+        grp.note(["command latency ({} sessions x {} page loads):"
+                  .format(sessions, iterations)] + table)
+
+    def spawn_webdriver(self):
+        """Start PhantomJS in --webdriver mode on a free port, and wait
+           for it to be ready.  Returns (BackgroundProcess, port)."""
+        port = find_free_port()
+        pjs = self.runner.spawn_phantomjs(
+            None, [], ["--webdriver=127.0.0.1:{}".format(port)], self.env)
+        try:
+            pjs.wait_for(r"running on port", TIMEOUT)
+        except:
+            pjs.stop()
+            raise
+        return pjs, port
+
+    def run_session(self, client, url, iterations, screenshot):
+        base = "/session/" + client.new_session()
+        try:
+            for i in range(iterations):
+                client.command("get", "POST", base + "/url", {"url": url})
+                elem = client.command("findElement", "POST",
+                                      base + "/element",
+                                      {"using": "css selector",
+                                       "value": "#target"})
+                client.command("click", "POST", "{}/element/{}/click"
+                               .format(base, elem["ELEMENT"]), {})
+                count = client.command(
+                    "executeScript", "POST", base + "/execute",
+                    {"script": "return document.getElementById('count')"
+                               ".textContent;", "args": []})
+                if count != "1":
+                    raise RuntimeError("click was not registered "
+                                       "(count = {!r})".format(count))
+                if screenshot:
+                    client.command("screenshot", "GET", base + "/screenshot")
+        finally:
+            client.command("delete session", "DELETE", base)
+
+class WebDriverSessionsBenchmark(WebDriverBenchmark):
+    """Measure how GhostDriver copes with many sessions open at once in
+       one --webdriver process.  For each session count N, N clients
+       (one thread each, each with its own connection) simultaneously
+       open a session, run the 'webdriver' benchmark's page-load loop,
+       and delete it.  Command throughput, p99 command latency and peak
+       RSS are recorded for each N.
+
+       After each round the process must report no open sessions, and
+       its RSS must fall back to within 'retained_mb' of the idle RSS
+       measured after a warm-up session; otherwise the round fails.
+
+       Parameters:
+         sessions     comma-separated session counts (1,2,4,8,16)
+         iterations   page loads per session (5)
+         screenshot   take a screenshot on every page load (no)
+         retained_mb  RSS a round may leave behind, in MiB (32)
+    """
+    def run(self, grp):
+        levels     = self.param("sessions", [1, 2, 4, 8, 16])
+        iterations = self.param("iterations", 5)
+        screenshot = self.param("screenshot", False)
+        retained   = self.param("retained_mb", 32.0)
+        url = self.env["TEST_HTTP_BASE"] + "bench/webdriver.html"
+
+        pjs, port = self.spawn_webdriver()
+        with pjs:
+            errors = self.run_round(port, url, 1, 1, False)[1]
+            if errors:
+                grp.add_error(pjs.output[-20:],
+                              "warm-up session: {}".format(errors[0]))
+                return
+            idle = self.settle(pjs.pid, None)
+
+            curve = ["{:>8} {:>10} {:>8} {:>10} {:>10}".format(
+                "sessions", "cmds/sec", "p99 ms", "peak RSS", "after")]
+            for n in levels:
+                tag = "n={}".format(n)
+                with RSSSampler(pjs.pid) as sampler:
+                    timings, errors, elapsed = self.run_round(
+                        port, url, n, iterations, screenshot)
+                for e in errors[:5]:
+                    grp.add_fail([], "{}: {}".format(tag, e))
+                if not timings:
+                    continue
+
+                rate = len(timings) / elapsed
+                grp.record("commands/sec ({})".format(tag), rate, "cmds/s")
+                grp.record("p99 command latency ({})".format(tag),
+                           percentile(timings, 99), "ms",
+                           higher_is_better=False)
+                if sampler.peak is not None:
+                    grp.record("peak RSS ({})".format(tag),
+                               sampler.peak / 1048576.0, "MiB",
+                               higher_is_better=False)
+
+                left = self.open_sessions(port)
+                if left:
+                    grp.add_fail([], "{}: {} sessions still open after"
+                                 " DELETE".format(tag, left))
+                after = self.settle(pjs.pid, idle + retained * 1048576
+                                    if idle is not None else None)
+                if after is not None and idle is not None:
+                    grp.record("RSS retained ({})".format(tag),
+                               max(after - idle, 0) / 1048576.0, "MiB",
+                               higher_is_better=False)
+                    if after - idle > retained * 1048576:
+                        grp.add_fail([], "{}: {:.1f} MiB not returned"
+                                     " after DELETE".format(
+                                         tag, (after - idle) / 1048576.0))
+
+                curve.append("{:>8} {:>10.1f} {:>8.1f} {:>10} {:>10}".format(
+                    n, rate, percentile(timings, 99),
+                    "{:.1f} MiB".format(sampler.peak / 1048576.0)
+                    if sampler.peak else "n/a",
+                    "{:.1f} MiB".format(after / 1048576.0)
+                    if after else "n/a"))
+
+        grp.note(["session scaling ({} page loads per session):"
+                  .format(iterations)] + curve)
+
+    def run_round(self, port, url, n, iterations, screenshot):
+        """Run N sessions concurrently.  Returns (all command latencies
+           in ms, error messages, elapsed seconds)."""
+        clients = [JSONWireClient("127.0.0.1", port) for _ in range(n)]
+        errors = []
+        go = threading.Event()
+
+        def session(client):
+            go.wait()
+            try:
+                self.run_session(client, url, iterations, screenshot)
+            except (RuntimeError, EnvironmentError,
+                    httplib.HTTPException) as e:
+                errors.append(str(e))
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=session, args=(c,))
+                   for c in clients]
+        for t in threads:
+            t.start()
+        t0 = time.time()
+        go.set()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - t0
+
+        timings = []
+        for c in clients:
+            for samples in c.timings.values():
+                timings.extend(samples)
+        return timings, errors, elapsed
+
+    def open_sessions(self, port):
+        client = JSONWireClient("127.0.0.1", port)
+        try:
+            return len(client.command("sessions", "GET", "/sessions"))
+        finally:
+            client.close()
+
+    def settle(self, pid, target, wait=5.0):
+        """Give the process up to WAIT seconds to release memory, and
+           return its final RSS; stop early once it is below TARGET.
+           With no TARGET, wait until RSS stops falling."""
+        rss = read_proc_status(pid, "VmRSS")
+        deadline = time.time() + wait
+        while rss is not None and time.time() < deadline:
+            if target is not None and rss <= target:
+                break
+            time.sleep(0.25)
+            prev, rss = rss, read_proc_status(pid, "VmRSS")
+            if target is None and rss is not None and rss >= prev:
+                break
+        return rss
+
+class RSSSampler(object):
+    """Samples the RSS of process PID in the background while in use as
+       a context manager; 'peak' is the largest value seen, or None if
+       RSS could not be read."""
+    def __init__(self, pid, interval=0.05):
+        self.pid      = pid
+        self.interval = interval
+        self.peak     = None
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while True:
+            rss = read_proc_status(self.pid, "VmRSS")
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *dontcare):
+        self._stop.set()
+        self._thread.join()
+
+BENCHMARKS = collections.OrderedDict((
+    ("webserver",  WebserverBenchmark),
+    ("render",     RenderBenchmark),
+    ("multipage",  MultipageBenchmark),
+    ("startup",    StartupBenchmark),
+    ("disk-cache", DiskCacheBenchmark),
+    ("webdriver",  WebDriverBenchmark),
+    ("webdriver-sessions", WebDriverSessionsBenchmark),
+    ("fs",         FsBenchmark),
+    ("child-process", ChildProcessBenchmark),
+    ("cookies",    CookieJarBenchmark),
+    ("soak",       SoakBenchmark),
+    ("stdio",      StdioBenchmark),
+    ("proxy",      ProxyBenchmark),
+))
+
+def parse_bench_param(arg):
+    name, sep, value = arg.partition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE, got " + arg)
+    return (name, value)
+
 def init():
     base_path = os.path.normpath(os.path.dirname(os.path.abspath(__file__)))
 
@@ -1031,9 +5165,88 @@ def init():
                         choices=['always', 'never', 'auto'],
                         help="colorize the output; can be 'always',"
                         " 'never', or 'auto' (the default)")
+    parser.add_argument('--bench', metavar='NAME', action='append',
+                        default=[], choices=list(BENCHMARKS),
+                        help="Run benchmark NAME instead of the tests"
+                        " (repeatable); one of: " + ", ".join(BENCHMARKS))
+    parser.add_argument('--bench-startup', dest='bench',
+                        action='append_const', const='startup',
+                        help="Same as --bench startup")
+    parser.add_argument('--bench-param', metavar='NAME=VALUE',
+                        dest='bench_params', action='append', default=[],
+                        type=parse_bench_param,
+                        help="Set a benchmark parameter (repeatable)")
+    parser.add_argument('--baseline', metavar='FILE',
+                        default=os.path.join(base_path, BENCH_DIR,
+                                             'baseline.json'),
+                        help="Compare benchmark results against FILE"
+                        " (default: %(default)s)")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Record benchmark results in the baseline file")
+    parser.add_argument('--tolerance', metavar='PCT', type=float,
+                        default=TOLERANCE,
+                        help="Fail benchmarks more than PCT percent worse"
+                        " than baseline (default: %(default)s)")
+
+    parser.add_argument('--profile', metavar='TOOL', default=None,
+                        choices=list(PROFILERS),
+                        help="Run each test under a profiler (one of: " +
+                        ", ".join(PROFILERS) + ") and report the hottest"
+                        " functions across the suite")
+    parser.add_argument('--profile-dir', metavar='DIR',
+                        default='phantomjs-profiles',
+                        help="Write per-test profiles and the aggregated"
+                        " reports to DIR (default: %(default)s)")
+    parser.add_argument('--render-diff-dir', metavar='DIR',
+                        default='render-diffs',
+                        help="Write images showing how renders that failed"
+                        " a compare-renders check differ from their"
+                        " references to DIR (default: %(default)s)")
+    parser.add_argument('--result-cache', metavar='FILE', default=None,
+                        help="Skip tests that passed on an earlier run with"
+                        " this cache FILE, if nothing they depend on has"
+                        " changed since; replay their results instead")
+    parser.add_argument('--request-trace', metavar='FILE', default=None,
+                        help="Record when each connection and request to"
+                        " the test servers began and ended, and write the"
+                        " waterfall to FILE: a HAR file if FILE ends in"
+                        " .har, otherwise a Chrome trace")
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help="Write a Chrome trace of the runner's own"
+                        " activity (test discovery, directive parsing,"
+                        " PhantomJS processes, output parsing, server"
+                        " requests) to FILE")
+    parser.add_argument('--server-workers', metavar='N', type=int, default=1,
+                        help="Serve HTTP(S) from N worker processes"
+                        " (default: %(default)s)")
+    parser.add_argument('--watch', action='store_true',
+                        help="After running the tests, keep the test"
+                        " servers running, and whenever a test script,"
+                        " a file below lib/ or the PhantomJS binary"
+                        " changes, rerun the tests it affects")
 
     options = parser.parse_args()
+    if options.profile:
+        if options.debugger:
+            parser.error("--profile cannot be combined with --debugger")
+        tool = "valgrind" if options.profile == "callgrind" else "perf"
+        if distutils.spawn.find_executable(tool) is None:
+            parser.error("--profile={} requires '{}', which is not"
+                         " installed".format(options.profile, tool))
+    if options.result_cache and (options.profile or options.debugger):
+        parser.error("--result-cache cannot be combined with --profile"
+                     " or --debugger")
+    if options.watch and (options.bench or options.profile or
+                          options.debugger):
+        parser.error("--watch cannot be combined with --bench, --profile"
+                     " or --debugger")
+    if options.server_workers < 1:
+        parser.error("--server-workers must be at least 1")
+    if options.server_workers > 1 and not hasattr(os, 'fork'):
+        parser.error("--server-workers is not supported on this platform")
     activate_colorization(options)
+    if options.trace:
+        TRACER.enable()
     runner = TestRunner(base_path, phantomjs_exe, options)
     if options.verbose:
         rc, ver, err = runner.run_phantomjs('--version', silent=True)
@@ -1055,7 +5268,14 @@ def main():
     try:
         with HTTPTestServer(runner.base_path,
                             runner.signal_server_error,
-                            runner.verbose):
+                            runner.verbose,
+                            runner.request_stats,
+                            runner.server_workers) as server:
+            runner.server = server
+            if runner.benchmarks:
+                sys.exit(runner.run_benchmarks())
+            if runner.watch_mode:
+                sys.exit(runner.watch())
             sys.exit(runner.run_tests())
 
     except Exception: